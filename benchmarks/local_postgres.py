@@ -0,0 +1,84 @@
+"""
+Throwaway PostgreSQL server for the benchmarks: a fresh cluster in a
+temporary directory, listening only on a unix socket, which is deleted when
+stopped.
+"""
+
+import os
+import shutil
+import tempfile
+import subprocess
+
+import psycopg2 as pg
+
+class LocalPostgres(object):
+    def __init__(self, bin_dir=None, port=54329):
+        self.bin_dir = bin_dir
+        self.port = port
+        self.base_dir = None
+
+    def Command(self, name):
+        if self.bin_dir is None:
+            return name
+        return os.path.join(self.bin_dir, name)
+
+    def Start(self):
+        self.base_dir = tempfile.mkdtemp(prefix='gtdb_bench_pg_')
+        self.data_dir = os.path.join(self.base_dir, 'data')
+        self.socket_dir = os.path.join(self.base_dir, 'socket')
+        started = False
+        try:
+            os.mkdir(self.socket_dir)
+            log = open(os.path.join(self.base_dir, 'initdb.log'), 'w')
+            try:
+                subprocess.check_call([self.Command('initdb'), '-D', self.data_dir, '-A', 'trust',
+                                       '-U', 'postgres', '-E', 'UTF8', '--no-locale'],
+                                      stdout=log, stderr=subprocess.STDOUT)
+            finally:
+                log.close()
+            subprocess.check_call([self.Command('pg_ctl'), '-D', self.data_dir, '-w',
+                                   '-l', os.path.join(self.base_dir, 'postgres.log'),
+                                   '-o', "-k %s -p %i -c listen_addresses='' -c fsync=off" %
+                                         (self.socket_dir, self.port),
+                                   'start'])
+            started = True
+        finally:
+            if not started:
+                self.RemoveCluster()
+
+    def RemoveCluster(self):
+        """
+        Removes a cluster which failed to start, stopping the server if it
+        got as far as starting.
+        """
+        if os.path.exists(os.path.join(self.data_dir, 'postmaster.pid')):
+            try:
+                subprocess.call([self.Command('pg_ctl'), '-D', self.data_dir, '-w', '-m', 'immediate', 'stop'])
+            except OSError:
+                pass
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+        self.base_dir = None
+
+    def Dsn(self, dbname='postgres'):
+        return "dbname=%s user=postgres host=%s port=%i" % (dbname, self.socket_dir, self.port)
+
+    def CreateDatabase(self, dbname, schema_file):
+        conn = pg.connect(self.Dsn())
+        conn.set_isolation_level(pg.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute("CREATE DATABASE " + dbname)
+        conn.close()
+
+        conn = pg.connect(self.Dsn(dbname))
+        cur = conn.cursor()
+        cur.execute(open(schema_file).read())
+        conn.commit()
+        conn.close()
+        return self.Dsn(dbname)
+
+    def Stop(self):
+        if self.base_dir is None:
+            return
+        subprocess.call([self.Command('pg_ctl'), '-D', self.data_dir, '-w', '-m', 'fast', 'stop'])
+        shutil.rmtree(self.base_dir)
+        self.base_dir = None
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+Micro benchmarks of the pure python inner loops: FASTA/FASTQ parsing, genome
+segmentation and match column masking in the marker pipelines, genome record
+building, marker concatenation and greengenes formatting in the tree data
+profiles, and XML metadata parsing. The inputs are generated from a fixed
+seed, so runs on the same python are comparable.
+
+Each benchmark reports the best time per operation over several repeats and,
+when the tracemalloc module is available (python 3, or the pytracemalloc
+backport on python 2), the peak and retained memory allocated by one
+operation. Results can be saved with --save and compared against a saved
+baseline with --compare. Without tracemalloc these refuse to run, as the
+allocations can't be measured, unless --times-only is given.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+from cStringIO import StringIO
+import xml.etree.ElementTree as et
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import seq_funcs
+import xml_funcs
+from profiles import tree_data
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_SEED = 1
+DEFAULT_REPEATS = 5
+# Each timed repeat runs the operation enough times to take at least this long
+MIN_REPEAT_SECONDS = 0.2
+# --compare fails if an operation is slower than the baseline by more than this
+DEFAULT_THRESHOLD = 1.10
+
+#-------- Fixed inputs
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+def RandomSequence(rng, length, alphabet='ACGT'):
+    return ''.join([rng.choice(alphabet) for x in xrange(length)])
+
+def FastaLines(rng, contig_count, contig_length):
+    lines = []
+    for contig in range(contig_count):
+        lines.append(">contig_%i\n" % (contig + 1,))
+        seq = RandomSequence(rng, contig_length)
+        for i in range(0, len(seq), 80):
+            lines.append(seq[i:i + 80] + "\n")
+    return lines
+
+def FastqLines(rng, read_count, read_length):
+    lines = []
+    for read in range(read_count):
+        lines.append("@read_%i\n" % (read + 1,))
+        lines.append(RandomSequence(rng, read_length) + "\n")
+        lines.append("+\n")
+        lines.append(RandomSequence(rng, read_length, 'ABCDEFGHIJ') + "\n")
+    return lines
+
+def PfamAlignment(rng, name, columns):
+    """
+    An hmmalign --outformat Pfam alignment of one sequence, with a third of
+    the columns being insert columns.
+    """
+    mask = ''.join([rng.choice('xx.') for x in range(columns)])
+    seq = ''.join([rng.choice('ACDEFGHIKLMNPQRSTVWY-') if m == 'x' else rng.choice('acdefghiklmnpqrstvwy.')
+                   for m in mask])
+    width = len('#=GR ' + name + ' PP') + 1
+    return ("# STOCKHOLM 1.0\n" +
+            "\n" +
+            name.ljust(width) + seq + "\n" +
+            ('#=GR ' + name + ' PP').ljust(width) + '*' * columns + "\n" +
+            '#=GC PP_cons'.ljust(width) + '*' * columns + "\n" +
+            '#=GC RF'.ljust(width) + mask + "\n" +
+            "//\n")
+
+def ChosenMarkers(rng, marker_count):
+    return [(marker_id, "PMPROK%05i" % marker_id, rng.randint(50, 500))
+            for marker_id in range(1, marker_count + 1)]
+
+def GenomeRow(rng, chosen_markers):
+    # Every fifth marker is missing from the genome
+    present = [(marker_id, size) for (marker_id, name, size) in chosen_markers if marker_id % 5 != 0]
+    return (1, 'C00000001', 'Synthetic genome', 'root', 'public',
+            'k__Bacteria;p__Firmicutes;c__Bacilli;o__Bacillales',
+            'k__Bacteria; p__Firmicutes; c__Bacilli; o__Bacillales; f__Bacillaceae',
+            [marker_id for (marker_id, size) in present],
+            [RandomSequence(rng, size, 'ACDEFGHIKLMNPQRSTVWY-') for (marker_id, size) in present])
+
+def MetadataXml(rng):
+    return ('<?xml version="1.0"?><data><internal>' +
+            '<taxonomy>k__Bacteria;p__Firmicutes;c__Bacilli</taxonomy>' +
+            '<core_list>public</core_list>' +
+            '<date_added>1357000000</date_added>' +
+            '<greengenes><dereplicated><best_blast>' +
+            '<greengenes_tax>k__Bacteria; p__Firmicutes; c__Bacilli</greengenes_tax>' +
+            '<identity>%.2f</identity>' % (rng.uniform(90, 100),) +
+            '</best_blast></dereplicated></greengenes>' +
+            ''.join(['<field_%i>%s</field_%i>' % (i, RandomSequence(rng, 20), i) for i in range(20)]) +
+            '</internal></data>')
+
+#-------- Benchmarks
+
+def MetadataFields(xmlstr):
+    """
+    The metadata lookups the tree data profiles made before the fields were
+    moved into columns.
+    """
+    root = et.fromstring(xmlstr)
+    fields = []
+    for path in ('internal/greengenes/dereplicated/best_blast/greengenes_tax',
+                 'internal/taxonomy', 'internal/core_list'):
+        (nodes, created) = xml_funcs.ReturnExtantOrCreateElement(root, path)
+        fields.append('' if created else nodes[0].text)
+    return fields
+
+def MakeBenchmarks(seed):
+    """
+    Returns a list of (name, function) pairs, each function running one
+    operation on the fixed inputs.
+    """
+    rng = random.Random(seed)
+    fasta_lines = FastaLines(rng, 100, 5000)
+    fastq_lines = FastqLines(rng, 2000, 150)
+    genome_records = [('contig_%i' % (i + 1,), RandomSequence(rng, 200000), None) for i in range(10)]
+    alignment = PfamAlignment(rng, '1234_PMPROK00003', 600)
+    chosen_markers = ChosenMarkers(rng, 38)
+    row = GenomeRow(rng, chosen_markers)
+    record = tree_data.MakeGenomeRecord(row)
+    aligned_seq = tree_data.ConcatenateMarkers(record, chosen_markers)
+    greengenes_writer = tree_data.GreengenesWriter(NullWriter(), len(chosen_markers))
+    metadata_xml = MetadataXml(rng)
+    null_writer = NullWriter()
+
+    return [('readfq (fasta, 100 x 5 kb contigs)',
+             lambda: list(seq_funcs.readfq(iter(fasta_lines)))),
+            ('readfq (fastq, 2000 x 150 bp reads)',
+             lambda: list(seq_funcs.readfq(iter(fastq_lines)))),
+            ('segmentation (10 x 200 kb contigs)',
+             lambda: seq_funcs.WriteSegmentedFasta(null_writer, genome_records)),
+            ('match column masking (600 columns)',
+             lambda: seq_funcs.ReadMaskedAlignment(StringIO(alignment))),
+            ('genome record (38 markers)',
+             lambda: tree_data.MakeGenomeRecord(row)),
+            ('marker concatenation (38 markers)',
+             lambda: tree_data.ConcatenateMarkers(record, chosen_markers)),
+            ('greengenes record',
+             lambda: greengenes_writer.Write(record, aligned_seq)),
+            ('xml metadata parsing',
+             lambda: MetadataFields(metadata_xml))]
+
+#-------- Measurement
+
+def TimeOperation(func, repeats):
+    """
+    Returns the best time of one run of func, in nanoseconds, over the
+    repeats.
+    """
+    # The loop count is calibrated under the same conditions (no garbage
+    # collection) as the timed repeats
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        loops = 1
+        while True:
+            start = time.time()
+            for i in xrange(loops):
+                func()
+            elapsed = time.time() - start
+            if elapsed >= MIN_REPEAT_SECONDS:
+                break
+            loops *= 2 if elapsed == 0 else max(2, int(MIN_REPEAT_SECONDS / elapsed) + 1)
+
+        best = elapsed / loops
+        for repeat in range(repeats - 1):
+            start = time.time()
+            for i in xrange(loops):
+                func()
+            best = min(best, (time.time() - start) / loops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best * 1e9
+
+def MeasureAllocations(func):
+    """
+    Returns the (peak, retained) bytes allocated by one run of func, or
+    (None, None) if tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        return (None, None)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        (retained, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return (peak, retained)
+
+def RunBenchmarks(seed, repeats, selected=None):
+    results = dict()
+    for (name, func) in MakeBenchmarks(seed):
+        if selected is not None and selected not in name:
+            continue
+        ns_per_op = TimeOperation(func, repeats)
+        (peak_bytes, retained_bytes) = MeasureAllocations(func)
+        results[name] = {'ns_per_op' : ns_per_op,
+                         'peak_bytes' : peak_bytes,
+                         'retained_bytes' : retained_bytes}
+    return results
+
+#-------- Reporting
+
+def FormatBytes(value):
+    if value is None:
+        return 'n/a'
+    return '%i' % (value,)
+
+def WriteReport(fh, results):
+    fh.write("%-40s %16s %14s %14s\n" % ("Benchmark", "ns/op", "Peak bytes", "Retained"))
+    for name in sorted(results.keys()):
+        result = results[name]
+        fh.write("%-40s %16.0f %14s %14s\n" % (name, result['ns_per_op'],
+                                               FormatBytes(result['peak_bytes']),
+                                               FormatBytes(result['retained_bytes'])))
+
+def WriteComparison(fh, results, baseline, threshold):
+    """
+    Writes the change of each benchmark against the baseline and returns
+    the names of those slower than the baseline by more than threshold.
+    """
+    regressions = []
+    fh.write("%-40s %16s %16s %8s\n" % ("Benchmark", "Baseline ns/op", "ns/op", "Ratio"))
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            fh.write("%-40s %16s %16.0f %8s\n" % (name, 'n/a', results[name]['ns_per_op'], 'new'))
+            continue
+        ratio = results[name]['ns_per_op'] / baseline[name]['ns_per_op']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        fh.write("%-40s %16.0f %16.0f %8.2f%s\n" % (name, baseline[name]['ns_per_op'],
+                                                    results[name]['ns_per_op'], ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the micro benchmarks of the pure python hot paths.')
+    parser.add_argument('--seed', dest='seed', type=int, default=DEFAULT_SEED,
+                        help='Seed of the fixed inputs. Only compare runs with the same seed.')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=DEFAULT_REPEATS,
+                        help='Number of timed repeats, the best is reported.')
+    parser.add_argument('--only', dest='only',
+                        help='Only run the benchmarks whose name contains this string.')
+    parser.add_argument('--save', dest='save',
+                        help='Save the results as a baseline to this file.')
+    parser.add_argument('--compare', dest='compare',
+                        help='Compare the results against the baseline in this file.')
+    parser.add_argument('--times-only', dest='times_only', action='store_true', default=False,
+                        help='Allow --save and --compare without tracemalloc, recording only the times.')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='With --compare, exit with an error if any benchmark is slower than ' +
+                             'the baseline by more than this ratio.')
+    args = parser.parse_args()
+
+    if tracemalloc is None:
+        if (args.save or args.compare) and not args.times_only:
+            sys.stderr.write("The allocations can't be measured without the tracemalloc module (python 3, " +
+                             "or the pytracemalloc backport on python 2). Pass --times-only to save or " +
+                             "compare the times alone.\n")
+            sys.exit(1)
+        sys.stderr.write("tracemalloc is not available, the allocations are not measured.\n")
+
+    results = RunBenchmarks(args.seed, args.repeats, args.only)
+    WriteReport(sys.stdout, results)
+
+    if args.save:
+        fh = open(args.save, 'wb')
+        try:
+            json.dump({'metadata' : {'recorded' : time.time(),
+                                     'python' : platform.python_version(),
+                                     'seed' : args.seed,
+                                     'repeats' : args.repeats,
+                                     'allocations' : tracemalloc is not None},
+                       'benchmarks' : results}, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        if baseline['metadata']['seed'] != args.seed:
+            sys.stderr.write("The baseline was recorded with a different seed.\n")
+            sys.exit(1)
+        print
+        regressions = WriteComparison(sys.stdout, results, baseline['benchmarks'], args.threshold)
+        if regressions:
+            sys.stderr.write("%i benchmark(s) slower than the baseline: %s\n" %
+                             (len(regressions), ", ".join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+End to end benchmarks of the genome tree backend. A throwaway PostgreSQL
+cluster is provisioned with the base schema (schema.sql) and the migrations,
+filled with seeded synthetic genomes, and the main backend operations are
+timed. The timings are written as JSON so that runs can be compared.
+
+With --stub-tools, transeq, hmmsearch and hmmalign are replaced by the
+deterministic stubs in benchmarks/stubs so that the marker pipeline can be
+timed without EMBOSS and HMMER installed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import socket
+import argparse
+import tempfile
+import platform
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import genome_tree_backend as backend
+import markers as markers_module
+
+from local_postgres import LocalPostgres
+
+SCALES = {'10' : 10,
+          '1k' : 1000,
+          '100k' : 100000}
+
+ROOT_USERNAME = 'root'
+ROOT_PASSWORD = 'benchmark'
+DATABASE_NAME = 'genome_tree_benchmark'
+TREE_ID_PREFIX = 'B'
+
+#-------- Synthetic data
+
+def WriteSyntheticGenome(path, rng, genome_length, contig_count):
+    """
+    Writes a FASTA file of contig_count random contigs adding up to
+    genome_length bases.
+    """
+    fh = open(path, 'w')
+    contig_length = max(genome_length / contig_count, 1)
+    for contig in range(contig_count):
+        fh.write(">contig_%i\n" % (contig + 1,))
+        seq = ''.join([rng.choice('ACGT') for x in xrange(contig_length)])
+        for i in range(0, len(seq), 80):
+            fh.write(seq[i:i + 80] + "\n")
+    fh.close()
+
+def SyntheticAlignedSequence(rng, length):
+    return ''.join([rng.choice('ACDEFGHIKLMNPQRSTVWY-') for x in xrange(length)])
+
+def MarkerLength(marker):
+    """
+    The model length (the LENG line) of the HMM of a marker.
+    """
+    path = os.path.join(os.path.dirname(markers_module.__file__), marker.rel_path)
+    for line in open(path):
+        if line.startswith('LENG'):
+            return int(line.split()[1])
+    return 0
+
+#-------- Timing
+
+class Timings(object):
+    def __init__(self):
+        self.samples = dict()
+        self.order = []
+
+    def Time(self, operation, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.Add(operation, time.time() - start)
+        return result
+
+    def Add(self, operation, seconds):
+        if operation not in self.samples:
+            self.samples[operation] = []
+            self.order.append(operation)
+        self.samples[operation].append(seconds)
+
+    def Summary(self):
+        summary = dict()
+        for (operation, samples) in self.samples.items():
+            summary[operation] = {'count' : len(samples),
+                                  'total_seconds' : sum(samples),
+                                  'mean_seconds' : sum(samples) / len(samples),
+                                  'min_seconds' : min(samples),
+                                  'max_seconds' : max(samples)}
+        return summary
+
+    def WriteReport(self, fh):
+        summary = self.Summary()
+        fh.write("%-45s %8s %12s %12s %12s\n" % ("Operation", "Count", "Total (s)", "Mean (ms)", "Max (ms)"))
+        for operation in self.order:
+            stats = summary[operation]
+            fh.write("%-45s %8i %12.3f %12.3f %12.3f\n" % (operation, stats['count'], stats['total_seconds'],
+                                                            stats['mean_seconds'] * 1000,
+                                                            stats['max_seconds'] * 1000))
+
+#-------- Setup
+
+def SetupDatabase(db):
+    """
+    Creates the root user and the marker databases, logs in and applies the
+    migrations.
+    """
+    with db.Transaction() as cur:
+        cur.execute("INSERT INTO users (username, password, type_id) VALUES (%s, %s, 0)",
+                    (ROOT_USERNAME, db.GenerateHashedPassword(ROOT_PASSWORD)))
+        for marker in markers_module.getAllMarkerSets():
+            cur.execute("INSERT INTO databases (name) SELECT %s " +
+                        "WHERE NOT EXISTS (SELECT 1 FROM databases WHERE name = %s)",
+                        (marker.database, marker.database))
+            cur.execute("INSERT INTO markers (database_specific_id, database_id, version, size) " +
+                        "SELECT %s, id, %s, %s FROM databases WHERE name = %s",
+                        (marker.name, marker.version, MarkerLength(marker), marker.database))
+
+    if not db.UserLogin(ROOT_USERNAME, ROOT_PASSWORD):
+        raise RuntimeError(db.lastErrorMessage)
+    if db.MigrateDatabase() is None:
+        raise RuntimeError(db.lastErrorMessage)
+
+def FillAlignedMarkers(db, rng, genome_ids):
+    """
+    Stores synthetic aligned markers for genomes whose markers were not
+    calculated, so that the tree data benchmarks have data for every genome.
+    """
+    with db.Cursor() as cur:
+        cur.execute("SELECT id, size FROM markers")
+        marker_sizes = cur.fetchall()
+
+    def Rows():
+        for genome_id in genome_ids:
+            for (marker_id, size) in marker_sizes:
+                yield backend.CopyRow((genome_id, marker_id, 'f',
+                                       SyntheticAlignedSequence(rng, size)))
+
+    with db.Transaction() as cur:
+        cur.copy_expert("COPY aligned_markers (genome_id, marker_id, dna, sequence) FROM STDIN",
+                        backend.IterFile(Rows()))
+
+#-------- Benchmarks
+
+def BenchmarkAddGenomes(db, timings, rng, work_dir, genome_count, genome_length, contig_count):
+    genome_ids = []
+    fasta_file = os.path.join(work_dir, 'genome.fna')
+    for i in range(genome_count):
+        WriteSyntheticGenome(fasta_file, rng, genome_length, contig_count)
+        genome_id = timings.Time('AddFastaGenome', db.AddFastaGenome, fasta_file,
+                                 'Synthetic genome %i' % (i + 1,), 'Benchmark genome', TREE_ID_PREFIX)
+        if genome_id is None:
+            raise RuntimeError(db.lastErrorMessage)
+        genome_ids.append(genome_id)
+    os.unlink(fasta_file)
+    return genome_ids
+
+def BenchmarkCalculateMarkers(db, timings, genome_ids):
+    for genome_id in genome_ids:
+        timings.Time('CalculateMarkersForGenome', db.CalculateMarkersForGenome, genome_id)
+
+def BenchmarkSearchGenomes(db, timings, repeats):
+    for i in range(repeats):
+        timings.Time('SearchGenomes (all)', lambda: list(db.SearchGenomes()))
+        timings.Time('SearchGenomes (name)', lambda: list(db.SearchGenomes(name='genome 1')))
+        timings.Time('SearchGenomes (page of 100)', lambda: list(db.SearchGenomes(limit=100)))
+        timings.Time('SearchGenomes (metadata fields)',
+                     lambda: list(db.SearchGenomes(metadata_fields=['taxonomy', 'greengenes_tax'])))
+
+def BenchmarkGenomeLists(db, timings, rng, genome_ids, repeats):
+    owner_id = db.currentUser.getUserId()
+    list_size = max(len(genome_ids) / 2, 1)
+    for i in range(repeats):
+        first = timings.Time('CreateGenomeList', db.CreateGenomeList,
+                             rng.sample(genome_ids, list_size), 'bench_a_%i' % i, '', owner_id, True)
+        second = timings.Time('CreateGenomeList', db.CreateGenomeList,
+                              rng.sample(genome_ids, list_size), 'bench_b_%i' % i, '', owner_id, True)
+
+        timings.Time('GetGenomeIdListFromGenomeListIds', db.GetGenomeIdListFromGenomeListIds,
+                     [first, second])
+
+        new_lists = []
+        for operation in ('union', 'intersection', 'difference'):
+            result = timings.Time('CombineGenomeLists (%s)' % operation, db.CombineGenomeLists,
+                                  operation, [first, second], 'bench_%s_%i' % (operation, i), '',
+                                  owner_id, True)
+            if result is not None:
+                new_lists.append(result[0])
+
+        timings.Time('ModifyGenomeList (add)', db.ModifyGenomeList, first,
+                     genome_ids=rng.sample(genome_ids, list_size), operation='add')
+        timings.Time('ModifyGenomeList (remove)', db.ModifyGenomeList, first,
+                     genome_ids=rng.sample(genome_ids, list_size), operation='remove')
+
+        timings.Time('GetGenomeLists (owner)', lambda: list(db.GetGenomeLists(owner_id)))
+        timings.Time('GetGenomeLists (all)', lambda: list(db.GetGenomeLists()))
+
+        for genome_list_id in [first, second] + new_lists:
+            timings.Time('DeleteGenomeList', db.DeleteGenomeList, genome_list_id, True)
+
+def BenchmarkTreeData(db, timings, genome_ids, work_dir):
+    for profile in sorted(db.ReturnKnownProfiles()):
+        directory = os.path.join(work_dir, profile)
+        timings.Time('MakeTreeData (%s)' % profile, db.MakeTreeData, [], list(genome_ids),
+                     profile, directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+#-------- Main
+
+def RunBenchmarks(args):
+    if args.stub_tools:
+        os.environ['PATH'] = os.path.join(BENCHMARK_DIR, 'stubs') + os.pathsep + os.environ['PATH']
+
+    genome_count = args.genomes if args.genomes is not None else SCALES[args.scale]
+    rng = random.Random(args.seed)
+    timings = Timings()
+    work_dir = tempfile.mkdtemp(prefix='gtdb_bench_')
+
+    server = LocalPostgres(args.pg_bin_dir, args.port)
+    try:
+        server.Start()
+        dsn = server.CreateDatabase(DATABASE_NAME, os.path.join(BENCHMARK_DIR, 'schema.sql'))
+        db = backend.GenomeDatabase(dsn)
+        db.MakePostgresConnection()
+        SetupDatabase(db)
+
+        genome_ids = BenchmarkAddGenomes(db, timings, rng, work_dir, genome_count,
+                                         args.genome_length, args.contigs)
+
+        marker_sample = genome_ids[:args.marker_sample]
+        BenchmarkCalculateMarkers(db, timings, marker_sample)
+        FillAlignedMarkers(db, rng, genome_ids[len(marker_sample):])
+
+        BenchmarkSearchGenomes(db, timings, args.repeats)
+        BenchmarkGenomeLists(db, timings, rng, genome_ids, args.repeats)
+        BenchmarkTreeData(db, timings, genome_ids, work_dir)
+
+        db.ClosePostgresConnection()
+    finally:
+        server.Stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    timings.WriteReport(sys.stderr)
+
+    results = {'metadata' : {'recorded' : time.time(),
+                             'host' : socket.gethostname(),
+                             'python' : platform.python_version(),
+                             'genomes' : genome_count,
+                             'genome_length' : args.genome_length,
+                             'contigs' : args.contigs,
+                             'marker_sample' : len(marker_sample),
+                             'repeats' : args.repeats,
+                             'seed' : args.seed,
+                             'stub_tools' : args.stub_tools},
+               'operations' : timings.Summary()}
+    fh = open(args.output, 'wb')
+    try:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    finally:
+        fh.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the end to end genome tree benchmarks.')
+    parser.add_argument('--scale', dest='scale', choices=sorted(SCALES.keys()), default='10',
+                        help='Number of synthetic genomes to load.')
+    parser.add_argument('--genomes', dest='genomes', type=int,
+                        help='Exact number of synthetic genomes to load (overrides --scale).')
+    parser.add_argument('--genome-length', dest='genome_length', type=int, default=20000,
+                        help='Length in bases of each synthetic genome.')
+    parser.add_argument('--contigs', dest='contigs', type=int, default=5,
+                        help='Number of contigs in each synthetic genome.')
+    parser.add_argument('--marker-sample', dest='marker_sample', type=int, default=5,
+                        help='Number of genomes to run the marker pipeline on. The other ' +
+                             'genomes are given synthetic aligned markers.')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                        help='Number of times to repeat the search and list benchmarks.')
+    parser.add_argument('--seed', dest='seed', type=int, default=1,
+                        help='Seed of the synthetic data.')
+    parser.add_argument('--stub-tools', dest='stub_tools', action='store_true', default=False,
+                        help='Use the deterministic transeq/hmmsearch/hmmalign stubs.')
+    parser.add_argument('--pg-bin-dir', dest='pg_bin_dir',
+                        help='Directory of initdb and pg_ctl, if not on the PATH.')
+    parser.add_argument('--port', dest='port', type=int, default=54329,
+                        help='Port of the throwaway PostgreSQL server.')
+    parser.add_argument('--output', dest='output', default='benchmark_results.json',
+                        help='File to write the JSON results to.')
+
+    RunBenchmarks(parser.parse_args())
@@ -0,0 +1,71 @@
+-- Base schema of the genome tree database, reconstructed from the queries
+-- in the backend, for provisioning throwaway benchmark databases. Columns
+-- added by db_migrations.py are not included here, the benchmark harness
+-- applies the migrations on top of this with MigrateDatabase.
+
+CREATE TABLE user_types (
+    id integer PRIMARY KEY,
+    name text NOT NULL
+);
+
+CREATE TABLE users (
+    id serial PRIMARY KEY,
+    username text NOT NULL UNIQUE,
+    password text NOT NULL,
+    type_id integer NOT NULL REFERENCES user_types(id)
+);
+
+CREATE TABLE genome_sources (
+    id serial PRIMARY KEY,
+    name text NOT NULL UNIQUE
+);
+
+CREATE TABLE genomes (
+    id serial PRIMARY KEY,
+    tree_id text NOT NULL UNIQUE,
+    name text,
+    description text,
+    metadata xml,
+    owner_id integer REFERENCES users(id),
+    genome_source_id integer REFERENCES genome_sources(id),
+    id_at_source text,
+    genomic_fasta oid
+);
+
+CREATE TABLE genome_lists (
+    id serial PRIMARY KEY,
+    name text NOT NULL,
+    description text,
+    owner_id integer REFERENCES users(id),
+    private boolean NOT NULL DEFAULT True
+);
+
+CREATE TABLE genome_list_contents (
+    list_id integer NOT NULL REFERENCES genome_lists(id),
+    genome_id integer NOT NULL REFERENCES genomes(id),
+    PRIMARY KEY (list_id, genome_id)
+);
+
+CREATE TABLE databases (
+    id serial PRIMARY KEY,
+    name text NOT NULL UNIQUE
+);
+
+CREATE TABLE markers (
+    id serial PRIMARY KEY,
+    database_specific_id text NOT NULL,
+    database_id integer NOT NULL REFERENCES databases(id),
+    version text NOT NULL,
+    size integer NOT NULL
+);
+
+CREATE TABLE aligned_markers (
+    genome_id integer NOT NULL REFERENCES genomes(id),
+    marker_id integer NOT NULL REFERENCES markers(id),
+    dna boolean NOT NULL,
+    sequence text,
+    PRIMARY KEY (genome_id, marker_id, dna)
+);
+
+INSERT INTO user_types (id, name) VALUES (0, 'root'), (1, 'admin'), (2, 'user');
+INSERT INTO genome_sources (name) VALUES ('user');
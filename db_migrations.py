@@ -0,0 +1,203 @@
+"""
+Schema migrations for the genome tree database, applied in order by
+GenomeDatabase.MigrateDatabase() (the MigrateDatabase command). Each
+migration is a (name, statements) tuple and is applied in a single
+transaction. The names of applied migrations are recorded in the
+schema_migrations table so that each one only ever runs once.
+
+Append new migrations to the end of the list, never edit applied ones.
+"""
+
+# PostgreSQL cannot modify XML documents, so the metadata fields moved into
+# columns are removed from the serialized documents by this function. It
+# walks the tags of the document and drops the elements (with their
+# attributes and contents) found at exactly element_path, e.g.
+# '{data,internal,core_list}', leaving same-named elements elsewhere alone.
+# It is created by the migrations which need it and dropped afterwards.
+REMOVE_XML_ELEMENT_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION genome_tree_remove_xml_element(doc text, element_path text[]) " +
+    "RETURNS text AS $$ " +
+    "DECLARE " +
+        "result text := ''; " +
+        "pos integer := 1; " +
+        "tag_start integer; " +
+        "tag_length integer; " +
+        "tag text; " +
+        "tag_name text; " +
+        "path text[] := '{}'; " +
+        "skip_depth integer; " +
+    "BEGIN " +
+        "LOOP " +
+            "tag_start := strpos(substr(doc, pos), '<'); " +
+            "EXIT WHEN tag_start = 0; " +
+            "tag_start := pos + tag_start - 1; " +
+            "IF skip_depth IS NULL THEN " +
+                "result := result || substr(doc, pos, tag_start - pos); " +
+            "END IF; " +
+            "IF substr(doc, tag_start, 4) = '<!--' THEN " +
+                "tag_length := strpos(substr(doc, tag_start), '-->') + 2; " +
+            "ELSIF substr(doc, tag_start, 9) = '<![CDATA[' THEN " +
+                "tag_length := strpos(substr(doc, tag_start), ']]>') + 2; " +
+            "ELSIF substr(doc, tag_start, 2) = '<?' THEN " +
+                "tag_length := strpos(substr(doc, tag_start), '?>') + 1; " +
+            "ELSE " +
+                # '>' may appear in attribute values but '<' may not, so a
+                # tag ends at the last '>' before the next '<'
+                "tag := substr(doc, tag_start, " +
+                              "coalesce(nullif(strpos(substr(doc, tag_start + 1), '<'), 0), " +
+                                       "length(doc) - tag_start + 1)); " +
+                "tag_length := length(tag) - strpos(reverse(tag), '>') + 1; " +
+            "END IF; " +
+            "tag := substr(doc, tag_start, tag_length); " +
+            "tag_name := substring(tag FROM '^</?([^[:space:]/>]+)'); " +
+            "IF tag_name IS NULL OR left(tag, 2) IN ('<!', '<?') THEN " +
+                "NULL; " +
+            "ELSIF left(tag, 2) = '</' THEN " +
+                "IF skip_depth = coalesce(array_length(path, 1), 0) THEN " +
+                    "skip_depth := NULL; " +
+                    "tag := ''; " +
+                "END IF; " +
+                "path := path[1:coalesce(array_length(path, 1), 0) - 1]; " +
+            "ELSIF right(tag, 2) = '/>' THEN " +
+                "IF skip_depth IS NULL AND path || tag_name = element_path THEN " +
+                    "tag := ''; " +
+                "END IF; " +
+            "ELSE " +
+                "path := path || tag_name; " +
+                "IF skip_depth IS NULL AND path = element_path THEN " +
+                    "skip_depth := array_length(path, 1); " +
+                "END IF; " +
+            "END IF; " +
+            "IF skip_depth IS NULL THEN " +
+                "result := result || tag; " +
+            "END IF; " +
+            "pos := tag_start + tag_length; " +
+        "END LOOP; " +
+        "RETURN result || substr(doc, pos); " +
+    "END; " +
+    "$$ LANGUAGE plpgsql IMMUTABLE")
+
+MIGRATIONS = [
+    # Core list membership ('public' or 'private') was stored in the XML
+    # metadata as internal/core_list, which meant parsing the metadata of
+    # every genome to select the core lists. The values are moved to an
+    # indexed column.
+    ("0001_genomes_core_list_column",
+     ["ALTER TABLE genomes ADD COLUMN core_list text",
+      REMOVE_XML_ELEMENT_FUNCTION,
+      "UPDATE genomes " +
+      "SET core_list = (xpath('/data/internal/core_list/text()', metadata))[1]::text, " +
+          "metadata = XMLPARSE(DOCUMENT genome_tree_remove_xml_element(XMLSERIALIZE(DOCUMENT metadata AS text), " +
+                                                                      "'{data,internal,core_list}')) " +
+      "WHERE xpath_exists('/data/internal/core_list', metadata)",
+      "DROP FUNCTION genome_tree_remove_xml_element(text, text[])",
+      "CREATE INDEX genomes_core_list_idx ON genomes (core_list) WHERE core_list IS NOT NULL"]),
+
+    # The remaining metadata fields read or written on every export and
+    # search are moved out of the XML metadata into typed columns as well.
+    # A date_added which isn't a number of seconds since the epoch is left
+    # in the XML metadata rather than failing the migration.
+    ("0002_genomes_promoted_metadata_columns",
+     ["ALTER TABLE genomes " +
+      "ADD COLUMN taxonomy text, " +
+      "ADD COLUMN greengenes_tax text, " +
+      "ADD COLUMN date_added timestamp with time zone",
+      REMOVE_XML_ELEMENT_FUNCTION,
+      "UPDATE genomes " +
+      "SET taxonomy = promoted.taxonomy, " +
+          "greengenes_tax = promoted.greengenes_tax, " +
+          "date_added = CASE WHEN promoted.date_valid " +
+                            "THEN to_timestamp(promoted.date_added::double precision) END, " +
+          "metadata = XMLPARSE(DOCUMENT " +
+              "genome_tree_remove_xml_element(" +
+                  "genome_tree_remove_xml_element(" +
+                      "CASE WHEN promoted.date_valid " +
+                           "THEN genome_tree_remove_xml_element(XMLSERIALIZE(DOCUMENT genomes.metadata AS text), " +
+                                                               "'{data,internal,date_added}') " +
+                           "ELSE XMLSERIALIZE(DOCUMENT genomes.metadata AS text) END, " +
+                      "'{data,internal,taxonomy}'), " +
+                  "'{data,internal,greengenes,dereplicated,best_blast,greengenes_tax}')) " +
+      "FROM (SELECT id, taxonomy, greengenes_tax, date_added, " +
+                   "coalesce(date_added ~ '^\\s*[0-9]{1,12}(\\.[0-9]+)?\\s*$', false) AS date_valid " +
+            "FROM (SELECT id, " +
+                         "(xpath('/data/internal/taxonomy/text()', metadata))[1]::text AS taxonomy, " +
+                         "(xpath('/data/internal/greengenes/dereplicated/best_blast/greengenes_tax/text()', metadata))[1]::text AS greengenes_tax, " +
+                         "(xpath('/data/internal/date_added/text()', metadata))[1]::text AS date_added " +
+                  "FROM genomes " +
+                  "WHERE xpath_exists('/data/internal/taxonomy', metadata) " +
+                  "OR xpath_exists('/data/internal/greengenes/dereplicated/best_blast/greengenes_tax', metadata) " +
+                  "OR xpath_exists('/data/internal/date_added', metadata)) AS fields) AS promoted " +
+      "WHERE genomes.id = promoted.id",
+      "DROP FUNCTION genome_tree_remove_xml_element(text, text[])",
+      "CREATE INDEX genomes_taxonomy_idx ON genomes (taxonomy text_pattern_ops)",
+      "CREATE INDEX genomes_date_added_idx ON genomes (date_added)"]),
+
+    # Metadata fields without a column of their own which are set through
+    # ImportMetadata, keyed by their XML path. PostgreSQL cannot modify XML
+    # documents in place, so these are kept in a JSONB document which can be
+    # merged on the server.
+    ("0003_genomes_extra_metadata",
+     ["ALTER TABLE genomes ADD COLUMN extra_metadata jsonb NOT NULL DEFAULT '{}'",
+      "CREATE INDEX genomes_extra_metadata_idx ON genomes USING gin (extra_metadata)"]),
+
+    # Substring (ILIKE '%...%') searches on genome names and descriptions.
+    # Creating the extension needs a database superuser.
+    ("0004_genomes_trigram_search_indexes",
+     ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+      "CREATE INDEX genomes_name_trgm_idx ON genomes USING gin (name gin_trgm_ops)",
+      "CREATE INDEX genomes_description_trgm_idx ON genomes USING gin (description gin_trgm_ops)",
+      "CREATE INDEX genomes_tree_id_idx ON genomes (tree_id)"]),
+
+    # Genome list listings: member counts per list, lists by owner, public
+    # lists and substring searches on list names. Needs 0004 for pg_trgm.
+    ("0005_genome_lists_listing_indexes",
+     ["CREATE INDEX genome_list_contents_list_id_idx ON genome_list_contents (list_id, genome_id)",
+      "CREATE INDEX genome_lists_owner_id_idx ON genome_lists (owner_id, id)",
+      "CREATE INDEX genome_lists_public_idx ON genome_lists (id) WHERE private = False",
+      "CREATE INDEX genome_lists_name_trgm_idx ON genome_lists USING gin (name gin_trgm_ops)"]),
+
+    # Notifications of changes to the tables behind the query service's
+    # cached responses (see genome_tree_service.py), with the name of the
+    # changed table as the payload.
+    ("0006_change_notifications",
+     ["CREATE OR REPLACE FUNCTION notify_genome_tree_change() RETURNS trigger AS $$ " +
+      "BEGIN " +
+          "PERFORM pg_notify('genome_tree_changes', TG_TABLE_NAME); " +
+          "RETURN NULL; " +
+      "END; " +
+      "$$ LANGUAGE plpgsql"] +
+     ["CREATE TRIGGER %s_notify_change " % (table,) +
+      "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s " % (table,) +
+      "FOR EACH STATEMENT EXECUTE PROCEDURE notify_genome_tree_change()"
+      for table in ('genomes', 'genome_lists', 'genome_list_contents', 'users')]),
+
+    # Stage metrics of the marker pipelines, stored by the
+    # --store-pipeline-metrics option (see pipeline_metrics.py).
+    ("0007_pipeline_metrics",
+     ["CREATE TABLE pipeline_metrics (" +
+          "id serial PRIMARY KEY, " +
+          "recorded timestamp with time zone NOT NULL, " +
+          "host text NOT NULL, " +
+          "genome_id integer, " +
+          "pipeline text NOT NULL, " +
+          "marker_database text NOT NULL, " +
+          "version text NOT NULL, " +
+          "stage text NOT NULL, " +
+          "wall_seconds double precision NOT NULL, " +
+          "cpu_seconds double precision NOT NULL, " +
+          "child_cpu_seconds double precision NOT NULL, " +
+          "subprocesses integer NOT NULL, " +
+          "bytes_read bigint NOT NULL, " +
+          "bytes_written bigint NOT NULL, " +
+          "peak_rss_kb bigint NOT NULL, " +
+          "child_peak_rss_kb bigint NOT NULL)",
+      "CREATE INDEX pipeline_metrics_genome_id_idx ON pipeline_metrics (genome_id)",
+      "CREATE INDEX pipeline_metrics_recorded_idx ON pipeline_metrics (recorded)"]),
+
+    # The peak RSS is now measured per stage, and is unknown where it can't
+    # be (see pipeline_metrics.py). Earlier rows hold process lifetime peaks.
+    ("0008_pipeline_metrics_stage_peak_rss",
+     ["ALTER TABLE pipeline_metrics " +
+      "ALTER COLUMN peak_rss_kb DROP NOT NULL, " +
+      "ALTER COLUMN child_peak_rss_kb DROP NOT NULL"]),
+]
@@ -0,0 +1,38 @@
+"""
+Registry of the hot backend queries which are prepared on the server once per
+connection and then executed by name (see GenomeDatabase.ExecutePrepared).
+Parameters are written as $1, $2, ... and their types are inferred by the
+server when the statement is prepared.
+"""
+
+STATEMENTS = {
+    'genome_id_from_tree_id' :
+        "SELECT id FROM genomes WHERE tree_id = $1",
+
+    'genome_id_from_source_id' :
+        "SELECT id FROM genomes WHERE id_at_source = $1 AND genome_source_id = $2",
+
+    'genome_exists' :
+        "SELECT id FROM genomes WHERE id = $1",
+
+    'genome_info' :
+        "SELECT tree_id, name, description, owner_id FROM genomes WHERE id = $1",
+
+    'user_id_from_username' :
+        "SELECT id FROM users WHERE username = $1",
+
+    'marker_id' :
+        "SELECT markers.id " +
+        "FROM markers, databases " +
+        "WHERE database_specific_id = $1 " +
+        "AND database_id = databases.id " +
+        "AND databases.name = $2 " +
+        "AND markers.version = $3",
+
+    'delete_aligned_marker' :
+        "DELETE FROM aligned_markers WHERE genome_id = $1 AND marker_id = $2",
+
+    'insert_aligned_marker' :
+        "INSERT INTO aligned_markers (genome_id, marker_id, dna, sequence) " +
+        "VALUES ($1, $2, False, $3)",
+}
@@ -0,0 +1,176 @@
+"""
+Cooperative flavour of the read paths of GenomeDatabase, for serving many
+concurrent clients from one process without a thread per request.
+
+This is built on gevent: psycopg2 is made cooperative with psycogreen, so
+while one request waits on the database the others run. Each request runs in
+its own greenlet with its own pooled connection. Calls return a greenlet
+(call .get() for the result, which raises AsyncQueryError on failure) and
+the Iter* calls return iterators which are fed by a greenlet as the rows or
+chunks arrive.
+
+gevent_patch.PatchForGevent() must be called at the very start of the
+program, before anything else (including this module) is imported.
+"""
+
+import gevent
+from gevent import monkey
+from gevent.lock import BoundedSemaphore
+from gevent.queue import Queue, Empty
+
+import genome_tree_backend as backend
+
+# Number of rows or chunks buffered between a streaming greenlet and its
+# consumer.
+STREAM_QUEUE_SIZE = 64
+
+class AsyncQueryError(Exception):
+    pass
+
+class _StreamFailure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+_END_OF_STREAM = object()
+
+class AsyncGenomeDatabase(object):
+    def __init__(self, dsn=None, max_connections=backend.DEFAULT_MAX_CONNECTIONS):
+        if not monkey.is_module_patched('threading'):
+            raise RuntimeError("gevent_patch.PatchForGevent() must be called first")
+        self.db = backend.GenomeDatabase(dsn, max_connections)
+        # Requests beyond the size of the pool wait for a connection
+        self.slots = BoundedSemaphore(max_connections)
+
+#-------- Database Connection Management
+
+    def MakePostgresConnection(self, port=None):
+        self.db.MakePostgresConnection(port)
+
+    def ClosePostgresConnection(self):
+        self.db.ClosePostgresConnection()
+
+    def UserLogin(self, username, password):
+        return self._Call('UserLogin', username, password)
+
+#-------- Greenlet Management
+
+    def _Spawn(self, func, *args, **kwargs):
+        """
+        Runs func in a new greenlet once a connection is available, returning
+        the connection to the pool when it is done.
+        """
+        def Run():
+            with self.slots:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.db.ReleaseConnection()
+        return gevent.spawn(Run)
+
+    def _Call(self, method_name, *args, **kwargs):
+        """
+        Runs a GenomeDatabase method in a new greenlet. A None result is
+        turned into an AsyncQueryError with the error reported by the backend.
+        """
+        def Run():
+            result = getattr(self.db, method_name)(*args, **kwargs)
+            if result is None:
+                raise AsyncQueryError(self.db.lastErrorMessage)
+            return result
+        return self._Spawn(Run)
+
+    def _Stream(self, method_name, *args, **kwargs):
+        """
+        Iterates over the generator returned by a GenomeDatabase method in a
+        new greenlet, handing the items to the caller through a bounded queue.
+        Stopping the iteration early stops the greenlet, which closes the
+        generator and returns its connection to the pool.
+        """
+        queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+
+        def Produce():
+            # GreenletExit (the consumer stopped) is not an Exception, so it
+            # goes straight through without waiting on the queue.
+            items = None
+            try:
+                items = getattr(self.db, method_name)(*args, **kwargs)
+                if items is None:
+                    raise AsyncQueryError(self.db.lastErrorMessage)
+                for item in items:
+                    queue.put(item)
+            except Exception as e:
+                queue.put(_StreamFailure(e))
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+            queue.put(_END_OF_STREAM)
+
+        producer = self._Spawn(Produce)
+
+        def Consume():
+            try:
+                while True:
+                    item = queue.get()
+                    if item is _END_OF_STREAM:
+                        break
+                    if isinstance(item, _StreamFailure):
+                        raise item.exception
+                    yield item
+            finally:
+                # Don't wait for the producer, it may be blocked on the full
+                # queue; free the queue so it can't block again.
+                producer.kill(block=False)
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+
+        return Consume()
+
+#-------- Genome Searching
+
+    def SearchGenomes(self, *args, **kwargs):
+        """
+        Takes the arguments of GenomeDatabase.SearchGenomes. The greenlet's
+        value is the list of result rows.
+        """
+        def Run():
+            rows = self.db.SearchGenomes(*args, **kwargs)
+            if rows is None:
+                raise AsyncQueryError(self.db.lastErrorMessage)
+            return list(rows)
+        return self._Spawn(Run)
+
+    def IterSearchGenomes(self, *args, **kwargs):
+        return self._Stream('SearchGenomes', *args, **kwargs)
+
+    def GetGenomeInfo(self, genome_id):
+        return self._Call('GetGenomeInfo', genome_id)
+
+#-------- Genome List Resolution
+
+    def GetGenomeIds(self, ids, source_id=None):
+        return self._Call('GetGenomeIds', ids, source_id)
+
+    def GetGenomeIdListFromGenomeListIds(self, genome_list_ids):
+        return self._Call('GetGenomeIdListFromGenomeListIds', genome_list_ids)
+
+    def IterGenomeLists(self, *args, **kwargs):
+        return self._Stream('GetGenomeLists', *args, **kwargs)
+
+#-------- Fasta File Export
+
+    def IterGenomicFasta(self, genome_id, chunk_size=backend.FASTA_CHUNK_SIZE):
+        return self._Stream('IterGenomicFasta', genome_id, chunk_size)
+
+#-------- Genome Treeing
+
+    def MakeTreeData(self, core_lists, list_of_genome_ids, profile, directory, prefix=None, **kwargs):
+        """
+        Takes the arguments of GenomeDatabase.MakeTreeData. Only the database
+        reads and file writes are cooperative, the alignment processing runs
+        in between them.
+        """
+        return self._Call('MakeTreeData', core_lists, list_of_genome_ids, profile,
+                          directory, prefix, **kwargs)
@@ -6,23 +6,23 @@ import tempfile
 import time
 import random
 import string
-import xml.etree.ElementTree as et
-import xml_funcs
-from xml.sax.saxutils import escape
+import threading
 
 import shutil
+from contextlib import contextmanager
 # Import extension modules
 import psycopg2 as pg
-import bcrypt
+import psycopg2.pool
 
-from simplehmmer.simplehmmer import HMMERRunner, HMMERParser
-from simplehmmer.hmmmodelparser import HmmModelParser
-from metachecka2000.dataConstructor import HMMERError, Mc2kHmmerDataConstructor as DataConstructor
-from metachecka2000.resultsParser import HMMAligner
-from metachecka2000.resultsParser import Mc2kHmmerResultsParser as QaParser
+# bcrypt, simplehmmer and metachecka2000 are imported by the methods which
+# use them, so that the quick lookups don't pay for loading them.
 
 # Import Genome Tree Database modules
 import profiles
+import db_migrations
+import db_statements
+import pipeline_metrics
+from seq_funcs import readfq, WriteSegmentedFasta, ReadMaskedAlignment
 
 # Import Genome Tree Database markers
 import markers as markers_module
@@ -30,6 +30,33 @@ import markers as markers_module
 # Need to remember the markers path
 markers_module_path = os.path.abspath(os.path.dirname(markers_module.__file__))
 
+# Connection settings, used unless a DSN is passed to GenomeDatabase or set
+# in the GENOME_TREE_DSN environment variable.
+DEFAULT_DSN = "dbname=genome_tree user=uqaskars host=/tmp/"
+DEFAULT_MAX_CONNECTIONS = 8
+
+# A connection which passed the liveness check is trusted for this long
+# before being checked again.
+LIVENESS_CACHE_SECONDS = 5.0
+
+# Connecting is retried with exponential backoff (e.g. while the server
+# restarts), starting at the initial delay and doubling after each attempt.
+RECONNECT_ATTEMPTS = 6
+RECONNECT_INITIAL_DELAY = 0.25
+
+# Genomic FASTA files are streamed out of the database in chunks of this size
+FASTA_CHUNK_SIZE = 1 << 20
+
+# Metadata fields which have been moved out of the XML metadata into columns
+# of the genomes table (see db_migrations.py), keyed by their XML path.
+PROMOTED_METADATA_FIELDS = {'internal/core_list' : 'core_list',
+                            'internal/taxonomy' : 'taxonomy',
+                            'internal/greengenes/dereplicated/best_blast/greengenes_tax' : 'greengenes_tax',
+                            'internal/date_added' : 'date_added'}
+
+# Any other metadata field is an element path below the XML document root
+metadata_path_regex = re.compile(r'^[A-Za-z_][\w.-]*(/[A-Za-z_][\w.-]*)*$')
+
 #---- User Class
 
 class User(object):
@@ -47,43 +74,335 @@ class User(object):
     def getTypeId(self):
         return self.typeId
 
+#--- Database Connection Class
+
+class PreparingConnection(pg.extensions.connection):
+    """
+    Connection which remembers the db_statements statements prepared on it
+    (see GenomeDatabase.ExecutePrepared).
+    """
+    def __init__(self, *args, **kwargs):
+        pg.extensions.connection.__init__(self, *args, **kwargs)
+        self.prepared = set()
+        self.profiler = None
+
 #--- Main Genome Database Object
 
 class GenomeDatabase(object):
-    def __init__(self):
-        self.conn = None
-        self.currentUser = None
+    def __init__(self, dsn=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.dsn = dsn
+        self.maxConnections = max_connections
+        self.pool = None
+        self.threadConnections = threading.local()
+        self.threadErrors = threading.local()
+        self.threadUsers = threading.local()
+        self.connString = None
+        self.sqlProfiler = None
+        self.pipelineMetricsFile = None
+        self.storePipelineMetrics = False
+        self.loggedInUser = None
         self.lastErrorMessage = None
 
 #-------- General Functions
     
+    @property
+    def lastErrorMessage(self):
+        """
+        The last error reported on the calling thread, so that threads
+        sharing this object don't see each other's errors.
+        """
+        return getattr(self.threadErrors, 'message', None)
+    
+    @lastErrorMessage.setter
+    def lastErrorMessage(self, msg):
+        self.threadErrors.message = msg
+    
     def ReportError(self, msg):
         self.lastErrorMessage = str(msg) + "\n"
+    
+    @property
+    def currentUser(self):
+        """
+        The user the calling thread works as: the user set by ActAs, if any,
+        otherwise the logged in user.
+        """
+        user = getattr(self.threadUsers, 'user', None)
+        if user is None:
+            user = self.loggedInUser
+        return user
+    
+    @currentUser.setter
+    def currentUser(self, user):
+        self.loggedInUser = user
+    
+    @contextmanager
+    def ActAs(self, user):
+        """
+        Context manager making the calling thread work as the specified user
+        (e.g. a client of the query service) instead of the logged in user.
+        """
+        previous = getattr(self.threadUsers, 'user', None)
+        self.threadUsers.user = user
+        try:
+            yield
+        finally:
+            self.threadUsers.user = previous
         
 #-------- Database Connection Management
 
     def MakePostgresConnection(self, port=None):
-        conn_string = "dbname=genome_tree user=uqaskars host=/tmp/"
+        """
+        Creates the connection pool. Each thread using this object checks out
+        its own connection from the pool on first use (see conn), so up to
+        maxConnections threads can use the database at once.
+        """
+        conn_string = self.dsn
+        if conn_string is None:
+            conn_string = os.environ.get('GENOME_TREE_DSN', DEFAULT_DSN)
         if port is not None:
             conn_string += " port=" + str(port)
-        self.conn = pg.connect(conn_string)
+        self.connString = conn_string
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.maxConnections, conn_string,
+                                                         connection_factory=PreparingConnection)
         
     def ClosePostgresConnection(self):
-        self.conn.close()
-        self.conn = None
+        self.pool.closeall()
+        self.pool = None
+        self.threadConnections = threading.local()
     
-    def IsPostgresConnectionActive(self):
-        if self.conn is not None:
-            cur = self.conn.cursor()
+    @property
+    def conn(self):
+        """
+        The connection of the calling thread, checked out of the pool on first
+        use. An idle connection not known to be alive for the last
+        LIVENESS_CACHE_SECONDS is checked with a trivial query first, and if
+        it has been lost (e.g. the server restarted) it is replaced, as are
+        stale connections handed out by the pool. None if there is no
+        connection pool.
+        """
+        conn = getattr(self.threadConnections, 'conn', None)
+        if conn is not None and not conn.closed:
+            if (conn.get_transaction_status() != pg.extensions.TRANSACTION_STATUS_IDLE
+                    or self.RecentlyAlive()):
+                return conn
+            if self.CheckConnection(conn):
+                return conn
+        if conn is not None:
+            self.DiscardConnection()
+        if self.pool is None:
+            return None
+        
+        # Every idle connection in the pool may be stale, after those the
+        # pool opens new ones
+        for attempt in range(self.maxConnections + 1):
+            conn = self.CheckoutConnection()
+            if self.CheckConnection(conn):
+                self.threadConnections.conn = conn
+                return conn
+            self.pool.putconn(conn, close=True)
+        raise pg.OperationalError("Unable to get a working database connection")
+    
+    def RecentlyAlive(self):
+        last_alive = getattr(self.threadConnections, 'lastAlive', None)
+        return last_alive is not None and time.time() - last_alive < LIVENESS_CACHE_SECONDS
+    
+    def CheckConnection(self, conn):
+        """
+        Runs a trivial query on an idle connection, leaving it idle. Returns
+        False if the connection is broken.
+        """
+        try:
+            cur = conn.cursor(cursor_factory=pg.extensions.cursor)
             try:
-                cur.execute("SELECT * from genomes")
-            except:
-                return False
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            conn.rollback()
+        except pg.Error:
+            return False
+        self.threadConnections.lastAlive = time.time()
+        return True
+    
+    def CheckoutConnection(self):
+        """
+        Gets a connection from the pool, retrying with exponential backoff
+        if the server cannot be reached.
+        """
+        delay = RECONNECT_INITIAL_DELAY
+        attempt = 1
+        while True:
+            try:
+                conn = self.pool.getconn()
+                break
+            except pg.OperationalError:
+                if attempt >= RECONNECT_ATTEMPTS:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+            attempt += 1
+        
+        if self.sqlProfiler is not None and conn.profiler is None:
+            conn.profiler = self.sqlProfiler
+            conn.cursor_factory = self.sqlProfiler.cursor_factory
+        return conn
+    
+    def EnableSqlProfiling(self):
+        """
+        Records the time, rows and statements of every query run from now on,
+        per GenomeDatabase method (see sql_profiler.py). Returns the
+        SqlProfiler holding the results.
+        """
+        import sql_profiler
+        self.sqlProfiler = sql_profiler.SqlProfiler(type(self))
+        return self.sqlProfiler
+    
+    def ReleaseConnection(self):
+        """
+        Returns the connection of the calling thread to the pool, rolling back
+        anything uncommitted. Worker threads should call this when they are
+        done with the database. A connection which can't be rolled back (e.g.
+        the server restarted) is closed and dropped from the pool instead.
+        """
+        conn = getattr(self.threadConnections, 'conn', None)
+        if conn is None:
+            return
+        self.threadConnections.conn = None
+        self.threadConnections.lastAlive = None
+        if self.pool is None:
+            return
+        close = bool(conn.closed)
+        if not close:
+            try:
+                conn.rollback()
+            except pg.Error:
+                close = True
+        self.pool.putconn(conn, close=close)
+    
+    def DiscardConnection(self):
+        """
+        Closes the connection of the calling thread and removes it from the
+        pool. The next use of conn checks out a fresh one.
+        """
+        conn = getattr(self.threadConnections, 'conn', None)
+        if conn is None:
+            return
+        self.threadConnections.conn = None
+        self.threadConnections.lastAlive = None
+        if self.pool is None:
+            return
+        try:
+            self.pool.putconn(conn, close=True)
+        except pg.Error:
+            pass
+    
+    @contextmanager
+    def Cursor(self, name=None):
+        """
+        Context manager yielding a cursor on the connection of the calling
+        thread, which is closed on exit. Pass a name for a server side cursor.
+        
+        Cursors are for reading. When the outermost Cursor or Transaction of
+        the thread exits, the transaction the reads started is ended, so that
+        connections aren't left idle in transaction holding their snapshot.
+        """
+        conn = self.conn
+        cur = conn.cursor(name)
+        # Open Cursors and Transactions of the thread, which may be
+        # interleaved (e.g. by row generators), so it is a count
+        self.threadConnections.depth = getattr(self.threadConnections, 'depth', 0) + 1
+        try:
+            yield cur
+        finally:
+            self.threadConnections.depth -= 1
+            try:
+                cur.close()
+                if (self.threadConnections.depth == 0 and not conn.closed and
+                        conn.get_transaction_status() != pg.extensions.TRANSACTION_STATUS_IDLE):
+                    conn.rollback()
+            except pg.Error:
+                # A broken connection is replaced on its next use (see conn)
+                pass
+    
+    @contextmanager
+    def Transaction(self):
+        """
+        Context manager yielding a cursor whose work is committed on exit, or
+        rolled back if an exception is raised.
+        """
+        conn = self.conn
+        cur = conn.cursor()
+        self.threadConnections.depth = getattr(self.threadConnections, 'depth', 0) + 1
+        try:
+            yield cur
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self.threadConnections.depth -= 1
             cur.close()
-            return True
-        else:
+    
+    def ExecutePrepared(self, cur, name, params):
+        """
+        Executes the db_statements statement called name with the cursor,
+        preparing it on the cursor's connection the first time it is used
+        there. The server then only parses and plans it once per connection.
+        """
+        conn = cur.connection
+        if name not in conn.prepared:
+            cur.execute("PREPARE " + name + " AS " + db_statements.STATEMENTS[name])
+            conn.prepared.add(name)
+        cur.execute("EXECUTE " + name + " (" + ", ".join(["%s"] * len(params)) + ")", params)
+    
+    def IsPostgresConnectionActive(self):
+        """
+        Checks the connection of the calling thread, replacing it if it has
+        been lost (see conn). A successful check is cached for
+        LIVENESS_CACHE_SECONDS.
+        """
+        if self.pool is None:
+            return False
+        try:
+            return self.conn is not None
+        except pg.Error:
             return False
 
+    def MigrateDatabase(self):
+        """
+        Applies the schema migrations in db_migrations.py which have not yet
+        been applied to the database, each in its own transaction. Returns
+        the list of names of the migrations applied, or None on failure.
+        """
+        if self.currentUser.getTypeId() != 0:
+            self.ReportError("Only root can do that.")
+            return None
+        
+        with self.Transaction() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (" +
+                            "name text PRIMARY KEY, " +
+                            "applied timestamp NOT NULL DEFAULT now())")
+        
+        with self.Cursor() as cur:
+            cur.execute("SELECT name FROM schema_migrations")
+            applied = set([name for (name,) in cur.fetchall()])
+        
+        newly_applied = []
+        for (name, statements) in db_migrations.MIGRATIONS:
+            if name in applied:
+                continue
+            try:
+                with self.Transaction() as cur:
+                    for statement in statements:
+                        cur.execute(statement)
+                    cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+            except pg.Error as e:
+                self.ReportError("Migration %s failed: %s" % (name, str(e).strip()))
+                return None
+            newly_applied.append(name)
+        
+        return newly_applied
+
 #-------- User Login Management
     
     def GenerateRandomPassword(self, length=8):
@@ -91,26 +410,37 @@ class GenomeDatabase(object):
         return ''.join(random.choice(chars) for x in range(8))
         
     def GenerateHashedPassword(self, password):
+        import bcrypt
         return bcrypt.hashpw(password, bcrypt.gensalt())
     
     def CheckPlainTextPassword(self, password, hashed_password):
+        import bcrypt
         return bcrypt.hashpw(password, hashed_password) == hashed_password
     
     def UserLogin(self, username, password):
+        user = self.AuthenticateUser(username, password)
+        if user is None:
+            return None
+        self.currentUser = user
+        return User
+    
+    def AuthenticateUser(self, username, password):
+        """
+        Returns the User with the specified username and password, or None
+        if they don't match, without logging in as that user.
+        """
         if not self.IsPostgresConnectionActive():
             self.ReportError("Unable to establish database connection")
             return None
    
-        cur = self.conn.cursor()
-        query = "SELECT id, password, type_id FROM users WHERE username = %s"
-        cur.execute(query, [username])
-        result = cur.fetchone()
-        cur.close()
+        with self.Cursor() as cur:
+            query = "SELECT id, password, type_id FROM users WHERE username = %s"
+            cur.execute(query, [username])
+            result = cur.fetchone()
         if result:
             (userid, hashed, type_id) = result
             if self.CheckPlainTextPassword(password, hashed):
-                self.currentUser = User(result[0], username, result[2])
-                return User
+                return User(userid, username, type_id)
             else:
                 self.ReportError("Incorrect password")
         else:
@@ -123,9 +453,9 @@ class GenomeDatabase(object):
         """
         Checks if the current user has higher privileges that the specified user_id.
         """
-        cur = self.conn.cursor()
-        cur.execute("SELECT type_id FROM users WHERE id = %s", (user_id,))
-        result = cur.fetchone()
+        with self.Cursor() as cur:
+            cur.execute("SELECT type_id FROM users WHERE id = %s", (user_id,))
+            result = cur.fetchone()
         
         if not result:
             self.ReportError("User not found.")
@@ -138,9 +468,9 @@ class GenomeDatabase(object):
             return False
     
     def GetUserIdFromUsername(self, username):
-        cur = self.conn.cursor()
-        cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-        result = cur.fetchone()
+        with self.Cursor() as cur:
+            self.ExecutePrepared(cur, 'user_id_from_username', (username,))
+            result = cur.fetchone()
         
         if not result:
             self.ReportError("Username not found.")
@@ -164,12 +494,11 @@ class GenomeDatabase(object):
             self.ReportError("Cannot create a user with same or higher level privileges")
             return False
         
-        cur = self.conn.cursor()
-        cur.execute("INSERT into users (username, password, type_id) " +
-                    "VALUES (%s, %s, %s) ", (username,
-                                             self.GenerateHashedPassword(password),
-                                             userTypeId))
-        self.conn.commit()
+        with self.Transaction() as cur:
+            cur.execute("INSERT into users (username, password, type_id) " +
+                        "VALUES (%s, %s, %s) ", (username,
+                                                 self.GenerateHashedPassword(password),
+                                                 userTypeId))
         
         return True
     
@@ -196,115 +525,181 @@ class GenomeDatabase(object):
             self.ReportError("You cannot modify your own privileges.")
             return False
         
-        cur = self.conn.cursor()
-        query = "SELECT id FROM users WHERE id = %s"
-        cur.execute(query, [user_id])
+        if password is not None and not password:
+            self.ReportError("You must specify a non-blank password.")
+            return False
         
-        result = cur.fetchone()
+        with self.Transaction() as cur:
+            query = "SELECT id FROM users WHERE id = %s"
+            cur.execute(query, [user_id])
+            
+            result = cur.fetchone()
 
-        if not result:
-            self.ReportError("Unable to find user id: " + user_id)
-            return False            
-        
-        if password is not None:
-            if not password:
-                self.ReportError("You must specify a non-blank password.")
-                return False
-            else:
+            if not result:
+                self.ReportError("Unable to find user id: " + str(user_id))
+                return False            
+            
+            if password is not None:
                 cur.execute("UPDATE users SET password = %s WHERE id = %s", 
                     (self.GenerateHashedPassword(password), user_id))
+            
+            if userTypeId is not None:
+                cur.execute("UPDATE users SET type_id = %s WHERE id = %s", 
+                        (userTypeId,  user_id))
         
-        if userTypeId is not None:
-            cur.execute("UPDATE users SET type_id = %s WHERE id = %s", 
-                    (userTypeId,  user_id))
-        
-        self.conn.commit()
         return True
     
 #-------- Genome List Management
     
     def CreateGenomeList(self, genome_list, name, description, owner_id, private):
         
-        cur = self.conn.cursor()
-        
-        query = "INSERT INTO genome_lists (name, description, owner_id, private) VALUES (%s, %s, %s, %s) RETURNING id"
-        cur.execute(query, (name, description, owner_id, private))
-        (genome_list_id, ) = cur.fetchone()
-        
-        query = "INSERT INTO genome_list_contents (list_id, genome_id) VALUES (%s, %s)"
-        cur.executemany(query, [(genome_list_id, x) for x in genome_list])
-        
-        self.conn.commit()
+        with self.Transaction() as cur:
+            query = "INSERT INTO genome_lists (name, description, owner_id, private) VALUES (%s, %s, %s, %s) RETURNING id"
+            cur.execute(query, (name, description, owner_id, private))
+            (genome_list_id, ) = cur.fetchone()
+            
+            # All members in one statement, passing the ids as an array parameter
+            query = ("INSERT INTO genome_list_contents (list_id, genome_id) " +
+                     "SELECT DISTINCT %s, genome_id " +
+                     "FROM unnest(%s::integer[]) AS genome_id")
+            cur.execute(query, (genome_list_id, list(genome_list)))
         
         return genome_list_id
     
     def CloneGenomeList(self, genome_list_id, name, description, owner_id, private):
         
-        cur = self.conn.cursor()
-        
-        query = "SELECT genome_id FROM genome_list_contents WHERE genome_list_id = %s"
-        cur.execute(query, (genome_list_id,))
-        genome_id_list = [x[0] for x in cur.fetchall()]
+        with self.Cursor() as cur:
+            query = "SELECT genome_id FROM genome_list_contents WHERE genome_list_id = %s"
+            cur.execute(query, (genome_list_id,))
+            genome_id_list = [x[0] for x in cur.fetchall()]
         
         return self.CreateGenomeList(genome_id_list, name, description, owner_id, private)
     
+    def CombineGenomeLists(self, operation, genome_list_ids, name, description, owner_id, private):
+        """
+        Creates a new genome list from the 'union', 'intersection' or
+        'difference' (the first list minus all of the others) of the specified
+        genome lists. The members are computed and stored by a single
+        statement on the server. All of the lists must be visible to the
+        current user. Returns a (new genome list id, member count) tuple, or
+        None on failure.
+        """
+        if operation not in ('union', 'intersection', 'difference'):
+            self.ReportError("Operation needs to be one of: union, intersection, difference.")
+            return None
+        
+        try:
+            genome_list_ids = [int(x) for x in genome_list_ids]
+        except ValueError:
+            self.ReportError("Invalid genome list id in: %s" % (", ".join([str(x) for x in genome_list_ids]),))
+            return None
+        if len(genome_list_ids) == 0 or (operation == 'difference' and len(genome_list_ids) < 2):
+            self.ReportError("Not enough genome lists specified for the %s." % (operation,))
+            return None
+        
+        with self.Transaction() as cur:
+            cur.execute("SELECT list.id " +
+                        "FROM genome_lists as list, users " +
+                        "WHERE list.owner_id = users.id " +
+                        "AND list.id = ANY(%s) " +
+                        "AND (list.private = False " +
+                             "OR users.type_id > %s " +
+                             "OR list.owner_id = %s) ", (genome_list_ids,
+                                                         self.currentUser.getTypeId(),
+                                                         self.currentUser.getUserId()))
+            visible_ids = set([list_id for (list_id,) in cur.fetchall()])
+            missing_ids = [str(x) for x in genome_list_ids if x not in visible_ids]
+            if len(missing_ids) > 0:
+                self.ReportError("Cant find specified Genome List Id(s): " + ", ".join(missing_ids))
+                return None
+        
+            if operation == 'union':
+                members_query = ("SELECT DISTINCT genome_id " +
+                                 "FROM genome_list_contents " +
+                                 "WHERE list_id = ANY(%s)")
+                members_params = [genome_list_ids]
+            elif operation == 'intersection':
+                members_query = ("SELECT genome_id " +
+                                 "FROM genome_list_contents " +
+                                 "WHERE list_id = ANY(%s) " +
+                                 "GROUP BY genome_id " +
+                                 "HAVING count(DISTINCT list_id) = %s")
+                members_params = [genome_list_ids, len(set(genome_list_ids))]
+            else:
+                members_query = ("SELECT genome_id " +
+                                 "FROM genome_list_contents " +
+                                 "WHERE list_id = %s " +
+                                 "EXCEPT " +
+                                 "SELECT genome_id " +
+                                 "FROM genome_list_contents " +
+                                 "WHERE list_id = ANY(%s)")
+                members_params = [genome_list_ids[0], genome_list_ids[1:]]
+        
+            cur.execute("WITH new_list AS ( " +
+                            "INSERT INTO genome_lists (name, description, owner_id, private) " +
+                            "VALUES (%s, %s, %s, %s) " +
+                            "RETURNING id), " +
+                        "inserted AS ( " +
+                            "INSERT INTO genome_list_contents (list_id, genome_id) " +
+                            "SELECT new_list.id, members.genome_id " +
+                            "FROM new_list, (" + members_query + ") AS members " +
+                            "RETURNING genome_id) " +
+                        "SELECT (SELECT id FROM new_list), (SELECT count(*) FROM inserted)",
+                        [name, description, owner_id, private] + members_params)
+            result = cur.fetchone()
+        
+        return result
     
     def ModifyGenomeList(self, genome_list_id, name=None, description=None, genome_ids=None,
                          operation=None, public=None):
         
-        cur = self.conn.cursor()
-        
-        query = "SELECT owner_id FROM genome_lists WHERE id = %s";
-        cur.execute(query, (genome_list_id,))
-        result = cur.fetchone()
-        if not result:
-            self.ReportError("Cant find specified Genome List Id: " + str(genome_list_id))
-            return False
+        with self.Transaction() as cur:
+            query = "SELECT owner_id FROM genome_lists WHERE id = %s";
+            cur.execute(query, (genome_list_id,))
+            result = cur.fetchone()
+            if not result:
+                self.ReportError("Cant find specified Genome List Id: " + str(genome_list_id))
+                return False
         
-        (owner_id, ) = result
+            (owner_id, ) = result
         
-        # Need to check permissions to edit this list.
-        if not(self.CheckForCurrentUserHigherPrivileges(owner_id) or owner_id == self.currentUser.getUserId()):
-            self.ReportError("Insufficient privileges to edit this list")
-            return False
+            # Need to check permissions to edit this list.
+            if not(self.CheckForCurrentUserHigherPrivileges(owner_id) or owner_id == self.currentUser.getUserId()):
+                self.ReportError("Insufficient privileges to edit this list")
+                return False
         
         
-        if name is not None:
-            query = "UPDATE genome_lists SET name = %s WHERE id = %s";
-            cur.execute(query, (name, genome_list_id))
+            if name is not None:
+                query = "UPDATE genome_lists SET name = %s WHERE id = %s";
+                cur.execute(query, (name, genome_list_id))
             
-        if description is not None:
-            query = "UPDATE genome_lists SET description = %s WHERE id = %s";
-            cur.execute(query, (description, genome_list_id))
+            if description is not None:
+                query = "UPDATE genome_lists SET description = %s WHERE id = %s";
+                cur.execute(query, (description, genome_list_id))
             
-        if public is not None:
-            query = "UPDATE genome_lists SET private = %s WHERE id = %s";
-            cur.execute(query, (not(public), genome_list_id))
+            if public is not None:
+                query = "UPDATE genome_lists SET private = %s WHERE id = %s";
+                cur.execute(query, (not(public), genome_list_id))
             
-        temp_table_name = "TEMP" + str(int(time.time()))
+            if genome_ids:
+                # The ids are passed as a single array parameter and applied as
+                # one set operation.
+                if operation == 'add':
+                    query = ("INSERT INTO genome_list_contents (list_id, genome_id) " +
+                             "SELECT DISTINCT %s, new_ids.genome_id " +
+                             "FROM unnest(%s::integer[]) AS new_ids (genome_id) " +
+                             "WHERE NOT EXISTS ( " +
+                                "SELECT 1 " +
+                                "FROM genome_list_contents " +
+                                "WHERE list_id = %s " +
+                                "AND genome_list_contents.genome_id = new_ids.genome_id)")
+                    cur.execute(query, (genome_list_id, list(genome_ids), genome_list_id))
+                elif operation == 'remove':
+                    query = ("DELETE FROM genome_list_contents " + 
+                            "WHERE list_id = %s " + 
+                            "AND genome_id = ANY(%s::integer[])")
+                    cur.execute(query, (genome_list_id, list(genome_ids)))
         
-        if genome_ids:
-            cur.execute("CREATE TEMP TABLE %s (id integer)" % (temp_table_name,) )
-            query = "INSERT INTO {0} (id) VALUES (%s)".format(temp_table_name)
-            cur.executemany(query, [(x,) for x in genome_ids])
-            
-            if operation == 'add':
-                query = ("INSERT INTO genome_list_contents (list_id, genome_id) " +
-                         "SELECT %s, id FROM {0} " +
-                         "WHERE id NOT IN ( " +
-                            "SELECT genome_id " +
-                            "FROM genome_list_contents " +
-                            "WHERE list_id = %s)").format(temp_table_name)
-                cur.execute(query, (genome_list_id, genome_list_id))
-            elif operation == 'remove':
-                query = ("DELETE FROM genome_list_contents " + 
-                        "WHERE list_id = %s " + 
-                        "AND genome_id IN ( " +  
-                            "SELECT id " +
-                            "FROM {0})").format(temp_table_name)
-                cur.execute(query, [genome_list_id])
-        
-        self.conn.commit()
         return True
     
     def DeleteGenomeList(self, genome_list_id, execute):
@@ -314,31 +709,28 @@ class GenomeDatabase(object):
             check if it can be done. This allows the prompting of the user for confirmation to
             be handled outside the backend and thus is implementation agnostic.
         """
-        cur = self.conn.cursor()
-        
-        query = "SELECT owner_id FROM genome_lists WHERE id = %s"
-        cur.execute(query, (genome_list_id,))
-        result = cur.fetchone()
-        if not result:
-            self.ReportError("Cant find specified Genome List Id: " + str(genome_list_id) + "\n")
-            return False
+        with self.Transaction() as cur:
+            query = "SELECT owner_id FROM genome_lists WHERE id = %s"
+            cur.execute(query, (genome_list_id,))
+            result = cur.fetchone()
+            if not result:
+                self.ReportError("Cant find specified Genome List Id: " + str(genome_list_id) + "\n")
+                return False
         
-        (owner_id,) = result
-        # Check that we have permission to delete this list.
-        if (not self.CheckForCurrentUserHigherPrivileges(owner_id)) and (not (owner_id == self.currentUser.getUserId())):
-            self.ReportError("Insufficient privileges to delete this list: " + str(genome_list_id) + "\n")
-            return False
+            (owner_id,) = result
+            # Check that we have permission to delete this list.
+            if (not self.CheckForCurrentUserHigherPrivileges(owner_id)) and (not (owner_id == self.currentUser.getUserId())):
+                self.ReportError("Insufficient privileges to delete this list: " + str(genome_list_id) + "\n")
+                return False
         
-        if not execute:
-            return True
+            if not execute:
+                return True
             
-        query = "DELETE FROM genome_list_contents WHERE list_id = %s"
-        cur.execute(query, (genome_list_id,))
-        
-        query = "DELETE FROM genome_lists WHERE id = %s"
-        cur.execute(query, (genome_list_id,))
+            query = "DELETE FROM genome_list_contents WHERE list_id = %s"
+            cur.execute(query, (genome_list_id,))
         
-        self.conn.commit()
+            query = "DELETE FROM genome_lists WHERE id = %s"
+            cur.execute(query, (genome_list_id,))
         
         return True
 
@@ -379,80 +771,140 @@ class GenomeDatabase(object):
 
     def GetGenomeIdListFromGenomeListId(self, genome_list_id):
         
-        cur = self.conn.cursor()
-        
-        cur.execute("SELECT id " +
-                    "FROM genome_lists " +
-                    "WHERE id = %s", (genome_list_id,))
+        with self.Cursor() as cur:
+            cur.execute("SELECT id " +
+                        "FROM genome_lists " +
+                        "WHERE id = %s", (genome_list_id,))
         
-        if not cur.fetchone():
-            self.ReportError("No genome list with id: " + str(genome_list_id))
-            return None
+            if not cur.fetchone():
+                self.ReportError("No genome list with id: " + str(genome_list_id))
+                return None
         
-        cur.execute("SELECT genome_id " +
-                    "FROM genome_list_contents " +
-                    "WHERE list_id = %s", (genome_list_id,))
+            cur.execute("SELECT genome_id " +
+                        "FROM genome_list_contents " +
+                        "WHERE list_id = %s", (genome_list_id,))
         
-        result = cur.fetchall()
+            result = cur.fetchall()
         
-        return [genome_id for (genome_id,) in result]
+            return [genome_id for (genome_id,) in result]
             
-    def GetGenomeLists(self, owner_id=None):
+    def GetGenomeIdListFromGenomeListIds(self, genome_list_ids):
         """
-        Get all genomes list owned by owner_id which the current user is allowed
-        to see. If owner_id is None, return all visible genome lists for the
-        current user.
+        Fetches the members of many genome lists in a single query. Returns a
+        (genome_ids, list_counts, missing_list_ids) tuple where genome_ids is
+        the deduplicated list of member genome ids, list_counts is a dict of
+        genome list id -> number of members and missing_list_ids is a list of
+        the requested genome list ids which do not exist. Returns None on
+        failure.
         """
-        cur = self.conn.cursor()
-
-        if owner_id is None:
-            cur.execute("SELECT list.id, list.name, list.description, username " +
-                        "FROM genome_lists as list, users " +
-                        "WHERE list.owner_id = users.id " +
-                        "AND (list.private = False " +
-                             "OR users.type_id > %s " +
-                             "OR list.owner_id = %s) " +
-                        "ORDER by list.id ", (self.currentUser.getTypeId(),
-                                              self.currentUser.getUserId()))
-        
-        else:
-            cur.execute("SELECT list.id, list.name, list.description, username " +
-            "FROM genome_lists as list, users " +
-            "WHERE list.owner_id = users.id " +
-            "AND list.owner_id = %s " +
-            "ORDER by list.id ", (self.currentUser.getUserId(),))
+        try:
+            genome_list_ids = [int(x) for x in genome_list_ids]
+        except ValueError:
+            self.ReportError("Invalid genome list id in: %s" % (", ".join([str(x) for x in genome_list_ids]),))
+            return None
         
-        return cur.fetchall()
+        # Rows with a list id describe a requested list, the other rows are
+        # the distinct members of all of the lists.
+        with self.Cursor() as cur:
+            cur.execute("WITH requested AS ( " +
+                            "SELECT DISTINCT unnest(%s::integer[]) AS list_id), " +
+                        "members AS ( " +
+                            "SELECT list_id, genome_id " +
+                            "FROM genome_list_contents " +
+                            "WHERE list_id IN (SELECT list_id FROM requested)) " +
+                        "SELECT requested.list_id, genome_lists.id IS NOT NULL, " +
+                               "(SELECT count(*) FROM members WHERE members.list_id = requested.list_id), NULL " +
+                        "FROM requested LEFT JOIN genome_lists ON genome_lists.id = requested.list_id " +
+                        "UNION ALL " +
+                        "SELECT NULL, NULL, NULL, genome_id " +
+                        "FROM (SELECT DISTINCT genome_id FROM members) AS distinct_members",
+                        (genome_list_ids,))
+        
+            genome_ids = list()
+            list_counts = dict()
+            missing_list_ids = list()
+            for (list_id, exists, count, genome_id) in cur:
+                if list_id is None:
+                    genome_ids.append(genome_id)
+                elif exists:
+                    list_counts[list_id] = count
+                else:
+                    missing_list_ids.append(list_id)
+        
+        return (genome_ids, list_counts, sorted(missing_list_ids))
+            
+    def GetGenomeLists(self, owner_id=None, name=None, limit=None, after=None):
+        """
+        Returns an iterator over (list_id, name, description, owner, member
+        count) tuples for the genome lists which the current user is allowed
+        to see, in list id order. If owner_id is specified, only the lists
+        owned by that user are returned. If name is specified, only the lists
+        whose name contains it (case insensitive) are returned.
+        
+        Rows are streamed from a server side cursor. For keyset pagination,
+        limit caps the number of rows and after only returns lists with an id
+        greater than it (i.e. pass the last list id of the previous page).
+        """
+        search_terms = ["(list.private = False " +
+                        "OR users.type_id > %s " +
+                        "OR list.owner_id = %s)"]
+        query_params = [self.currentUser.getTypeId(),
+                        self.currentUser.getUserId()]
+        if owner_id is not None:
+            search_terms.append("list.owner_id = %s")
+            query_params.append(owner_id)
+        if name is not None:
+            search_terms.append("list.name ILIKE %s")
+            query_params.append('%' + name + '%')
+        if after is not None:
+            search_terms.append("list.id > %s")
+            query_params.append(after)
+        
+        limit_query = ''
+        if limit is not None:
+            limit_query = ' LIMIT %s'
+            query_params.append(int(limit))
+        
+        # The member count is only computed for the rows returned, using the
+        # list_id index on genome_list_contents.
+        def IterRows():
+            with self.Cursor("genome_lists") as cur:
+                cur.itersize = 1000
+                cur.execute("SELECT list.id, list.name, list.description, username, " +
+                            "(SELECT count(*) FROM genome_list_contents AS contents " +
+                             "WHERE contents.list_id = list.id) " +
+                            "FROM genome_lists as list, users " +
+                            "WHERE list.owner_id = users.id " +
+                            "AND " + " AND ".join(search_terms) + " " +
+                            "ORDER by list.id" + limit_query, query_params)
+                for row in cur:
+                    yield row
+        
+        return IterRows()
 
 #-------- Genome Management
     
     def CheckGenomeExists(self, genome_id):
         
-        cur = self.conn.cursor()
-        
-        cur.execute("SELECT id " +
-            "FROM genomes " +
-            "WHERE id = %s ", [genome_id])
+        with self.Cursor() as cur:
+            self.ExecutePrepared(cur, 'genome_exists', (genome_id,))
         
-        if cur.fetchone():
-            return True
-        else:
-            return False
+            if cur.fetchone():
+                return True
+            else:
+                return False
 
     def GetGenomeInfo(self, genome_id):
         
-        cur = self.conn.cursor()
-        
-        cur.execute("SELECT tree_id, name, description, owner_id " +
-            "FROM genomes " +
-            "WHERE id = %s ", [genome_id])
+        with self.Cursor() as cur:
+            self.ExecutePrepared(cur, 'genome_info', (genome_id,))
         
-        result = cur.fetchone()
-        if not result:
-            self.ReportError("Unable to find genome_id: " + genome_id )
-            return None
+            result = cur.fetchone()
+            if not result:
+                self.ReportError("Unable to find genome_id: " + genome_id )
+                return None
         
-        return result
+            return result
     
     def GetGenomeOwner(self, genome_id):
         
@@ -464,49 +916,98 @@ class GenomeDatabase(object):
         """
         If source is None, assume tree_ids.
         """
-        cur = self.conn.cursor()
-        
-        return_id = None
+        with self.Cursor() as cur:
+            if source_id is None:
         
-        if source_id is None:
-        
-            cur.execute("SELECT id " +
-                        "FROM genomes " +
-                        "WHERE tree_id = %s ", [id_at_source])
+                self.ExecutePrepared(cur, 'genome_id_from_tree_id', (id_at_source,))
             
-            result = cur.fetchone()
-            if result is None:
-                self.ReportError("Unable to find tree id: " + id_at_source)
-                return None
+                result = cur.fetchone()
+                if result is None:
+                    self.ReportError("Unable to find tree id: " + id_at_source)
+                    return None
             
-            (genome_id, ) = result
+                (genome_id, ) = result
             
-            return genome_id
+                return genome_id
             
-        else:
+            else:
 
-            cur.execute("SELECT id " +
-                        "FROM genomes  " +
-                        "WHERE id_at_source = %s " +
-                        "AND genome_source_id = %s", [id_at_source, source_id])
+                self.ExecutePrepared(cur, 'genome_id_from_source_id', (id_at_source, source_id))
         
-            result = cur.fetchone()
-            if result is None:
-                self.ReportError("Unable to find genome : " + str(source_id))
-                return None
+                result = cur.fetchone()
+                if result is None:
+                    self.ReportError("Unable to find genome : " + str(source_id))
+                    return None
             
-            (genome_id, ) = result
+                (genome_id, ) = result
             
-            return genome_id
+                return genome_id
 
-    def SearchGenomes(self, name=None, description=None, genome_list_id=None, owner_id=None):
+    def GetGenomeIds(self, ids, source_id=None):
+        """
+        Batch version of GetGenomeId, resolving any number of ids in a single
+        query. If source is None, assume tree_ids. Returns a (found, missing)
+        tuple where found is a dict of id -> genome_id and missing is a list
+        of the ids which could not be found, in the order given.
+        """
+        ids = list(ids)
         
-        cur = self.conn.cursor()
+        with self.Cursor() as cur:
+            if source_id is None:
+                cur.execute("SELECT tree_id, id " +
+                            "FROM genomes " +
+                            "WHERE tree_id = ANY(%s)", (ids,))
+            else:
+                cur.execute("SELECT id_at_source, id " +
+                            "FROM genomes " +
+                            "WHERE id_at_source = ANY(%s) " +
+                            "AND genome_source_id = %s", (ids, source_id))
+            
+            found = dict(cur.fetchall())
+        
+        missing = list()
+        missing_set = set()
+        for x in ids:
+            if x not in found and x not in missing_set:
+                missing.append(x)
+                missing_set.add(x)
         
-        if genome_list_id is not None and genome_list_id in self.GetGenomeLists():
-            print "No Genomes Found"
+        return (found, missing)
+
+    def MetadataFieldExpression(self, field):
+        """
+        Returns a (SQL expression, parameters) tuple which extracts a metadata
+        field of a genome as text on the server. field is either the name of
+        a promoted metadata column (e.g. taxonomy) or an XML element path below
+        the document root (e.g. internal/greengenes/dereplicated/best_blast/greengenes_tax).
+        Values set through ImportMetadata take precedence over the XML.
+        Returns None if the field is not valid.
+        """
+        if field in PROMOTED_METADATA_FIELDS.values():
+            return ("genomes.%s::text" % (field,), [])
+        if field in PROMOTED_METADATA_FIELDS:
+            return ("genomes.%s::text" % (PROMOTED_METADATA_FIELDS[field],), [])
+        if not metadata_path_regex.match(field):
+            self.ReportError("Invalid metadata field: " + field)
             return None
-       
+        return ("coalesce(genomes.extra_metadata->>%s, (xpath(%s, genomes.metadata))[1]::text)",
+                [field, '/data/' + field + '/text()'])
+        
+    def SearchGenomes(self, name=None, description=None, genome_list_id=None, owner_id=None,
+                      metadata_fields=None, limit=None, after=None):
+        """
+        Returns an iterator over (tree_id, name, owner, date added, description)
+        tuples for the genomes matching all of the specified terms, in tree_id
+        order. Each of the requested metadata_fields (see
+        MetadataFieldExpression) is extracted on the server and appended to
+        the tuples. Returns None if the search terms are not valid.
+        
+        Rows are streamed from a server side cursor. For keyset pagination,
+        limit caps the number of rows and after only returns genomes with a
+        tree_id greater than it (i.e. pass the last tree_id of the previous
+        page). Name and description searches are backed by trigram indexes.
+        """
+        
         search_terms = list()
         query_params = list()
         if owner_id is not None:
@@ -521,165 +1022,223 @@ class GenomeDatabase(object):
         if genome_list_id is not None:
             search_terms.append("genomes.id in (SELECT genome_id FROM genome_list_contents WHERE list_id = %s)")
             query_params.append(genome_list_id)
+        if after is not None:
+            search_terms.append("genomes.tree_id > %s")
+            query_params.append(after)
         
         search_query = ''
         if len(search_terms):
             search_query = ' AND ' + ' AND '.join(search_terms)
         
-        cur.execute("SELECT tree_id, name, username, description, XMLSERIALIZE(document metadata as text) " +
-                    "FROM genomes, users " +
-                    "WHERE owner_id = users.id " + search_query, query_params)
-        
-        result = cur.fetchall()
-        
-        if len(result) == 0:
-            print "No Genomes Found"
-            return None
-        
-        return_array = []
-        for (tree_id, name, username, description, xml) in result:
-            root = et.fromstring(xml)
-            date_added = root.findall('internal/date_added')
-            if len(date_added) == 0:
-                date_added = 'Unknown Date'
-            else:
-                date_added = time.strftime('%X %x %Z',
-                                           time.localtime(float(date_added[0].text)))
-            return_array.append((tree_id, name, username, date_added, description))
-        
-        return return_array
+        limit_query = ''
+        if limit is not None:
+            limit_query = ' LIMIT %s'
+            query_params.append(int(limit))
+        
+        field_columns = ''
+        field_params = list()
+        if metadata_fields:
+            for field in metadata_fields:
+                expression = self.MetadataFieldExpression(field)
+                if expression is None:
+                    return None
+                field_columns += ", " + expression[0]
+                field_params += expression[1]
+        
+        def IterRows():
+            with self.Cursor("search_genomes") as cur:
+                cur.itersize = 1000
+                cur.execute("SELECT tree_id, name, username, description, extract(epoch FROM date_added)" + field_columns + " " +
+                            "FROM genomes, users " +
+                            "WHERE owner_id = users.id " + search_query + " " +
+                            "ORDER BY genomes.tree_id" + limit_query, field_params + query_params)
+                for row in cur:
+                    (tree_id, name, username, description, date_added) = row[:5]
+                    if date_added is None:
+                        date_added = 'Unknown Date'
+                    else:
+                        date_added = time.strftime('%X %x %Z',
+                                                   time.localtime(float(date_added)))
+                    yield (tree_id, name, username, date_added, description) + tuple(row[5:])
+        
+        return IterRows()
        
-    def FindMarkers(self, marker_database_name, version, fasta_file):
-        return self.FindMarkersEmboss(marker_database_name, version, fasta_file)
+    def FindMarkers(self, marker_database_name, version, fasta_file, genome_id=None):
+        return self.FindMarkersEmboss(marker_database_name, version, fasta_file, genome_id)
     
-    def FindMarkersEmboss(self, marker_database_name, version, fasta_file):
+    def FindMarkersEmboss(self, marker_database_name, version, fasta_file, genome_id=None):
+        from simplehmmer.simplehmmer import HMMERRunner, HMMERParser
+        
+        metrics = pipeline_metrics.GenomeMetrics('emboss', marker_database_name, version, genome_id)
         markers = markers_module.getAllMarkerSets()
         filter_function = lambda x,y : (x == marker_database_name) and (y == version)
         filtered_markers = dict([(x.name, x) for x in markers if filter_function(x.database, x.version)])
         result_dir = tempfile.mkdtemp()
+        segmented_fasta = os.path.join(result_dir, "segmented_fasta.fa")
+        translated_fasta = os.path.join(result_dir, marker_database_name + ".faa")
         
         # Lazy solution - split up into 10kb segments (offset by 5k) so that hmm_align only has to align 10kb max.
-        fh = open(os.path.join(result_dir, "segmented_fasta.fa"), "wb")
-        for (name, seq, qual) in readfq(open(fasta_file)):
-            pos = 10000
-            while True:
-                fh.write(">%i_%i_%s\n" % (pos - 10000, pos, name))
-                fh.write(seq[pos-10000:pos] + "\n")
-                if len(seq) <= pos:
-                    break
-                pos += 5000
-        fh.close()
+        with metrics.Stage('segmentation') as stage:
+            fh = open(segmented_fasta, "wb")
+            WriteSegmentedFasta(fh, readfq(open(fasta_file)))
+            fh.close()
+            stage.Read(fasta_file)
+            stage.Wrote(segmented_fasta)
+        
+        with metrics.Stage('translation') as stage:
+            stage.Call(["transeq", '-sequence', segmented_fasta,
+                        '-outseq', translated_fasta,
+                        '-table', '11',
+                        '-frame', '6'])
+            stage.Read(segmented_fasta)
+            stage.Wrote(translated_fasta)
         
         sequence_dict = dict()
         hmmer = HMMERRunner()
-        subprocess.call(["transeq", '-sequence', os.path.join(result_dir, "segmented_fasta.fa"),
-                         '-outseq', os.path.join(result_dir, marker_database_name + ".faa"),
-                         '-table', '11',
-                         '-frame', '6'])
-        for marker in filtered_markers.values():
-            hmmer.search(os.path.join(markers_module_path, marker.rel_path),
-                         os.path.join(result_dir, marker_database_name + ".faa"),
-                         os.path.join(result_dir, marker.name))
-            parser = HMMERParser(open(os.path.join(result_dir, marker.name, 'hmmer_out.txt')))
-            result = parser.next()
-            if result:
-                sequence_dict[marker.name] = result.target_name
+        with metrics.Stage('search') as stage:
+            for marker in filtered_markers.values():
+                hmmer.search(os.path.join(markers_module_path, marker.rel_path),
+                             translated_fasta,
+                             os.path.join(result_dir, marker.name))
+                stage.Subprocess()
+                stage.Read(translated_fasta)
+                hmmer_out = os.path.join(result_dir, marker.name, 'hmmer_out.txt')
+                stage.Wrote(hmmer_out)
+                parser = HMMERParser(open(hmmer_out))
+                result = parser.next()
+                if result:
+                    sequence_dict[marker.name] = result.target_name
         
         target_seq_dict = dict()
         
-        count = 0
-        for (name, seq, qual) in readfq(open(os.path.join(result_dir, marker_database_name + ".faa"))):
-            count += 1
-            if name in sequence_dict.values():
-                target_seq_dict[name] = count
-                fh = open(os.path.join(result_dir, str(count) + ".faa"), 'wb')
-                fh.write(">" + name + "\n")
-                fh.write(seq)
-                fh.close()
+        with metrics.Stage('extraction') as stage:
+            count = 0
+            for (name, seq, qual) in readfq(open(translated_fasta)):
+                count += 1
+                if name in sequence_dict.values():
+                    target_seq_dict[name] = count
+                    target_fasta = os.path.join(result_dir, str(count) + ".faa")
+                    fh = open(target_fasta, 'wb')
+                    fh.write(">" + name + "\n")
+                    fh.write(seq)
+                    fh.close()
+                    stage.Wrote(target_fasta)
+            stage.Read(translated_fasta)
                 
         result_dict = dict()
         
+        alignment_stage = metrics.Stage('alignment')
+        parsing_stage = metrics.Stage('parsing')
         for (marker_name, target_name) in sequence_dict.items():
-            os.system("hmmalign --allcol --outformat Pfam -o %s %s %s" %
-                      (os.path.join(result_dir, marker_name + ".aligned"),
-                       os.path.join(markers_module_path, filtered_markers[marker_name].rel_path),
-                       os.path.join(result_dir, str(target_seq_dict[target_name]) + ".faa")))
-            fh = open(os.path.join(result_dir, marker_name + ".aligned"))
-            fh.readline()
-            fh.readline()
-            seqline = fh.readline()
-            seq_start_pos = seqline.rfind(' ')
-            fh.readline()
-            fh.readline()
-            mask = fh.readline()
-            seqline = seqline[seq_start_pos:]
-            mask = mask[seq_start_pos:]
-            seqline = ''.join([seqline[x] for x in range(0, len(seqline)) if mask[x] == 'x'])
-            if (seqline.count('-') / float(len(seqline))) > 0.5: # Limit to less than half gaps
-                continue
-            result_dict[marker_name] = seqline
+            aligned_file = os.path.join(result_dir, marker_name + ".aligned")
+            target_fasta = os.path.join(result_dir, str(target_seq_dict[target_name]) + ".faa")
+            with alignment_stage:
+                alignment_stage.Call(["hmmalign", "--allcol", "--outformat", "Pfam", "-o", aligned_file,
+                                      os.path.join(markers_module_path, filtered_markers[marker_name].rel_path),
+                                      target_fasta])
+                alignment_stage.Read(target_fasta)
+                alignment_stage.Wrote(aligned_file)
+            with parsing_stage:
+                parsing_stage.Read(aligned_file)
+                fh = open(aligned_file)
+                seqline = ReadMaskedAlignment(fh)
+                fh.close()
+                if (seqline.count('-') / float(len(seqline))) > 0.5: # Limit to less than half gaps
+                    continue
+                result_dict[marker_name] = seqline
         
         subprocess.call(["rm", "-rf", result_dir])
+        self.EmitPipelineMetrics(metrics)
         return result_dict
     
-    def FindMarkersMetachecker(self, marker_database_name, version, fasta_file):
+    def FindMarkersMetachecker(self, marker_database_name, version, fasta_file, genome_id=None):
+        from metachecka2000.dataConstructor import Mc2kHmmerDataConstructor as DataConstructor
+        from metachecka2000.resultsParser import HMMAligner
+        from metachecka2000.resultsParser import Mc2kHmmerResultsParser as QaParser
+        
+        metrics = pipeline_metrics.GenomeMetrics('metachecker', marker_database_name, version, genome_id)
         markers = markers_module.getAllMarkerSets()
         filter_function = lambda x,y : (x == marker_database_name) and (y == version)
         filtered_markers = dict([(x.name, x) for x in markers if filter_function(x.database, x.version)])
         result_dir = tempfile.mkdtemp()
-        concatenated_hmm = tempfile.NamedTemporaryFile(delete=False)
-        for marker in filtered_markers.values():
-            with open(os.path.join(markers_module_path, marker.rel_path)) as fh:
-                for line in fh:
-                    concatenated_hmm.write(line)
         
-        concatenated_hmm.close()
+        with metrics.Stage('hmm_concatenation') as stage:
+            concatenated_hmm = tempfile.NamedTemporaryFile(delete=False)
+            for marker in filtered_markers.values():
+                with open(os.path.join(markers_module_path, marker.rel_path)) as fh:
+                    for line in fh:
+                        concatenated_hmm.write(line)
+            
+            concatenated_hmm.close()
+            stage.Wrote(concatenated_hmm.name)
+        
         prefix = 'gtdb_'
-        dc = DataConstructor()
-        dc.buildData([fasta_file], result_dir, concatenated_hmm.name, prefix, quiet=True)
+        # The subprocesses of these stages are run by metachecka2000, so
+        # they aren't counted.
+        with metrics.Stage('search') as stage:
+            dc = DataConstructor()
+            dc.buildData([fasta_file], result_dir, concatenated_hmm.name, prefix, quiet=True)
+            stage.Read(fasta_file)
+            stage.Read(concatenated_hmm.name)
 
-        qa = QaParser(prefix=prefix)
-        qa.analyseResults(result_dir, concatenated_hmm.name)
+        with metrics.Stage('analysis') as stage:
+            qa = QaParser(prefix=prefix)
+            qa.analyseResults(result_dir, concatenated_hmm.name)
 
-        aligner = HMMAligner(prefix=prefix, individualFile=True,
-                includeConsensus=False, outputFormat="Pfam")
-        aligner.makeAlignments(result_dir,
-                concatenated_hmm.name,prefix=prefix,bestHit=True)
+        with metrics.Stage('alignment') as stage:
+            aligner = HMMAligner(prefix=prefix, individualFile=True,
+                    includeConsensus=False, outputFormat="Pfam")
+            aligner.makeAlignments(result_dir,
+                    concatenated_hmm.name,prefix=prefix,bestHit=True)
         
         result_dict = dict()
-        for folder in os.listdir(result_dir):
-            # returns the summary information in metachecka for addition into
-            # the DB
-            summary_info = qa.results[folder].calculateMarkers()
-            
-            for marker_name in filtered_markers:
-                try:
-                    with open(os.path.join(result_dir,folder,marker_name)+"_out.align") as fh:
-                        fh.readline()
-                        fh.readline()
-                        seqline = fh.readline()
-                        seq_start_pos = seqline.rfind(' ')
-                        fh.readline()
-                        fh.readline()
-                        mask = fh.readline()
-                        seqline = seqline[seq_start_pos:]
-                        mask = mask[seq_start_pos:]
-                        seqline = ''.join([seqline[x] for x in range(0, len(seqline)) if mask[x] == 'x'])
-                        if (seqline.count('-') / float(len(seqline))) > 0.5: # Limit to less than half gaps
-                            continue
-                        result_dict[marker_name] = seqline
-                except IOError:
-                    pass
+        with metrics.Stage('parsing') as stage:
+            for folder in os.listdir(result_dir):
+                # returns the summary information in metachecka for addition into
+                # the DB
+                summary_info = qa.results[folder].calculateMarkers()
+                
+                for marker_name in filtered_markers:
+                    try:
+                        aligned_file = os.path.join(result_dir,folder,marker_name)+"_out.align"
+                        with open(aligned_file) as fh:
+                            stage.Read(aligned_file)
+                            seqline = ReadMaskedAlignment(fh)
+                            if (seqline.count('-') / float(len(seqline))) > 0.5: # Limit to less than half gaps
+                                continue
+                            result_dict[marker_name] = seqline
+                    except IOError:
+                        pass
         #cleanup
         os.remove(concatenated_hmm.name)
         shutil.rmtree(result_dir)
         
+        self.EmitPipelineMetrics(metrics)
         return result_dict
 
+    def EmitPipelineMetrics(self, metrics):
+        """
+        Writes the stage metrics of a marker pipeline run as JSON lines to
+        pipelineMetricsFile and/or stores them in the pipeline_metrics table,
+        as configured.
+        """
+        if self.pipelineMetricsFile is None and not self.storePipelineMetrics:
+            return
+        records = metrics.Records()
+        if self.pipelineMetricsFile is not None:
+            pipeline_metrics.WriteJsonLines(self.pipelineMetricsFile, records)
+        if self.storePipelineMetrics:
+            columns = ['host', 'genome_id', 'pipeline', 'marker_database', 'version', 'stage',
+                       'wall_seconds', 'cpu_seconds', 'child_cpu_seconds', 'subprocesses',
+                       'bytes_read', 'bytes_written', 'peak_rss_kb', 'child_peak_rss_kb']
+            with self.Transaction() as cur:
+                cur.executemany("INSERT INTO pipeline_metrics (recorded, " + ", ".join(columns) + ") " +
+                                "VALUES (to_timestamp(%s), " + ", ".join(["%s"] * len(columns)) + ")",
+                                [[record['recorded']] + [record[column] for column in columns]
+                                 for record in records])
+
     def CalculateMarkersForGenome(self, genome_id):
         
-        cur = self.conn.cursor()
-
         if not self.CheckGenomeExists(genome_id):
             self.ReportError("Unable to find genome_id: " + str(genome_id))
             return False
@@ -691,33 +1250,23 @@ class GenomeDatabase(object):
         markers = dict()
         
         markers["Phylosift"] = {'version': '2',
-                                'markers': self.FindMarkers("Phylosift","2", destfile)}
+                                'markers': self.FindMarkers("Phylosift","2", destfile, genome_id)}
         
         markers["pmid22170421"] = {'version': '1',
-                                   'markers': self.FindMarkers("pmid22170421","1", destfile)}
+                                   'markers': self.FindMarkers("pmid22170421","1", destfile, genome_id)}
 
-        for database in markers.keys():
-            for (marker_database_id, seq) in markers[database]['markers'].items():
-                cur.execute("SELECT markers.id " +
-                            "FROM markers, databases " +
-                            "WHERE database_specific_id = %s " +
-                            "AND database_id = databases.id " +
-                            "AND databases.name = %s " +
-                            "AND markers.version = %s",
-                            (marker_database_id, database, markers[database]['version']))
-                result = cur.fetchone()
-                if result:
+        with self.Transaction() as cur:
+            for database in markers.keys():
+                for (marker_database_id, seq) in markers[database]['markers'].items():
+                    self.ExecutePrepared(cur, 'marker_id',
+                                         (marker_database_id, database, markers[database]['version']))
+                    result = cur.fetchone()
+                    if not result:
+                        continue
                     (marker_id,) = result
-                
-                cur.execute("DELETE from aligned_markers "+
-                            "WHERE genome_id = %s " +
-                            "AND marker_id = %s",
-                            (genome_id, marker_id))
-                cur.execute("INSERT into aligned_markers (genome_id, marker_id, dna, sequence) " + 
-                            "VALUES (%s, %s, False, %s)",
-                            (genome_id, marker_id, seq))
-        
-        self.conn.commit()
+                    
+                    self.ExecutePrepared(cur, 'delete_aligned_marker', (genome_id, marker_id))
+                    self.ExecutePrepared(cur, 'insert_aligned_marker', (genome_id, marker_id, seq))
         
         os.unlink(destfile)
         
@@ -727,14 +1276,15 @@ class GenomeDatabase(object):
             self.lastErrorMessage = "Only root can do that."
             return False
         
-        all_genomes_array = self.SearchGenomes()
+        with self.Cursor() as cur:
+            cur.execute("SELECT id FROM genomes ORDER BY id")
+            all_genome_ids = [genome_id for (genome_id,) in cur.fetchall()]
         
-        for genome_array in all_genomes_array:
-            tree_id = genome_array[0]
-            genome_id = self.GetGenomeId(tree_id)
+        for genome_id in all_genome_ids:
             self.CalculateMarkersForGenome(genome_id)
 
     def AddMarkers(self, marker_dict):
+        from simplehmmer.hmmmodelparser import HmmModelParser
         
         if self.currentUser.getTypeId() != 0:
             self.lastErrorMessage = "Only root can do that."
@@ -763,43 +1313,157 @@ class GenomeDatabase(object):
         return True
 #-------- Metadata Managements
     
-    def UpdateTaxonomies(self, taxonomy_dict):
-        cur = self.conn.cursor()
-        
+    def UpdateTaxonomies(self, taxonomies):
+        """
+        Sets the internal taxonomy of genomes. taxonomies is a dict of tree_id
+        to taxonomy, or any iterable of (tree_id, taxonomy) pairs (e.g. read
+        straight from a taxonomy file). The pairs are streamed into a staging
+        table with COPY and applied in a single statement. Where a tree_id is
+        given more than once, the last taxonomy wins.
+        
+        Returns a (number of genomes updated, list of unknown tree ids) tuple,
+        or None on failure.
+        """
         if self.currentUser.getTypeId() != 0:
             self.lastErrorMessage = "Only root can do that."
-            return False
+            return None
         
-        for (tree_id, taxonomy) in taxonomy_dict.items():
-            genome_id = self.GetGenomeId(tree_id)
-            if not genome_id:
-                self.lastErrorMessage = "Unable to find tree id: " + tree_id
-                return False
-            taxonomy = taxonomy.replace('; ', ';')
-            cur.execute("SELECT XMLSERIALIZE(document metadata as text) "+
-                        "FROM genomes " +
-                        "WHERE id = %s", (genome_id,));
-            
-            result = cur.fetchone()
-            if result:
-                (xmlstr,) = result
+        if isinstance(taxonomies, dict):
+            taxonomies = taxonomies.items()
+        
+        with self.Transaction() as cur:
+            cur.execute("CREATE TEMP TABLE taxonomy_staging (" +
+                            "line serial, " +
+                            "tree_id text, " +
+                            "taxonomy text) " +
+                        "ON COMMIT DROP")
+            cur.copy_expert("COPY taxonomy_staging (tree_id, taxonomy) FROM STDIN",
+                            IterFile(CopyRow((tree_id, taxonomy)) for (tree_id, taxonomy) in taxonomies))
+            cur.execute("ANALYZE taxonomy_staging")
+        
+            cur.execute("WITH latest AS ( " +
+                            "SELECT DISTINCT ON (tree_id) tree_id, taxonomy " +
+                            "FROM taxonomy_staging " +
+                            "ORDER BY tree_id, line DESC), " +
+                        "updated AS ( " +
+                            "UPDATE genomes " +
+                            "SET taxonomy = replace(latest.taxonomy, '; ', ';') " +
+                            "FROM latest " +
+                            "WHERE genomes.tree_id = latest.tree_id " +
+                            "RETURNING genomes.tree_id) " +
+                        "SELECT (SELECT count(*) FROM updated), " +
+                               "ARRAY(SELECT tree_id FROM latest " +
+                                     "WHERE NOT EXISTS (SELECT 1 FROM updated " +
+                                                       "WHERE updated.tree_id = latest.tree_id) " +
+                                     "ORDER BY tree_id)")
+            (updated_count, unknown_tree_ids) = cur.fetchone()
+        
+        return (updated_count, unknown_tree_ids)
+    
+    def ImportMetadata(self, metadata_file, batch_size=10000, progress_callback=None):
+        """
+        Bulk sets arbitrary metadata fields from a tab separated file object.
+        The first line is a header of tree_id followed by the field names,
+        either promoted metadata columns (e.g. taxonomy) or XML paths (e.g.
+        internal/greengenes/dereplicated/best_blast/greengenes_tax). Empty
+        cells leave the field unchanged.
+        
+        The rows are streamed into a staging table with COPY and merged into
+        the genomes on the server in transactions of batch_size rows, calling
+        progress_callback(rows merged, total rows) after each one.
+        
+        Returns a (number of genomes updated, list of unknown tree ids) tuple,
+        or None on failure.
+        """
+        if self.currentUser.getTypeId() != 0:
+            self.ReportError("Only root can do that.")
+            return None
+        
+        if batch_size < 1:
+            self.ReportError("The batch size must be at least 1.")
+            return None
+        
+        header = metadata_file.readline().rstrip('\r\n').split('\t')
+        if len(header) < 2 or header[0] != 'tree_id':
+            self.ReportError("The first line must be a header of tree_id followed by the field names.")
+            return None
+        fields = header[1:]
+        
+        column_updates = list()
+        extra_paths = list()
+        extra_columns = list()
+        for (i, field) in enumerate(fields):
+            column = PROMOTED_METADATA_FIELDS.get(field, field)
+            if column == 'date_added':
+                self.ReportError("date_added cannot be imported.")
+                return None
+            if column in PROMOTED_METADATA_FIELDS.values():
+                column_updates.append("%s = coalesce(staging.field_%i, genomes.%s)" % (column, i, column))
+            elif metadata_path_regex.match(field):
+                extra_paths.append(field)
+                extra_columns.append("staging.field_%i" % (i,))
             else:
-                continue
-            root = et.fromstring(xmlstr)
-            internal_node =  xml_funcs.ReturnExtantOrCreateElement(root, 'internal')[0][0]
-            taxonomy_node = xml_funcs.ReturnExtantOrCreateElement(internal_node, 'taxonomy')[0][0]
-            taxonomy_node.text = escape(taxonomy)
+                self.ReportError("Invalid metadata field: " + field)
+                return None
+        if len(extra_paths) > 0:
+            column_updates.append("extra_metadata = genomes.extra_metadata || " +
+                                  "jsonb_strip_nulls(json_object(%%s::text[], ARRAY[%s])::jsonb)" %
+                                  (", ".join(extra_columns),))
+        
+        def ReadRows():
+            for line in metadata_file:
+                splitline = line.rstrip('\r\n').split('\t')
+                if splitline == ['']:
+                    continue
+                splitline += [''] * (len(header) - len(splitline))
+                yield CopyRow([value if value != '' else None for value in splitline[:len(header)]])
+        
+        with self.Transaction() as cur:
+            cur.execute("DROP TABLE IF EXISTS metadata_staging")
+            cur.execute("CREATE TEMP TABLE metadata_staging (" +
+                            "line serial PRIMARY KEY, " +
+                            "tree_id text, " +
+                            ", ".join(["field_%i text" % (i,) for i in range(len(fields))]) + ")")
+            cur.copy_expert("COPY metadata_staging (tree_id, " +
+                            ", ".join(["field_%i" % (i,) for i in range(len(fields))]) + ") FROM STDIN",
+                            IterFile(ReadRows()))
+            cur.execute("ANALYZE metadata_staging")
             
-            cur.execute("UPDATE genomes " +
-                        "SET metadata = XMLPARSE(document %s) " +
-                        "WHERE id = %s", (et.tostring(root), genome_id))
-        
-        self.conn.commit()
-        return True
+            cur.execute("SELECT coalesce(max(line), 0), " +
+                               "ARRAY(SELECT DISTINCT tree_id FROM metadata_staging " +
+                                     "WHERE NOT EXISTS (SELECT 1 FROM genomes " +
+                                                       "WHERE genomes.tree_id = metadata_staging.tree_id) " +
+                                     "ORDER BY tree_id) " +
+                        "FROM metadata_staging")
+            (total_rows, unknown_tree_ids) = cur.fetchone()
+        
+        # Within a batch the last row for a tree id wins
+        update_query = ("UPDATE genomes " +
+                        "SET " + ", ".join(column_updates) + " " +
+                        "FROM (SELECT DISTINCT ON (tree_id) * " +
+                              "FROM metadata_staging " +
+                              "WHERE line > %s AND line <= %s " +
+                              "ORDER BY tree_id, line DESC) AS staging " +
+                        "WHERE genomes.tree_id = staging.tree_id")
+        
+        updated_count = 0
+        for batch_start in range(0, total_rows, batch_size):
+            batch_end = min(batch_start + batch_size, total_rows)
+            params = [batch_start, batch_end]
+            if len(extra_paths) > 0:
+                params = [extra_paths] + params
+            with self.Transaction() as cur:
+                cur.execute(update_query, params)
+                updated_count += cur.rowcount
+            if progress_callback is not None:
+                progress_callback(batch_end, total_rows)
+        
+        with self.Transaction() as cur:
+            cur.execute("DROP TABLE metadata_staging")
+        
+        return (updated_count, unknown_tree_ids)
     
     def UpdateCoreList(self, genome_ids, operation):
-        cur = self.conn.cursor()
-        
         if self.currentUser.getTypeId() != 0:
             self.lastErrorMessage = "Only root can do that."
             return False
@@ -808,64 +1472,52 @@ class GenomeDatabase(object):
             self.lastErrorMessage = "Operation needs to be one of: private, public, delete."
             return False
         
-        for genome_id in genome_ids:
-            cur.execute("SELECT XMLSERIALIZE(document metadata as text) "+
-            "FROM genomes " +
-            "WHERE id = %s", (genome_id,));
-            result = cur.fetchone()
-            if result:
-                (xmlstr,) = result
-            else:
-                continue
-            root = et.fromstring(xmlstr)
-            internal_node =  xml_funcs.ReturnExtantOrCreateElement(root, 'internal')[0][0]
-            core_list_node = xml_funcs.ReturnExtantOrCreateElement(internal_node, 'core_list')[0][0]
-            if operation == "delete":
-                internal_node.remove(core_list_node)
-            else:
-                core_list_node.text = escape(operation)
-            
+        core_list = operation
+        if operation == "delete":
+            core_list = None
+        
+        with self.Transaction() as cur:
             cur.execute("UPDATE genomes " +
-                        "SET metadata = XMLPARSE(document %s) " +
-                        "WHERE id = %s", (et.tostring(root), genome_id))
-            
-        self.conn.commit()
+                        "SET core_list = %s " +
+                        "WHERE id = ANY(%s)", (core_list, list(genome_ids)))
+        
         return True
     
 #-------- Genome Sources Management
 
     def GetGenomeSources(self):
-        cur = self.conn.cursor()
+        with self.Cursor() as cur:
+            cur.execute("SELECT id, name FROM genome_sources")
         
-        cur.execute("SELECT id, name FROM genome_sources")
-        
-        return cur.fetchall()
+            return cur.fetchall()
     
     def GetGenomeSourceIdFromName(self, source_name):
         
-        cur = self.conn.cursor()
-        cur.execute("SELECT id FROM genome_sources where name = %s", (source_name,))
+        with self.Cursor() as cur:
+            cur.execute("SELECT id FROM genome_sources where name = %s", (source_name,))
         
-        result = cur.fetchone()
-        if result:
-            (source_id,) = result
-            return source_id
-        else:
-            self.ReportError("Unable to find source: " + source_name)
-        return None
+            result = cur.fetchone()
+            if result:
+                (source_id,) = result
+                return source_id
+            else:
+                self.ReportError("Unable to find source: " + source_name)
+            return None
 
 # ------- Genome Treeing
 
     def ReturnKnownProfiles(self):
-        return profiles.profiles.keys()
+        return profiles.ReturnKnownProfileNames()
+
+    def MakeTreeData(self, core_lists, list_of_genome_ids, profile, directory, prefix=None, **kwargs):
+        """
+        Any extra keyword arguments (e.g. the column filtering thresholds) are
+        passed through to the MakeTreeData function of the profile.
+        """
 
-    def MakeTreeData(self, core_lists, list_of_genome_ids, profile, directory, prefix=None):    
-       
-        cur = self.conn.cursor()
-        
         if profile is None:
             profile = profiles.ReturnDefaultProfileName()
-        if profile not in profiles.profiles:
+        if profile not in profiles.ReturnKnownProfileNames():
             self.ReportError("Unknown Profile: " + profile)
             return None
         if not(os.path.exists(directory)):
@@ -875,50 +1527,76 @@ class GenomeDatabase(object):
         if len(core_lists) != 0:
             genome_id_dict = dict([(genome_id, 1) for genome_id in list_of_genome_ids])
         
-            cur.execute("SELECT id, XMLSERIALIZE(document metadata as text) " +
-                        "FROM genomes")
-        
-            for (genome_id, xmlstr) in cur.fetchall():
-                root = et.fromstring(xmlstr)
-                internal_node =  xml_funcs.ReturnExtantOrCreateElement(root, 'internal')[0][0]
-                core_list_node = xml_funcs.ReturnExtantOrCreateElement(internal_node, 'core_list')[0][0]
-                
-                if genome_id not in genome_id_dict:
-                    if ((core_list_node.text == "private" and "private" in core_lists) or
-                        (core_list_node.text == "public" and "public" in core_lists)):
+            with self.Cursor() as cur:
+                cur.execute("SELECT id " +
+                            "FROM genomes " +
+                            "WHERE core_list = ANY(%s)", (list(core_lists),))
+            
+                for (genome_id,) in cur:
+                    if genome_id not in genome_id_dict:
                         list_of_genome_ids.append(genome_id)
             
-        return profiles.profiles[profile].MakeTreeData(self, list_of_genome_ids,
-                                                       directory, prefix)
+        return profiles.LoadProfile(profile).MakeTreeData(self, list_of_genome_ids,
+                                                          directory, prefix, **kwargs)
 
 #-------- Fasta File Management
 
     def ExportGenomicFasta(self, genome_id, destfile=None):
         
-        cur = self.conn.cursor()
+        with self.Cursor() as cur:
+            cur.execute("SELECT genomic_fasta " +
+                        "FROM genomes " +
+                        "WHERE id = %s ", [genome_id])
+            result = cur.fetchone()
+        
+            if result is None:
+                return None
+            (genomic_oid,) = result
         
-        cur.execute("SELECT genomic_fasta " +
-                    "FROM genomes " +
-                    "WHERE id = %s ", [genome_id])
-        result = cur.fetchone()
+            fasta_lobject = self.conn.lobject(genomic_oid, 'r')
         
-        if result is None:
-            return None
-        (genomic_oid,) = result
+            if destfile is None:
+                return fasta_lobject.read()
+            else:
+                fasta_lobject.export(destfile)
         
-        fasta_lobject = self.conn.lobject(genomic_oid, 'r')
+            return True
+    
+    def IterGenomicFasta(self, genome_id, chunk_size=FASTA_CHUNK_SIZE):
+        """
+        Generator yielding the genomic FASTA of a genome in chunks of up to
+        chunk_size bytes, so that large genomes are never held in memory.
+        Yields nothing if the genome doesn't exist.
         
-        if destfile is None:
-            return fasta_lobject.read()
-        else:
-            fasta_lobject.export(destfile)
+        The large object is read inside the Cursor, so the transaction the
+        read needs ends with the generator.
+        """
+        with self.Cursor() as cur:
+            cur.execute("SELECT genomic_fasta " +
+                        "FROM genomes " +
+                        "WHERE id = %s ", [genome_id])
+            result = cur.fetchone()
         
-        return True
+            if result is None or result[0] is None:
+                return
+            (genomic_oid,) = result
+        
+            try:
+                fasta_lobject = self.conn.lobject(genomic_oid, 'r')
+            except pg.OperationalError:
+                # The genome was deleted since it was selected
+                return
+            try:
+                while True:
+                    chunk = fasta_lobject.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                fasta_lobject.close()
     
     def AddFastaGenome(self, fasta_file, name, desc, id_prefix, source_id=None, id_at_source=None):
         
-        cur = self.conn.cursor()
-        
         match = re.search('^[A-Z]$', id_prefix)
         if not match:
             self.ReportError("Tree ID prefixes must be in the range A-Z")
@@ -935,134 +1613,143 @@ class GenomeDatabase(object):
             self.ReportError("You need to be logged in to add a FASTA file.")
             return None
         
-        query = "SELECT tree_id FROM genomes WHERE tree_id like %s order by tree_id desc;"
-        cur.execute(query, (id_prefix + '%',))
-        last_id = None
-        for (tree_id,) in cur:
-            last_id = tree_id
-            break
-        if (last_id is None):
-            new_id = id_prefix + "00000001"
-        else:
-            new_id = id_prefix + "%08.i" % (int(last_id[1:]) + 1)
-        
-        if source_id is None:
-            cur.execute("SELECT id FROM genome_sources WHERE name = 'user'")
-            result = cur.fetchone()
-            if not result:
-                self.ReportError("Could not find 'user' genome source. Possible database corruption.")
-                return None
-            (source_id,) = result
-            if id_at_source is not None:
-                self.ReportError("You cannot specify an ID at an unspecified genome source.")
-                return None
+        with self.Transaction() as cur:
+            query = "SELECT tree_id FROM genomes WHERE tree_id like %s order by tree_id desc;"
+            cur.execute(query, (id_prefix + '%',))
+            last_id = None
+            for (tree_id,) in cur:
+                last_id = tree_id
+                break
+            if (last_id is None):
+                new_id = id_prefix + "00000001"
+            else:
+                new_id = id_prefix + "%08.i" % (int(last_id[1:]) + 1)
         
-        if id_at_source is None:
-            id_at_source = new_id
-
-        added = time.mktime(time.localtime()) # Seconds since epoch
+            if source_id is None:
+                cur.execute("SELECT id FROM genome_sources WHERE name = 'user'")
+                result = cur.fetchone()
+                if not result:
+                    self.ReportError("Could not find 'user' genome source. Possible database corruption.")
+                    return None
+                (source_id,) = result
+                if id_at_source is not None:
+                    self.ReportError("You cannot specify an ID at an unspecified genome source.")
+                    return None
+        
+            if id_at_source is None:
+                id_at_source = new_id
 
-        initial_xml_string = 'XMLPARSE (DOCUMENT \'<?xml version="1.0"?><data><internal><date_added>%i</date_added></internal></data>\')' % (added)
-        cur.execute("INSERT INTO genomes (tree_id, name, description, metadata, owner_id, genome_source_id, id_at_source) "
-            + "VALUES (%s, %s, %s, " + initial_xml_string + ", %s, %s, %s) "
-            + "RETURNING id" , (new_id, name, desc, self.currentUser.getUserId(),
-                                source_id, id_at_source))
-        
-        genome_id = cur.fetchone()[0]
+            initial_xml_string = 'XMLPARSE (DOCUMENT \'<?xml version="1.0"?><data><internal></internal></data>\')'
+            cur.execute("INSERT INTO genomes (tree_id, name, description, metadata, date_added, owner_id, genome_source_id, id_at_source) "
+                + "VALUES (%s, %s, %s, " + initial_xml_string + ", now(), %s, %s, %s) "
+                + "RETURNING id" , (new_id, name, desc, self.currentUser.getUserId(),
+                                    source_id, id_at_source))
         
-        fasta_lobject = self.conn.lobject(0, 'w', 0, fasta_file)
+            genome_id = cur.fetchone()[0]
         
-        cur.execute("UPDATE genomes SET genomic_fasta = %s WHERE id = %s",
-                    (fasta_lobject.oid, genome_id))
+            fasta_lobject = self.conn.lobject(0, 'w', 0, fasta_file)
         
-        fasta_lobject.close()
+            cur.execute("UPDATE genomes SET genomic_fasta = %s WHERE id = %s",
+                        (fasta_lobject.oid, genome_id))
         
-        self.conn.commit()
+            fasta_lobject.close()
         
         return genome_id
     
     def DeleteGenome(self, genome_id):
         
-        cur = self.conn.cursor()
-        
-        # Check that you are allowed to delete this genome
+        with self.Transaction() as cur:
+            # Check that you are allowed to delete this genome
         
-        cur.execute("SELECT owner_id " +
-            "FROM genomes " +
-            "WHERE id = %s ", [genome_id])
+            cur.execute("SELECT owner_id " +
+                "FROM genomes " +
+                "WHERE id = %s ", [genome_id])
         
-        result = cur.fetchone()
+            result = cur.fetchone()
         
-        if result is None:
-            return None
-        (owner_id,) = result
+            if result is None:
+                return None
+            (owner_id,) = result
         
-        if (not owner_id == self.currentUser.getUserId()) and not self.CheckForCurrentUserHigherPrivileges(owner_id):
-            self.lastErrorMessage = "Insufficient priviliges"
-            return None
+            if (not owner_id == self.currentUser.getUserId()) and not self.CheckForCurrentUserHigherPrivileges(owner_id):
+                self.lastErrorMessage = "Insufficient priviliges"
+                return None
         
-        # Delete the fasta object
+            # Delete the fasta object
         
-        cur.execute("SELECT genomic_fasta " +
-            "FROM genomes " +
-            "WHERE id = %s ", [genome_id])
+            cur.execute("SELECT genomic_fasta " +
+                "FROM genomes " +
+                "WHERE id = %s ", [genome_id])
         
-        result = cur.fetchone()
+            result = cur.fetchone()
         
-        if result is not None:
-            (genomic_oid,) = result
+            if result is not None:
+                (genomic_oid,) = result
             
-            fasta_lobject = self.conn.lobject(genomic_oid, 'w')
+                fasta_lobject = self.conn.lobject(genomic_oid, 'w')
             
-            fasta_lobject.unlink()
+                fasta_lobject.unlink()
         
-        # Delete the DB entries object
+            # Delete the DB entries object
         
-        cur.execute("DELETE from genome_list_contents " +
-                    "WHERE genome_id = %s", [genome_id])
+            cur.execute("DELETE from genome_list_contents " +
+                        "WHERE genome_id = %s", [genome_id])
         
-        cur.execute("DELETE from aligned_markers " +
-                    "WHERE genome_id = %s", [genome_id])
+            cur.execute("DELETE from aligned_markers " +
+                        "WHERE genome_id = %s", [genome_id])
         
-        cur.execute("DELETE from genomes " +
-                    "WHERE id = %s", [genome_id])
-        
-        self.conn.commit()
+            cur.execute("DELETE from genomes " +
+                        "WHERE id = %s", [genome_id])
         
         return True
         
         
 #----- Other Functions
 
-def readfq(fp): # this is a generator function
-    """https://github.com/lh3/"""
-    last = None # this is a buffer keeping the last unprocessed line
-    while True: # mimic closure; is it a bad idea?
-        if not last: # the first record or a record following a fastq
-            for l in fp: # search for the start of the next record
-                if l[0] in '>@': # fasta/q header line
-                    last = l[:-1] # save this line
-                    break
-        if not last: break
-        name, seqs, last = last[1:].split()[0], [], None
-        for l in fp: # read the sequence
-            if l[0] in '@+>':
-                last = l[:-1]
+class IterFile(object):
+    """
+    Read only file object over an iterable of strings, so that generated
+    rows can be streamed to COPY without building the whole input in memory.
+    """
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.buffer = ''
+    
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
                 break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+': # this is a fasta record
-            yield name, ''.join(seqs), None # yield a fasta record
-            if not last: break
-        else: # this is a fastq record
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp: # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq): # have read enough quality
-                    last = None
-                    yield name, seq, ''.join(seqs); # yield a fastq record
-                    break
-            if last: # reach EOF before reading enough quality
-                yield name, seq, None # yield a fasta record instead
+        if size < 0:
+            size = len(self.buffer)
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+    
+    def readline(self, size=-1):
+        while '\n' not in self.buffer:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
                 break
-           
+        end = self.buffer.find('\n') + 1
+        if end == 0:
+            end = len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        (data, self.buffer) = (self.buffer[:end], self.buffer[end:])
+        return data
+
+def CopyRow(values):
+    """
+    Formats a sequence of values as a line of COPY text format input. None
+    becomes NULL.
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        else:
+            fields.append(str(value).replace('\\', '\\\\').replace('\t', '\\t')
+                                    .replace('\n', '\\n').replace('\r', '\\r'))
+    return '\t'.join(fields) + '\n'
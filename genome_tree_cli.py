@@ -1,17 +1,37 @@
 #!/usr/bin/env python
+import time
+start_time = time.time()
+
 import argparse
 import sys
-import genome_tree_backend as backend
 import getpass
 import random
 import os
 
 import profiles
 
+# genome_tree_backend (and through it psycopg2) is imported once the
+# arguments have been parsed, so --help and usage errors stay fast.
+
+imports_time = time.time()
+
 def ErrorReport(msg):
     sys.stderr.write(msg)
     sys.stderr.flush()
 
+def TimingReport(phases):
+    """
+    Writes the time taken by each start up phase, given as a list of (name,
+    end time) pairs, to stderr.
+    """
+    sys.stderr.write("Start up timing (ms):\n")
+    last = start_time
+    for (name, end) in phases:
+        sys.stderr.write("  %-20s %10.1f\n" % (name, (end - last) * 1000))
+        last = end
+    sys.stderr.write("  %-20s %10.1f\n" % ("total", (last - start_time) * 1000))
+    sys.stderr.flush()
+
 def NewPasswordPrompt(GenomeDatabase):
     autogenerated = False
     password = getpass.getpass("Enter new password (leave blank to auto-generate):")
@@ -158,8 +178,11 @@ def ExportFasta(GenomeDatabase, args):
 
 def DeleteGenome(GenomeDatabase, args):
     tree_ids = args.tree_ids.split(',')
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(tree_ids)
+    for tree_id in missing_ids:
+        ErrorReport("Unable to find tree id: " + tree_id + "\n")
     for tree_id in tree_ids:
-        genome_id = GenomeDatabase.GetGenomeId(tree_id)
+        genome_id = genome_ids.get(tree_id)
         if genome_id is not None:
             if GenomeDatabase.DeleteGenome(genome_id) is None:
                 ErrorReport(GenomeDatabase.lastErrorMessage + "\n")
@@ -176,16 +199,30 @@ def SearchGenomes(GenomeDatabase, args):
         if user_id is None:
             ErrorReport(GenomeDatabase.lastErrorMessage)
             return None
-    return_array = GenomeDatabase.SearchGenomes(args.name, args.description,
-                                                args.list_id, user_id)
+    metadata_fields = []
+    if args.fields:
+        metadata_fields = args.fields.split(",")
+    rows = GenomeDatabase.SearchGenomes(args.name, args.description, args.list_id, user_id,
+                                        metadata_fields, args.limit, args.after)
     
-    if not return_array:
+    if rows is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage)
         return None
 
-    format_str = "%12.12s %50.50s %15.15s %25.25s %50.50s"
-    print format_str % ("Tree ID","Name","Owner","Added","Description")
-    for (tree_id, name, username, date_added, description) in return_array:
-        print format_str % (tree_id, name, username, date_added, description)
+    format_str = "%12.12s %50.50s %15.15s %25.25s %50.50s" + " %30.30s" * len(metadata_fields)
+    row_count = 0
+    last_tree_id = None
+    for row in rows:
+        if row_count == 0:
+            print format_str % (("Tree ID","Name","Owner","Added","Description") + tuple(metadata_fields))
+        print format_str % tuple(['' if value is None else value for value in row])
+        row_count += 1
+        last_tree_id = row[0]
+    
+    if row_count == 0:
+        print "No Genomes Found"
+    elif args.limit is not None and row_count == args.limit:
+        ErrorReport("Showed %i genomes, use --after %s for the next page.\n" % (row_count, last_tree_id))
 
 def ShowGenome(GenomeDatabase, args):
     pass
@@ -202,18 +239,16 @@ def CreateGenomeList(GenomeDatabase, args):
         if genome_source is None:
             print GenomeDatabase.lastErrorMessage()
             return False
-    genome_list = list()
     
     fh = open(args.filename, 'rb')
-    for line in fh:
-        line = line.rstrip()
-        genome_id = GenomeDatabase.GetGenomeId(line, genome_source)
-        if genome_id:
-            genome_list.append(genome_id)
-        else:
-            ErrorReport("Unable to find genome: %s, ignoring\n" % (line,))
+    ids = [line.rstrip() for line in fh]
     fh.close()
     
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(ids, genome_source)
+    for missing_id in missing_ids:
+        ErrorReport("Unable to find genome: %s, ignoring\n" % (missing_id,))
+    genome_list = [genome_ids[x] for x in ids if x in genome_ids]
+    
     GenomeDatabase.CreateGenomeList(genome_list, args.name, args.description,
                                     GenomeDatabase.currentUser.getUserId(),
                                     not args.public)
@@ -225,8 +260,10 @@ def ModifyGenomeList(GenomeDatabase, args):
     if args.tree_ids:
         tree_ids_list = args.tree_ids.split(",")
         
-    genome_ids_list = [GenomeDatabase.GetGenomeId(x) for x in tree_ids_list
-                       if GenomeDatabase.GetGenomeId(x) is not None]
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(tree_ids_list)
+    for tree_id in missing_ids:
+        ErrorReport("Unable to find tree id: %s, ignoring\n" % (tree_id,))
+    genome_ids_list = [genome_ids[x] for x in tree_ids_list if x in genome_ids]
     
     ret_val = GenomeDatabase.ModifyGenomeList(args.list_id, args.name, args.description,
                                               genome_ids_list, args.operation, args.public)
@@ -242,22 +279,32 @@ def CloneGenomeList(GenomeDatabase, args):
         if genome_source is None:
             print GenomeDatabase.lastErrorMessage()
             return False
-    genome_list = list()
     
     fh = open(args.filename, 'rb')
-    for line in fh:
-        line = line.rstrip()
-        genome_id = GenomeDatabase.GetGenomeId(line, genome_source)
-        if genome_id:
-            genome_list.append(genome_id)
-        else:
-            ErrorReport("Unable to find genome: %s, ignoring\n" % (line,))
+    ids = [line.rstrip() for line in fh]
     fh.close()
     
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(ids, genome_source)
+    for missing_id in missing_ids:
+        ErrorReport("Unable to find genome: %s, ignoring\n" % (missing_id,))
+    genome_list = [genome_ids[x] for x in ids if x in genome_ids]
+    
     GenomeDatabase.CreateGenomeList(genome_list, args.name, args.description,
                                     GenomeDatabase.currentUser.getUserId(),
                                     not args.public)
 
+def CombineGenomeLists(GenomeDatabase, args):
+    result = GenomeDatabase.CombineGenomeLists(args.operation, args.list_ids.split(","),
+                                               args.name, args.description,
+                                               GenomeDatabase.currentUser.getUserId(),
+                                               not args.public)
+    if result is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage)
+        return False
+    (list_id, member_count) = result
+    print "Created genome list %s with %i genomes." % (list_id, member_count)
+    return True
+
 def DeleteGenomeList(GenomeDatabase, args):
     if not args.force:
         if GenomeDatabase.DeleteGenomeList(args.list_id, args.force):
@@ -269,12 +316,20 @@ def CreateTreeData(GenomeDatabase, args):
     list_ids = args.list_ids.split(",")
     genome_id_set = set()
     if args.tree_ids:
-        extra_ids = [GenomeDatabase.GetGenomeId(x) for x in args.tree_ids.split(",")]
-        genome_id_set = genome_id_set.union(set(extra_ids))
-    for list_id in list_ids:
-        temp_genome_list = GenomeDatabase.GetGenomeIdListFromGenomeListId(list_id)
-        if temp_genome_list:
-            genome_id_set = genome_id_set.union(set(temp_genome_list))
+        (extra_ids, missing_ids) = GenomeDatabase.GetGenomeIds(args.tree_ids.split(","))
+        for tree_id in missing_ids:
+            ErrorReport("Unable to find tree id: %s, ignoring\n" % (tree_id,))
+        genome_id_set = genome_id_set.union(set(extra_ids.values()))
+    result = GenomeDatabase.GetGenomeIdListFromGenomeListIds(list_ids)
+    if result is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage)
+        return False
+    (list_genome_ids, list_counts, missing_list_ids) = result
+    for list_id in missing_list_ids:
+        ErrorReport("No genome list with id: %s, ignoring\n" % (list_id,))
+    for (list_id, count) in sorted(list_counts.items()):
+        ErrorReport("Genome list %s: %i genomes\n" % (list_id, count))
+    genome_id_set = genome_id_set.union(set(list_genome_ids))
     core_lists = []
     if args.core_lists:
         if args.core_lists == 'both':
@@ -282,17 +337,40 @@ def CreateTreeData(GenomeDatabase, args):
         else:
             core_lists = [args.core_lists]
     if len(genome_id_set) > 0:
-        GenomeDatabase.MakeTreeData(core_lists, list(genome_id_set), args.profile, args.out_dir)
+        if GenomeDatabase.MakeTreeData(core_lists, list(genome_id_set), args.profile, args.out_dir,
+                                       max_gap_fraction=args.max_gap_fraction,
+                                       min_conservation=args.min_conservation,
+                                       max_conservation=args.max_conservation,
+                                       output_formats=args.formats.split(","),
+                                       compression=args.compression,
+                                       tree_builder=args.tree_builder) is None:
+            ErrorReport(GenomeDatabase.lastErrorMessage)
 
 def ShowAllGenomeLists(GenomeDatabase, args):
+    owner_id = None
     if args.self_owned:
-        genome_lists = GenomeDatabase.GetGenomeLists(GenomeDatabase.currentUser.getUserId())
-    else:
-        genome_lists = GenomeDatabase.GetGenomeLists()
-    
-    print "ID\tName\tOwner\tDesc\n"
-    for (list_id, name, description, user) in genome_lists:
-        print "\t".join((str(list_id), name, user, description)),"\n"
+        owner_id = GenomeDatabase.currentUser.getUserId()
+    genome_lists = GenomeDatabase.GetGenomeLists(owner_id, args.name, args.limit, args.after)
+    
+    row_count = 0
+    last_list_id = None
+    for (list_id, name, description, user, count) in genome_lists:
+        if row_count == 0:
+            print "ID\tName\tOwner\tGenomes\tDesc\n"
+        print "\t".join((str(list_id), name, user, str(count), description or '')),"\n"
+        row_count += 1
+        last_list_id = list_id
+    
+    if row_count == 0:
+        print "No Genome Lists Found"
+    elif args.limit is not None and row_count == args.limit:
+        ErrorReport("Showed %i genome lists, use --after %s for the next page.\n" % (row_count, last_list_id))
+
+def Serve(GenomeDatabase, args):
+    import genome_tree_service
+    service = genome_tree_service.QueryService(GenomeDatabase, args.cache_entries, args.cache_ttl,
+                                               args.export_root, args.session_ttl)
+    service.Serve(args.host, args.port)
 
 def CalculateMarkers(GenomeDatabase, args):
     tree_ids = list()
@@ -306,35 +384,71 @@ def CalculateMarkers(GenomeDatabase, args):
     else:
         ErrorReport("Need to specify one of --tree_ids or --filename.\n")
         return False
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(tree_ids)
+    for tree_id in missing_ids:
+        ErrorReport("Unable to find tree id: %s, ignoring\n" % (tree_id,))
     for tree_id in tree_ids:
-        genome_id = GenomeDatabase.GetGenomeId(tree_id)
-        GenomeDatabase.CalculateMarkersForGenome(genome_id)
+        if tree_id in genome_ids:
+            GenomeDatabase.CalculateMarkersForGenome(genome_ids[tree_id])
 
 def RecalculateAllMarkers(GenomeDatabase, args):
     if not GenomeDatabase.RecalculateAllMarkers():
         ErrorReport(GenomeDatabase.lastErrorMessage + "\n")
 
 def UpdateTaxonomies(GenomeDatabase, args):
-    tax_dict = dict()
+    def ReadTaxonomyFile(fh):
+        for line in fh:
+            splitline = line.strip().split('\t')
+            if len(splitline) >= 2:
+                yield (splitline[0], splitline[1])
     fh = open(args.taxonomy_file,'rb')
-    for line in fh:
-        splitline = line.strip().split('\t')
-        tax_dict[splitline[0]] = splitline[1]
-    if not GenomeDatabase.UpdateTaxonomies(tax_dict):
-        ErrorReport(GenomeDatabase.lastErrorMessage() + "\n")
+    result = GenomeDatabase.UpdateTaxonomies(ReadTaxonomyFile(fh))
+    fh.close()
+    if result is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage + "\n")
+        return False
+    (updated_count, unknown_tree_ids) = result
+    print "Updated the taxonomy of %i genomes." % (updated_count,)
+    if len(unknown_tree_ids) > 0:
+        ErrorReport("Warning: The following tree ids were not found in the database and have been ignored:\n%s\n" %
+                    ("\n".join(unknown_tree_ids),))
+    return True
+
+def ImportMetadata(GenomeDatabase, args):
+    def ReportProgress(merged_rows, total_rows):
+        ErrorReport("Merged %i of %i rows\n" % (merged_rows, total_rows))
+    fh = open(args.metadata_file, 'rb')
+    result = GenomeDatabase.ImportMetadata(fh, args.batch_size, ReportProgress)
+    fh.close()
+    if result is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage)
+        return False
+    (updated_count, unknown_tree_ids) = result
+    print "Updated the metadata of %i genomes." % (updated_count,)
+    if len(unknown_tree_ids) > 0:
+        ErrorReport("Warning: The following tree ids were not found in the database and have been ignored:\n%s\n" %
+                    ("\n".join(unknown_tree_ids),))
+    return True
 
 def UpdateCoreList(GenomeDatabase, args):
-    genome_ids = list()
-    for tree_id in args.tree_ids.split(","):
-        genome_id = GenomeDatabase.GetGenomeId(tree_id)
-        if not genome_id:
-            ErrorReport("Unable to find genome id for" + tree_id + "\n" + GenomeDatabase.lastErrorMessage + "\n")
-            return False
-        else:
-            genome_ids.append(genome_id)
-    if not GenomeDatabase.UpdateCoreList(genome_ids, args.operation):
+    (genome_ids, missing_ids) = GenomeDatabase.GetGenomeIds(args.tree_ids.split(","))
+    if len(missing_ids) > 0:
+        ErrorReport("Unable to find genome ids for: " + ", ".join(missing_ids) + "\n")
+        return False
+    if not GenomeDatabase.UpdateCoreList(genome_ids.values(), args.operation):
         ErrorReport(GenomeDatabase.lastErrorMessage() + "\n")
 
+def MigrateDatabase(GenomeDatabase, args):
+    applied = GenomeDatabase.MigrateDatabase()
+    if applied is None:
+        ErrorReport(GenomeDatabase.lastErrorMessage)
+        return False
+    if len(applied) == 0:
+        print "Database schema is up to date."
+    for name in applied:
+        print "Applied migration: " + name
+    return True
+
 def AddMarkers(GenomeDatabase, args):
     input_dict = dict()
     if args.batchfile is not None:
@@ -357,6 +471,18 @@ if __name__ == '__main__':
                         help='A File containing password for the user'),
     parser.add_argument('--dev', dest='dev', action='store_true',
                         help='Run in developer mode')
+    parser.add_argument('--profile-sql', dest='profile_sql', action='store_true',
+                        help='Print the time, row count and slowest statements of the SQL run by each backend call')
+    parser.add_argument('--profile-sql-json', dest='profile_sql_json',
+                        help='Write the SQL profile to this file as JSON (implies --profile-sql)')
+    parser.add_argument('--pipeline-metrics', dest='pipeline_metrics',
+                        help='Append the stage metrics of the marker pipelines to this file as JSON lines (- for stderr)')
+    parser.add_argument('--store-pipeline-metrics', dest='store_pipeline_metrics', action='store_true',
+                        help='Store the stage metrics of the marker pipelines in the pipeline_metrics table')
+    parser.add_argument('--dsn', dest='dsn',
+                        help='PostgreSQL connection string (default: $GENOME_TREE_DSN or the built in settings)')
+    parser.add_argument('--timing', dest='timing', action='store_true',
+                        help='Print the time taken by each start up phase and the command to stderr')
     
     subparsers = parser.add_subparsers(help='Sub-Command Help', dest='subparser_name')
     
@@ -464,6 +590,13 @@ if __name__ == '__main__':
     parser_searchgenome.add_argument('--owner', dest = 'owner', nargs='?', default='-1',
                                        help='Search for genomes owned by this username. ' +
                                       'With no parameter finds genomes owned by the current user')
+    parser_searchgenome.add_argument('--fields', dest = 'fields',
+                                       help='Also show these metadata fields (comma separated), either promoted ' +
+                                       'columns (taxonomy, greengenes_tax, core_list) or XML paths (e.g. internal/some_field)')
+    parser_searchgenome.add_argument('--limit', dest = 'limit', type=int,
+                                       help='Show at most this many genomes')
+    parser_searchgenome.add_argument('--after', dest = 'after',
+                                       help='Only show genomes after this tree id (for paging through results with --limit)')
     parser_searchgenome.set_defaults(func=SearchGenomes) 
     
 # --------- Show Genome Sources
@@ -521,6 +654,23 @@ if __name__ == '__main__':
     parser_clonegenomelist.set_defaults(func=CloneGenomeList)
 
 
+# --------- Combine Genome Lists
+
+    parser_combinegenomelists = subparsers.add_parser('CombineGenomeLists',
+                                        help='Create a genome list from the union, intersection or difference of genome lists')
+    parser_combinegenomelists.add_argument('--operation', dest = 'operation', required=True,
+                                       choices=('union', 'intersection', 'difference'),
+                                       help='How to combine the lists. The difference is the first list minus all of the others.')
+    parser_combinegenomelists.add_argument('--list_ids', dest = 'list_ids', required=True,
+                                       help='IDs of the genome lists to combine (comma separated)')
+    parser_combinegenomelists.add_argument('--name', dest = 'name',
+                                       required=True, help='Name of the new genome list')
+    parser_combinegenomelists.add_argument('--description', dest = 'description',
+                                       required=True, help='Brief description of the new genome list')
+    parser_combinegenomelists.add_argument('--public', dest = 'public', default=False,
+                                       action='store_true', help='Make the list visible to all users.')
+    parser_combinegenomelists.set_defaults(func=CombineGenomeLists)
+
 # --------- Delete A Genome List
 
     parser_deletegenomelist = subparsers.add_parser('DeleteGenomeList',
@@ -537,6 +687,12 @@ if __name__ == '__main__':
                                         help='Create a genome list from a list of accessions')
     parser_showallgenomelists.add_argument('--owned', dest = 'self_owned',  default=False,
                                         action='store_true', help='Only show genome lists owned by you.')
+    parser_showallgenomelists.add_argument('--name', dest = 'name',
+                                        help='Only show genome lists whose name contains this (case insensitive)')
+    parser_showallgenomelists.add_argument('--limit', dest = 'limit', type=int,
+                                        help='Show at most this many genome lists')
+    parser_showallgenomelists.add_argument('--after', dest = 'after', type=int,
+                                        help='Only show genome lists with an ID greater than this (for paging through results)')
     parser_showallgenomelists.set_defaults(func=ShowAllGenomeLists)
 
 # -------- Generate Tree Data
@@ -553,8 +709,40 @@ if __name__ == '__main__':
                                         required=True, help='Directory to output the files')
     parser_createtreedata.add_argument('--profile', dest = 'profile',
                                         help='Marker profile to use (default: %s)' % (profiles.ReturnDefaultProfileName(),))
+    parser_createtreedata.add_argument('--max_gap_fraction', dest = 'max_gap_fraction', type=float,
+                                        help='Drop alignment columns with a larger fraction of gaps than this (0-1).')
+    parser_createtreedata.add_argument('--min_conservation', dest = 'min_conservation', type=float,
+                                        help='Drop alignment columns where the most common residue is less frequent than this (0-1).')
+    parser_createtreedata.add_argument('--max_conservation', dest = 'max_conservation', type=float,
+                                        help='Drop alignment columns where the most common residue is more frequent than this (0-1).')
+    parser_createtreedata.add_argument('--formats', dest = 'formats', default='fasta,greengenes',
+                                        help='Output formats (comma separated) from fasta, greengenes, phylip ' +
+                                        '(relaxed) and packed (memory mappable binary). Default: fasta,greengenes')
+    parser_createtreedata.add_argument('--compress', dest = 'compression', choices=('gzip', 'zstd'),
+                                        help='Compress the text outputs while they are written.')
+    parser_createtreedata.add_argument('--tree_builder', dest = 'tree_builder',
+                                        help='Stream the alignment to this tree building command line over stdin ' +
+                                        'while it is generated, e.g. "FastTree -lg". The Newick tree is saved next to the outputs.')
     parser_createtreedata.set_defaults(func=CreateTreeData)
      
+# -------- Query Service
+
+    parser_serve = subparsers.add_parser('Serve',
+                                        help='Run a read only HTTP/JSON query service. Clients log in to it with their own accounts.')
+    parser_serve.add_argument('--host', dest = 'host', default='127.0.0.1',
+                              help='Address to listen on (default: 127.0.0.1)')
+    parser_serve.add_argument('--port', dest = 'port', type=int, default=8080,
+                              help='Port to listen on (default: 8080)')
+    parser_serve.add_argument('--cache_entries', dest = 'cache_entries', type=int,
+                              default=1024, help='Number of responses to cache, 0 to disable caching (default: 1024)')
+    parser_serve.add_argument('--cache_ttl', dest = 'cache_ttl', type=float,
+                              default=300.0, help='Seconds before a cached response expires (default: 300)')
+    parser_serve.add_argument('--session_ttl', dest = 'session_ttl', type=float,
+                              default=3600.0, help='Seconds of inactivity before a client session expires (default: 3600)')
+    parser_serve.add_argument('--export_root', dest = 'export_root',
+                              help='Directory below which /treedata may write tree data. Without it /treedata is disabled.')
+    parser_serve.set_defaults(func=Serve)
+
 # -------- Marker management subparsers
 
     parser_calculatemarkers = subparsers.add_parser('CalculateMarkers',
@@ -578,6 +766,18 @@ if __name__ == '__main__':
                                         required=True, help='File containing tree ids and taxonomies (tab separated)')
     parser_updatetaxonomies.set_defaults(func=UpdateTaxonomies)
 
+#--------- Metadata managements - ImportMetadata
+
+    parser_importmetadata = subparsers.add_parser('ImportMetadata',
+                                        help='Bulk import metadata fields for many genomes (root only)')
+    parser_importmetadata.add_argument('--file', dest = 'metadata_file', required=True,
+                                        help='Tab separated file with a header line of tree_id followed by the ' +
+                                        'field names (e.g. taxonomy or internal/greengenes/dereplicated/best_blast/greengenes_tax), ' +
+                                        'then one line per genome. Empty cells leave a field unchanged.')
+    parser_importmetadata.add_argument('--batch_size', dest = 'batch_size', type=int, default=10000,
+                                        help='Number of rows to merge per transaction (default: 10000)')
+    parser_importmetadata.set_defaults(func=ImportMetadata)
+
 #--------- Metadata managements - UpdateCoreList
 
     parser_calculatemarkers = subparsers.add_parser('UpdateCoreList',
@@ -588,6 +788,12 @@ if __name__ == '__main__':
                                          required=True,  help='Operation to perform')
     parser_calculatemarkers.set_defaults(func=UpdateCoreList)
 
+#--------- Database management - apply schema migrations
+
+    parser_migratedatabase = subparsers.add_parser('MigrateDatabase',
+                                 help='Apply any outstanding database schema migrations (root only)')
+    parser_migratedatabase.set_defaults(func=MigrateDatabase)
+
 #--------- Marker Management - add markers
 
     parser_addmarkers = subparsers.add_parser('AddMarkers', 
@@ -604,13 +810,26 @@ if __name__ == '__main__':
 
 
     args = parser.parse_args()
+    phases = [('imports', imports_time), ('argument parsing', time.time())]
     
     # Initialise the backend
-    GenomeDatabase = backend.GenomeDatabase()
+    import genome_tree_backend as backend
+    phases.append(('backend import', time.time()))
+    
+    GenomeDatabase = backend.GenomeDatabase(args.dsn)
+    sql_profiler = None
+    if args.profile_sql or args.profile_sql_json:
+        sql_profiler = GenomeDatabase.EnableSqlProfiling()
+    if args.pipeline_metrics == '-':
+        GenomeDatabase.pipelineMetricsFile = sys.stderr
+    elif args.pipeline_metrics:
+        GenomeDatabase.pipelineMetricsFile = open(args.pipeline_metrics, 'a')
+    GenomeDatabase.storePipelineMetrics = args.store_pipeline_metrics
     if args.dev:
         GenomeDatabase.MakePostgresConnection(10000)
     else:
         GenomeDatabase.MakePostgresConnection()
+    phases.append(('connection', time.time()))
         
     # Login
     
@@ -627,7 +846,17 @@ if __name__ == '__main__':
         ErrorReport("Database login failed. The following error was reported:\n" +
                     "\t" + GenomeDatabase.lastErrorMessage)
         sys.exit(-1)
-
-    args.func(GenomeDatabase, args)
+    phases.append(('login', time.time()))
+
+    try:
+        args.func(GenomeDatabase, args)
+    finally:
+        if args.timing:
+            phases.append(('command', time.time()))
+            TimingReport(phases)
+        if sql_profiler is not None:
+            sql_profiler.WriteReport(sys.stderr)
+            if args.profile_sql_json:
+                sql_profiler.WriteJson(args.profile_sql_json)
 
 
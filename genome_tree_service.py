@@ -0,0 +1,483 @@
+"""
+Long running, read only HTTP/JSON query service over a GenomeDatabase (the
+Serve command). Requests are handled in threads, each with its own pooled
+connection. Clients log in once per session with POST /login, a JSON body
+of {"username": ..., "password": ...}, and pass the returned token as an
+"Authorization: Bearer <token>" header; each request runs as the user of
+its session. Responses of the lookup endpoints are cached; cached responses are
+dropped when their tables change (via the notifications set up by migration
+0006_change_notifications) or after a fixed time to live.
+
+Endpoints (POST):
+    /login
+    /logout
+
+Endpoints (GET):
+    /genomes?name=&description=&list_id=&owner=&fields=&limit=&after=
+    /genomes/<tree_id>
+    /genomes/<tree_id>/fasta
+    /lists?name=&owner=&limit=&after=
+    /lists/<list_id>/genomes?fields=&limit=&after=
+    /treedata?out_dir=&tree_ids=&list_ids=&core_lists=&profile=&prefix=&formats=&compress=
+
+/treedata is only available when the service is given an export root. Its
+out_dir is a directory below the export root, and the tree data files are
+only ever written there.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import binascii
+import select
+import threading
+import traceback
+import urlparse
+from collections import OrderedDict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import psycopg2 as pg
+
+CHANGE_CHANNEL = 'genome_tree_changes'
+LISTEN_TIMEOUT = 5.0
+LISTEN_RECONNECT_DELAY = 5.0
+
+DEFAULT_CACHE_ENTRIES = 1024
+DEFAULT_CACHE_TTL = 300.0
+
+# Sessions expire after this many seconds without a request
+DEFAULT_SESSION_TTL = 3600.0
+SESSION_TOKEN_BYTES = 32
+# Largest request body accepted (the login credentials)
+MAX_BODY_LENGTH = 64 * 1024
+
+# The tables each cached endpoint reads from
+SEARCH_TABLES = ('genomes', 'users', 'genome_list_contents')
+GENOME_INFO_TABLES = ('genomes',)
+GENOME_LIST_TABLES = ('genome_lists', 'genome_list_contents', 'users')
+
+#--- Response Cache
+
+class ResponseCache(object):
+    """
+    Thread safe LRU cache of response bodies which expire after ttl seconds,
+    or when one of the tables they were read from changes.
+    """
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation, so that responses read before an
+        # invalidation aren't cached after it
+        self.generation = 0
+
+    def Get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            (expires, tables, body) = entry
+            if expires < time.time():
+                return None
+            # Move to the most recently used end
+            self.entries[key] = entry
+            return body
+
+    def Put(self, key, body, tables, generation):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, tables, body)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def Invalidate(self, table):
+        with self.lock:
+            self.generation += 1
+            for (key, (expires, tables, body)) in self.entries.items():
+                if table in tables:
+                    del self.entries[key]
+
+    def Clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+#--- Sessions
+
+class SessionStore(object):
+    """
+    Thread safe map of session tokens to the users who logged in with them.
+    A session expires after ttl seconds without being used.
+    """
+    def __init__(self, ttl=DEFAULT_SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def Create(self, user):
+        token = binascii.hexlify(os.urandom(SESSION_TOKEN_BYTES))
+        with self.lock:
+            self.sessions[token] = (time.time() + self.ttl, user)
+            self.RemoveExpired()
+        return token
+
+    def Get(self, token):
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None:
+                return None
+            (expires, user) = entry
+            if expires < time.time():
+                del self.sessions[token]
+                return None
+            self.sessions[token] = (time.time() + self.ttl, user)
+            return user
+
+    def Delete(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def RemoveExpired(self):
+        now = time.time()
+        for (token, (expires, user)) in self.sessions.items():
+            if expires < now:
+                del self.sessions[token]
+
+#--- Request Handling
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class QueryService(object):
+    def __init__(self, GenomeDatabase, cache_entries=DEFAULT_CACHE_ENTRIES,
+                 cache_ttl=DEFAULT_CACHE_TTL, export_root=None, session_ttl=DEFAULT_SESSION_TTL):
+        self.db = GenomeDatabase
+        self.sessions = SessionStore(session_ttl)
+        # Requests beyond the size of the connection pool wait for a
+        # connection instead of failing to check one out
+        self.slots = threading.BoundedSemaphore(GenomeDatabase.maxConnections)
+        self.export_root = None
+        if export_root is not None:
+            self.export_root = os.path.realpath(export_root)
+        self.cache = ResponseCache(cache_entries, cache_ttl)
+        self.routes = [(re.compile(r'^/genomes$'), self.SearchGenomes, SEARCH_TABLES),
+                       (re.compile(r'^/genomes/([^/]+)$'), self.GenomeInfo, GENOME_INFO_TABLES),
+                       (re.compile(r'^/genomes/([^/]+)/fasta$'), self.GenomeFasta, None),
+                       (re.compile(r'^/lists$'), self.GenomeLists, GENOME_LIST_TABLES),
+                       (re.compile(r'^/lists/(\d+)/genomes$'), self.GenomeListContents, SEARCH_TABLES),
+                       (re.compile(r'^/treedata$'), self.TreeData, None)]
+        self.post_routes = [(re.compile(r'^/login$'), self.Login),
+                            (re.compile(r'^/logout$'), self.Logout)]
+
+    def Serve(self, host, port):
+        # Hand the connection of the thread that logged in back to the pool,
+        # the requests are all run on the handler threads
+        self.db.ReleaseConnection()
+
+        listener = threading.Thread(target=self.ListenForChanges)
+        listener.daemon = True
+        listener.start()
+
+        server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+        server.service = self
+        sys.stderr.write("Serving on http://%s:%i/\n" % (host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+    def ListenForChanges(self):
+        """
+        Drops cached responses as the notifications of changed tables come
+        in. If the notification connection is lost, everything is dropped as
+        changes may have been missed.
+        """
+        while True:
+            try:
+                conn = pg.connect(self.db.connString)
+                conn.set_isolation_level(pg.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute("LISTEN " + CHANGE_CHANNEL)
+                while True:
+                    if select.select([conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.cache.Invalidate(notify.payload)
+            except pg.Error as e:
+                sys.stderr.write("Lost change notifications (%s), clearing the cache\n" % (str(e).strip(),))
+                self.cache.Clear()
+                time.sleep(LISTEN_RECONNECT_DELAY)
+
+    def SessionToken(self, handler):
+        authorization = handler.headers.getheader('Authorization', '')
+        if not authorization.startswith('Bearer '):
+            return None
+        return authorization[len('Bearer '):].strip()
+
+    def SessionUser(self, handler):
+        """
+        Returns the user of the session of the request, raising a
+        ServiceError if there is no valid session.
+        """
+        token = self.SessionToken(handler)
+        user = None
+        if token:
+            user = self.sessions.Get(token)
+        if user is None:
+            raise ServiceError(401, "Log in with POST /login and pass the token as 'Authorization: Bearer <token>'")
+        return user
+
+    def Run(self, user, func, *args):
+        """
+        Runs func (as user, if not None) once a pooled connection is free,
+        returning the connection to the pool when it is done.
+        """
+        with self.slots:
+            try:
+                if user is None:
+                    return func(*args)
+                with self.db.ActAs(user):
+                    return func(*args)
+            finally:
+                self.db.ReleaseConnection()
+
+    def Handle(self, handler):
+        url = urlparse.urlparse(handler.path)
+        params = dict([(key, values[-1]) for (key, values) in urlparse.parse_qs(url.query).items()])
+        for (regex, endpoint, tables) in self.routes:
+            match = regex.match(url.path)
+            if match is None:
+                continue
+            try:
+                user = self.SessionUser(handler)
+            except ServiceError as e:
+                handler.SendBody(e.status, 'application/json', json.dumps({'error' : str(e)}))
+                return
+            cache_key = None
+            generation = self.cache.generation
+            if tables is not None:
+                # What is visible depends on the user
+                cache_key = (str(user.getUserId()) + ':' + url.path + '?' +
+                             '&'.join(['%s=%s' % item for item in sorted(params.items())]))
+                body = self.cache.Get(cache_key)
+                if body is not None:
+                    handler.SendBody(200, 'application/json', body)
+                    return
+            try:
+                result = self.Run(user, endpoint, handler, params, *match.groups())
+            except Exception as e:
+                self.SendException(handler, e)
+                return
+            if result is None:
+                # Already streamed by the endpoint
+                return
+            body = json.dumps(result)
+            if cache_key is not None:
+                self.cache.Put(cache_key, body, tables, generation)
+            handler.SendBody(200, 'application/json', body)
+            return
+        handler.SendBody(404, 'application/json', json.dumps({'error' : 'Not found: ' + url.path}))
+
+    def HandlePost(self, handler):
+        url = urlparse.urlparse(handler.path)
+        for (regex, endpoint) in self.post_routes:
+            if regex.match(url.path) is None:
+                continue
+            try:
+                result = self.Run(None, endpoint, handler)
+            except Exception as e:
+                self.SendException(handler, e)
+                return
+            handler.SendBody(200, 'application/json', json.dumps(result))
+            return
+        handler.SendBody(404, 'application/json', json.dumps({'error' : 'Not found: ' + url.path}))
+
+    def SendException(self, handler, e):
+        """
+        Sends the error response for an exception raised while handling a
+        request: the status of a ServiceError, 400 for invalid input and 500
+        for anything else.
+        """
+        if isinstance(e, ServiceError):
+            (status, message) = (e.status, str(e))
+        elif isinstance(e, (ValueError, pg.DataError)):
+            (status, message) = (400, "Invalid request: " + str(e).strip())
+        elif isinstance(e, pg.Error):
+            (status, message) = (500, str(e).strip())
+        else:
+            traceback.print_exc()
+            (status, message) = (500, "Internal error")
+        if handler.response_started:
+            # Part of a streamed response has already been sent, so all that
+            # can be done is to cut it short
+            handler.close_connection = 1
+            return
+        handler.SendBody(status, 'application/json', json.dumps({'error' : message}))
+
+    def CheckResult(self, result):
+        if result is None:
+            raise ServiceError(400, (self.db.lastErrorMessage or 'Request failed').strip())
+        return result
+
+    def IntParam(self, params, name):
+        if params.get(name) is None:
+            return None
+        try:
+            return int(params[name])
+        except ValueError:
+            raise ServiceError(400, "%s must be an integer" % (name,))
+
+    def OwnerParam(self, params):
+        if params.get('owner') is None:
+            return None
+        return self.CheckResult(self.db.GetUserIdFromUsername(params['owner']))
+
+    def FindGenome(self, tree_id):
+        (found, missing) = self.db.GetGenomeIds([tree_id])
+        if tree_id not in found:
+            raise ServiceError(404, "Unable to find tree id: " + tree_id)
+        return found[tree_id]
+
+    def ExportPath(self, out_dir):
+        """
+        Returns the absolute path of out_dir, a directory relative to the
+        export root. Raises a ServiceError if it resolves to anywhere outside
+        of the export root.
+        """
+        if not out_dir:
+            raise ServiceError(400, "out_dir is required")
+        path = os.path.realpath(os.path.join(self.export_root, out_dir))
+        if path != self.export_root and not path.startswith(self.export_root + os.sep):
+            raise ServiceError(403, "out_dir must be inside the export root")
+        return path
+
+#-------- Endpoints
+
+    def Login(self, handler):
+        length = int(handler.headers.getheader('Content-Length') or 0)
+        if length > MAX_BODY_LENGTH:
+            raise ServiceError(413, "Request body too large")
+        try:
+            credentials = json.loads(handler.rfile.read(length))
+            username = credentials['username']
+            password = credentials['password']
+        except (ValueError, TypeError, KeyError):
+            raise ServiceError(400, "The body must be a JSON object with a username and a password")
+        if not isinstance(username, basestring) or not isinstance(password, basestring):
+            raise ServiceError(400, "The username and password must be strings")
+        user = self.db.AuthenticateUser(username.encode('utf-8'), password.encode('utf-8'))
+        if user is None:
+            raise ServiceError(401, "Login failed")
+        return {'token' : self.sessions.Create(user)}
+
+    def Logout(self, handler):
+        token = self.SessionToken(handler)
+        if token:
+            self.sessions.Delete(token)
+        return {}
+
+    def SearchGenomes(self, handler, params, list_id=None):
+        fields = []
+        if params.get('fields'):
+            fields = params['fields'].split(",")
+        if list_id is None:
+            list_id = self.IntParam(params, 'list_id')
+        rows = self.CheckResult(self.db.SearchGenomes(params.get('name'), params.get('description'),
+                                                      list_id, self.OwnerParam(params), fields,
+                                                      self.IntParam(params, 'limit'), params.get('after')))
+        columns = ['tree_id', 'name', 'owner', 'date_added', 'description'] + fields
+        return [dict(zip(columns, row)) for row in rows]
+
+    def GenomeInfo(self, handler, params, tree_id):
+        (tree_id, name, description, owner_id) = self.CheckResult(self.db.GetGenomeInfo(self.FindGenome(tree_id)))
+        return {'tree_id' : tree_id,
+                'name' : name,
+                'description' : description,
+                'owner_id' : owner_id}
+
+    def GenomeFasta(self, handler, params, tree_id):
+        chunks = self.db.IterGenomicFasta(self.FindGenome(tree_id))
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/plain')
+        handler.end_headers()
+        for chunk in chunks:
+            handler.wfile.write(chunk)
+        return None
+
+    def GenomeLists(self, handler, params):
+        rows = self.db.GetGenomeLists(self.OwnerParam(params), params.get('name'),
+                                      self.IntParam(params, 'limit'), self.IntParam(params, 'after'))
+        columns = ['list_id', 'name', 'description', 'owner', 'genome_count']
+        return [dict(zip(columns, row)) for row in rows]
+
+    def GenomeListContents(self, handler, params, list_id):
+        return self.SearchGenomes(handler, params, int(list_id))
+
+    def TreeData(self, handler, params):
+        if self.export_root is None:
+            raise ServiceError(403, "Tree data export is not enabled on this service")
+        out_dir = self.ExportPath(params.get('out_dir'))
+        prefix = params.get('prefix')
+        if prefix is not None:
+            if prefix == '' or '/' in prefix or os.sep in prefix or (os.altsep and os.altsep in prefix):
+                raise ServiceError(400, "prefix must be a file name prefix, without directories")
+        genome_ids = set()
+        if params.get('tree_ids'):
+            (found, missing) = self.db.GetGenomeIds(params['tree_ids'].split(","))
+            if missing:
+                raise ServiceError(404, "Unable to find tree ids: " + ", ".join(missing))
+            genome_ids.update(found.values())
+        if params.get('list_ids'):
+            (list_genome_ids, list_counts, missing_list_ids) = self.CheckResult(
+                self.db.GetGenomeIdListFromGenomeListIds(params['list_ids'].split(",")))
+            if missing_list_ids:
+                raise ServiceError(404, "No genome lists with ids: " + ", ".join([str(x) for x in missing_list_ids]))
+            genome_ids.update(list_genome_ids)
+        core_lists = []
+        if params.get('core_lists') == 'both':
+            core_lists = ['public', 'private']
+        elif params.get('core_lists'):
+            core_lists = [params['core_lists']]
+        if len(genome_ids) == 0 and len(core_lists) == 0:
+            raise ServiceError(400, "No genomes specified")
+        self.CheckResult(self.db.MakeTreeData(core_lists, list(genome_ids), params.get('profile'),
+                                              out_dir, prefix,
+                                              output_formats=params.get('formats', 'fasta,greengenes').split(","),
+                                              compression=params.get('compress')))
+        return {'out_dir' : params['out_dir']}
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    response_started = False
+
+    def send_response(self, code, message=None):
+        self.response_started = True
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def do_GET(self):
+        self.server.service.Handle(self)
+
+    def do_POST(self):
+        self.server.service.HandlePost(self)
+
+    def SendBody(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,16 @@
+"""
+Monkey patching for the cooperative API (genome_tree_async.py). This module
+imports nothing at import time, so it can be imported and PatchForGevent()
+called at the very start of the program, before anything else is imported:
+
+    import gevent_patch
+    gevent_patch.PatchForGevent()
+
+    import genome_tree_async
+"""
+
+def PatchForGevent():
+    from gevent import monkey
+    monkey.patch_all()
+    import psycogreen.gevent
+    psycogreen.gevent.patch_psycopg()
@@ -0,0 +1,163 @@
+"""
+Stage level timing and resource accounting for the marker finding pipelines
+(FindMarkersEmboss and FindMarkersMetachecker). Each stage records its wall
+time, CPU time of this process and of its finished subprocesses, the number
+of subprocesses it ran, the sizes of the files it read and wrote, and the
+peak RSS of this process and of its largest subprocess during the stage.
+
+The peak RSS of this process is measured by resetting and reading the high
+water mark in /proc/self (Linux only, otherwise None). The peak RSS of
+subprocesses is only known for those run with Stage.Call, it is None for
+stages whose subprocesses are run by other libraries.
+"""
+
+import os
+import json
+import time
+import socket
+import resource
+import subprocess
+
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+def ResetPeakRss():
+    """
+    Resets the peak RSS of this process to its current RSS. Returns False
+    if that isn't supported.
+    """
+    try:
+        fh = open(PROC_CLEAR_REFS, 'w')
+        try:
+            fh.write('5')
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+def ReadPeakRss():
+    """
+    Returns the peak RSS of this process in kB since the last ResetPeakRss,
+    or None if it isn't available.
+    """
+    try:
+        fh = open(PROC_STATUS)
+        try:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        finally:
+            fh.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def MaxKb(current, value):
+    if current is None:
+        return value
+    return max(current, value)
+
+class Stage(object):
+    """
+    Context manager accumulating the metrics of one pipeline stage. A stage
+    can be entered any number of times (e.g. once per marker) and the
+    metrics are summed.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.child_cpu_seconds = 0.0
+        self.subprocesses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss_kb = None
+        self.child_peak_rss_kb = None
+
+    def __enter__(self):
+        self.peak_rss_available = ResetPeakRss()
+        self.start_wall = time.time()
+        self.start_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.wall_seconds += time.time() - self.start_wall
+        self.cpu_seconds += ((end_self.ru_utime + end_self.ru_stime) -
+                             (self.start_self.ru_utime + self.start_self.ru_stime))
+        self.child_cpu_seconds += ((end_children.ru_utime + end_children.ru_stime) -
+                                   (self.start_children.ru_utime + self.start_children.ru_stime))
+        if self.peak_rss_available:
+            peak_rss_kb = ReadPeakRss()
+            if peak_rss_kb is not None:
+                self.peak_rss_kb = MaxKb(self.peak_rss_kb, peak_rss_kb)
+        return False
+
+    def Call(self, args):
+        """
+        Runs a subprocess to completion, counting it and recording its peak
+        RSS. Returns its exit status, like subprocess.call.
+        """
+        process = subprocess.Popen(args)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self.subprocesses += 1
+        self.child_peak_rss_kb = MaxKb(self.child_peak_rss_kb, usage.ru_maxrss)
+        return process.returncode
+
+    def Subprocess(self, count=1):
+        self.subprocesses += count
+
+    def Read(self, path):
+        if os.path.exists(path):
+            self.bytes_read += os.path.getsize(path)
+
+    def Wrote(self, path):
+        if os.path.exists(path):
+            self.bytes_written += os.path.getsize(path)
+
+class GenomeMetrics(object):
+    """
+    The stages of one run of a marker pipeline over one genome.
+    """
+    def __init__(self, pipeline, marker_database_name, version, genome_id=None):
+        self.pipeline = pipeline
+        self.marker_database_name = marker_database_name
+        self.version = version
+        self.genome_id = genome_id
+        self.stages = []
+
+    def Stage(self, name):
+        stage = Stage(name)
+        self.stages.append(stage)
+        return stage
+
+    def Records(self):
+        host = socket.gethostname()
+        recorded = time.time()
+        return [{'recorded' : recorded,
+                 'host' : host,
+                 'genome_id' : self.genome_id,
+                 'pipeline' : self.pipeline,
+                 'marker_database' : self.marker_database_name,
+                 'version' : self.version,
+                 'stage' : stage.name,
+                 'wall_seconds' : stage.wall_seconds,
+                 'cpu_seconds' : stage.cpu_seconds,
+                 'child_cpu_seconds' : stage.child_cpu_seconds,
+                 'subprocesses' : stage.subprocesses,
+                 'bytes_read' : stage.bytes_read,
+                 'bytes_written' : stage.bytes_written,
+                 'peak_rss_kb' : stage.peak_rss_kb,
+                 'child_peak_rss_kb' : stage.child_peak_rss_kb} for stage in self.stages]
+
+def WriteJsonLines(fh, records):
+    for record in records:
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+    fh.flush()
@@ -1,75 +1,57 @@
 import os
-import psycopg2 as pg
+
+import tree_data
 
 def MakeTreeData(GenomeDatabase, list_of_genome_ids, directory, prefix=None, **kwargs):
-    """
-    TODO - This function is ugly, it needs to be cleaned up.
-    """
     if not os.path.isdir(directory):
         GenomeDatabase.ReportError("Directory doesn't exist: " + directory)
         return None
-    
-    cur = GenomeDatabase.conn.cursor()
-    
-    # For all of the markers, get the expected marker size.
-    aligned_markers = dict()
-    cur.execute("SELECT markers.id, database_specific_id, size " +
-                "FROM markers, databases " +
-                "WHERE database_id = databases.id " +
-                "AND databases.name = 'Phylosift' " +
-                "AND markers.version = '2' " +
-                "ORDER by database_specific_id")
-    
-    chosen_markers = list()
-    for marker_id, phylosift_id, size in cur:
-        chosen_markers.append((marker_id, phylosift_id, size))
 
-    cur.execute("SELECT tree_id, genome_id, marker_id, sequence, genomes.name "+
-                "FROM aligned_markers, genomes, databases, markers " +
-                "WHERE database_id = databases.id " +
-                "AND genomes.id = genome_id " +
-                "AND markers.id = marker_id " +
-                "AND databases.name = 'Phylosift' " +
-                "AND markers.version = '2' " +
-                "AND dna is false")
-    
-    for tree_id, genome_id, marker_id, sequence, name in cur:
-        if (genome_id in list_of_genome_ids):
-            if genome_id not in aligned_markers:
-                aligned_markers[genome_id] = dict()
-                aligned_markers[genome_id]['markers']    = dict()
-                aligned_markers[genome_id]['name']  = name
-                aligned_markers[genome_id]['tree_id']  = tree_id
-            aligned_markers[genome_id]['markers'][marker_id] = sequence
-            #For all the fields, replace None type with "".
-            aligned_markers[genome_id] = dict(map((lambda (k, v): (k, "") if v is None else (k, v)),
-                                                aligned_markers[genome_id].items()))
+    for option in ('max_gap_fraction', 'min_conservation', 'max_conservation'):
+        if kwargs.get(option) is not None:
+            GenomeDatabase.ReportError("Column filtering is not supported by the Phylosift_PMPROK_Individual profile")
+            return None
+
+    output_formats = kwargs.get('output_formats', tree_data.DEFAULT_OUTPUT_FORMATS)
+    compression = kwargs.get('compression')
+    error = tree_data.CheckOutputOptions(output_formats, compression)
+    if error is None and set(output_formats) != set(tree_data.DEFAULT_OUTPUT_FORMATS):
+        error = "The Phylosift_PMPROK_Individual profile only writes fasta and greengenes outputs"
+    if error is None and kwargs.get('tree_builder') is not None:
+        error = "The Phylosift_PMPROK_Individual profile cannot be streamed to a tree builder"
+    if error is not None:
+        GenomeDatabase.ReportError(error)
+        return None
+
+    with GenomeDatabase.Cursor() as cur:
+        chosen_markers = tree_data.GetChosenMarkers(cur, 'Phylosift', '2')
 
     if prefix is None:
         prefix = "Phylosift_PMPROK_Individual"
-    gg_fh = open(os.path.join(directory, prefix + ".greengenes"), 'wb')
-    
+
+    # One output file per marker, each written to as the genome records stream in.
+    fasta_fhs = dict()
     for marker_id, phylosift_id, size in chosen_markers:
-        fasta_fh = open(os.path.join(directory, prefix + "_" + phylosift_id + ".fasta"), 'wb')
-        for genome_id in aligned_markers.keys():
-            if marker_id in aligned_markers[genome_id]['markers']:
-                fasta_outstr = ">%s\n%s\n" % (aligned_markers[genome_id]['tree_id'],
-                                              aligned_markers[genome_id]['markers'][marker_id])
-                fasta_fh.write(fasta_outstr)
-        fasta_fh.close()
-        
-    for genome_id in aligned_markers.keys():  
-        gg_list = ["BEGIN",
-                   "db_name=%s" % aligned_markers[genome_id]['tree_id'],
-                   "organism=%s" % aligned_markers[genome_id]['name'],
-                   "prokMSA_id=%s" % (aligned_markers[genome_id]['tree_id']),
-                   "warning=",
-                   "aligned_seq=",
-                   "END"]   
-        gg_outstr = "\n".join(gg_list) + "\n\n";
-        gg_fh.write(gg_outstr);
-    
-    gg_fh.close()
-    fasta_fh.close()
-    
-    return True
\ No newline at end of file
+        fasta_fhs[marker_id] = tree_data.OpenOutput(os.path.join(directory, prefix + "_" + phylosift_id + ".fasta"),
+                                                    compression)
+    gg_fh = tree_data.OpenOutput(os.path.join(directory, prefix + ".greengenes"), compression)
+
+    try:
+        for record in tree_data.IterGenomeRecords(GenomeDatabase, list_of_genome_ids,
+                                                  'Phylosift', '2'):
+            for (marker_id, sequence) in record['markers'].items():
+                if marker_id in fasta_fhs:
+                    fasta_fhs[marker_id].write(tree_data.FormatFastaRecord(record['tree_id'],
+                                                                           sequence))
+            gg_list = ["db_name=%s" % record['tree_id'],
+                       "organism=%s" % record['name'],
+                       "prokMSA_id=%s" % (record['tree_id']),
+                       "warning=",
+                       "aligned_seq="]
+            gg_fh.write(tree_data.FormatGreengenesRecord(gg_list))
+    finally:
+        gg_fh.close()
+        for fasta_fh in fasta_fhs.values():
+            fasta_fh.close()
+
+    return True
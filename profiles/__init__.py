@@ -1,10 +1,20 @@
-import Phylosift_PMPROK
-import Phylosift_PMPROK_Individual
-import pmid22170421
+import importlib
 
-profiles = {"Phylosift_PMPROK" : Phylosift_PMPROK,
-            "Phylosift_PMPROK_Individual" : Phylosift_PMPROK_Individual,
-            "111_genes" : pmid22170421}
+# Profile name -> the module implementing it. The modules are only imported
+# when a profile is used, see LoadProfile.
+profile_modules = {"Phylosift_PMPROK" : "Phylosift_PMPROK",
+                   "Phylosift_PMPROK_Individual" : "Phylosift_PMPROK_Individual",
+                   "111_genes" : "pmid22170421"}
+
+def ReturnKnownProfileNames():
+    return profile_modules.keys()
+
+def LoadProfile(name):
+    """
+    Returns the module implementing the named profile, importing it on
+    first use.
+    """
+    return importlib.import_module(__name__ + "." + profile_modules[name])
 
 def ReturnDefaultProfileName():
     return "Phylosift_PMPROK"
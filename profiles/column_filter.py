@@ -0,0 +1,121 @@
+import numpy as np
+
+# Residues are counted in a reduced alphabet: gaps, the 26 letters (case
+# insensitive) and everything else.
+GAP_CODE = 0
+OTHER_CODE = 27
+ALPHABET_SIZE = 28
+
+_code_table = np.empty(256, dtype=np.uint8)
+_code_table.fill(OTHER_CODE)
+for _i, _c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+    _code_table[ord(_c)] = _i + 1
+    _code_table[ord(_c.lower())] = _i + 1
+for _c in '-.':
+    _code_table[ord(_c)] = GAP_CODE
+
+class ColumnFilter(object):
+    """
+    Accumulates per-column gap fraction and conservation of a concatenated
+    alignment, one sequence at a time, and then drops the columns which fall
+    outside the specified thresholds.
+
+    Conservation is the frequency of the most common residue in a column
+    amongst the non-gap residues of that column.
+
+    Usage is two passes over the alignment: Observe() every sequence, call
+    Finalise() and then Apply() the filter to every sequence.
+    """
+    def __init__(self, chosen_markers, max_gap_fraction=None, min_conservation=None,
+                 max_conservation=None, chunk_size=64):
+        self.chosen_markers = chosen_markers
+        self.max_gap_fraction = max_gap_fraction
+        self.min_conservation = min_conservation
+        self.max_conservation = max_conservation
+        self.width = sum([size for (marker_id, database_specific_id, size) in chosen_markers])
+
+        self.counts = np.zeros((ALPHABET_SIZE, self.width), dtype=np.int64)
+        self.row_count = 0
+        self.chunk = np.empty((chunk_size, self.width), dtype=np.uint8)
+        self.chunk_fill = 0
+        # Offsets into the flattened (code, column) count matrix for bincount
+        self.column_offsets = np.arange(self.width, dtype=np.intp)
+
+        self.gap_fraction = None
+        self.conservation = None
+        self.keep = None
+        self.kept_columns = None
+
+    def Observe(self, aligned_seq):
+        if len(aligned_seq) != self.width:
+            raise ValueError("Aligned sequence has %i columns, expected %i" %
+                             (len(aligned_seq), self.width))
+        self.chunk[self.chunk_fill] = np.frombuffer(aligned_seq, dtype=np.uint8)
+        self.chunk_fill += 1
+        if self.chunk_fill == self.chunk.shape[0]:
+            self._FlushChunk()
+
+    def _FlushChunk(self):
+        if self.chunk_fill == 0:
+            return
+        codes = _code_table[self.chunk[:self.chunk_fill]].astype(np.intp)
+        flat_index = (codes * self.width + self.column_offsets).ravel()
+        self.counts += np.bincount(flat_index,
+                                   minlength=ALPHABET_SIZE * self.width).reshape(ALPHABET_SIZE, self.width)
+        self.row_count += self.chunk_fill
+        self.chunk_fill = 0
+
+    def Finalise(self):
+        """
+        Computes the column statistics and the columns to keep. Returns the
+        number of columns kept.
+        """
+        self._FlushChunk()
+        self.chunk = None
+
+        gap_counts = self.counts[GAP_CODE].astype(np.float64)
+        residue_counts = self.counts[1:]
+        non_gap_counts = residue_counts.sum(axis=0).astype(np.float64)
+
+        self.gap_fraction = gap_counts / max(self.row_count, 1)
+        self.conservation = np.where(non_gap_counts > 0,
+                                     residue_counts.max(axis=0) / np.maximum(non_gap_counts, 1),
+                                     0.0)
+
+        keep = np.ones(self.width, dtype=bool)
+        if self.max_gap_fraction is not None:
+            keep &= self.gap_fraction <= self.max_gap_fraction
+        if self.min_conservation is not None:
+            keep &= self.conservation >= self.min_conservation
+        if self.max_conservation is not None:
+            keep &= self.conservation <= self.max_conservation
+        self.keep = keep
+        self.kept_columns = np.flatnonzero(keep)
+
+        return len(self.kept_columns)
+
+    def Apply(self, aligned_seq):
+        return np.frombuffer(aligned_seq, dtype=np.uint8)[self.kept_columns].tobytes()
+
+    def WriteColumnMap(self, fh):
+        """
+        Writes a tab separated map of every original alignment column to its
+        marker, its position within that marker, its statistics and its
+        position in the filtered alignment (or - if it was dropped).
+        """
+        fh.write("column\tmarker\tmarker_position\tgap_fraction\tconservation\tfiltered_column\n")
+        column = 0
+        filtered_column = 0
+        for (marker_id, database_specific_id, size) in self.chosen_markers:
+            for marker_position in range(size):
+                if self.keep[column]:
+                    filtered_str = str(filtered_column + 1)
+                    filtered_column += 1
+                else:
+                    filtered_str = '-'
+                fh.write("%i\t%s\t%i\t%.4f\t%.4f\t%s\n" % (column + 1, database_specific_id,
+                                                           marker_position + 1,
+                                                           self.gap_fraction[column],
+                                                           self.conservation[column],
+                                                           filtered_str))
+                column += 1
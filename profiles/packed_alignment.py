@@ -0,0 +1,67 @@
+import struct
+
+# Packed alignment layout: a fixed size header followed by one row of
+# exactly ncols bytes (one ASCII residue per byte) for each genome. Rows are
+# fixed width so the file can be memory mapped as an (nrows, ncols) matrix.
+# The accompanying index file maps row numbers to tree ids.
+MAGIC = 'GTALN001'
+HEADER_FORMAT = '<8sQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+class PackedAlignmentWriter(object):
+    """
+    Writes the concatenated alignment of each genome record as a row of the
+    packed binary alignment (.aln) and its row index (.aln.idx).
+    """
+    def __init__(self, path, ncols):
+        self.ncols = ncols
+        self.nrows = 0
+        self.fh = open(path, 'wb')
+        self.idx_fh = open(path + '.idx', 'wb')
+        # The row count is filled in on Close()
+        self.fh.write(struct.pack(HEADER_FORMAT, MAGIC, 0, ncols))
+
+    def Write(self, record, aligned_seq):
+        if len(aligned_seq) != self.ncols:
+            raise ValueError("Aligned sequence of %s has %i columns, expected %i" %
+                             (record['tree_id'], len(aligned_seq), self.ncols))
+        self.fh.write(aligned_seq)
+        self.idx_fh.write("%i\t%s\t%i\n" % (self.nrows, record['tree_id'],
+                                            HEADER_SIZE + self.nrows * self.ncols))
+        self.nrows += 1
+
+    def Close(self):
+        self.fh.seek(0)
+        self.fh.write(struct.pack(HEADER_FORMAT, MAGIC, self.nrows, self.ncols))
+        self.fh.close()
+        self.idx_fh.close()
+
+def LoadPackedAlignment(path):
+    """
+    Memory maps a packed alignment written by PackedAlignmentWriter. Returns a
+    (tree_ids, alignment) tuple where alignment is a read only numpy uint8
+    matrix with one row per tree id.
+    """
+    import numpy as np
+
+    fh = open(path, 'rb')
+    try:
+        (magic, nrows, ncols) = struct.unpack(HEADER_FORMAT, fh.read(HEADER_SIZE))
+    finally:
+        fh.close()
+    if magic != MAGIC:
+        raise ValueError("Not a packed alignment file: " + path)
+
+    tree_ids = []
+    idx_fh = open(path + '.idx', 'rb')
+    try:
+        for line in idx_fh:
+            tree_ids.append(line.split('\t')[1])
+    finally:
+        idx_fh.close()
+
+    if nrows == 0:
+        return (tree_ids, np.zeros((0, ncols), dtype=np.uint8))
+    alignment = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                          shape=(nrows, ncols))
+    return (tree_ids, alignment)
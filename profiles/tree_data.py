@@ -0,0 +1,424 @@
+import os
+import sys
+import gzip
+import shlex
+import subprocess
+
+import packed_alignment
+
+# Number of genome records pulled from the server per round trip. Each record
+# carries all of a genome's aligned markers, so this (and not the number of
+# requested genomes) bounds how much is held in memory at once.
+RECORD_FETCH_SIZE = 256
+
+OUTPUT_FORMATS = ('fasta', 'greengenes', 'phylip', 'packed')
+DEFAULT_OUTPUT_FORMATS = ('fasta', 'greengenes')
+COMPRESSION_TYPES = ('gzip', 'zstd')
+
+def GetChosenMarkers(cur, database_name, version):
+    """
+    Returns a list of (marker_id, database_specific_id, size) tuples for
+    every marker of the specified marker database, in output order.
+    """
+    cur.execute("SELECT markers.id, database_specific_id, size " +
+                "FROM markers, databases " +
+                "WHERE database_id = databases.id " +
+                "AND databases.name = %s " +
+                "AND markers.version = %s " +
+                "ORDER by database_specific_id", (database_name, version))
+    return cur.fetchall()
+
+def CountGenomeRecords(GenomeDatabase, list_of_genome_ids, database_name, version):
+    """
+    Returns the number of the specified genomes that have markers for the
+    specified marker database, i.e. the number of records IterGenomeRecords
+    will yield. Uses the same joins as IterGenomeRecords so the two agree.
+    """
+    with GenomeDatabase.Cursor() as cur:
+        cur.execute("SELECT count(DISTINCT genomes.id) " +
+                    "FROM aligned_markers, genomes, users, databases, markers " +
+                    "WHERE genomes.id = genome_id " +
+                    "AND users.id = owner_id " +
+                    "AND genome_id = ANY(%s) " +
+                    "AND marker_id = markers.id " +
+                    "AND database_id = databases.id " +
+                    "AND databases.name = %s " +
+                    "AND markers.version = %s " +
+                    "AND dna is false", (list(set(list_of_genome_ids)), database_name, version))
+        (count,) = cur.fetchone()
+    return count
+
+def IterGenomeRecords(GenomeDatabase, list_of_genome_ids, database_name, version,
+                      fetch_size=RECORD_FETCH_SIZE, report_missing=True):
+    """
+    Generator yielding one record (a dict) per genome with all of its aligned
+    markers for the specified marker database. Records are read through a
+    server side cursor with one row per genome, so each one can be written out
+    as soon as it arrives. Genomes without any markers are reported on stderr.
+    """
+    requested_ids = set(list_of_genome_ids)
+    seen_ids = set()
+
+    with GenomeDatabase.Cursor("tree_data_records") as cur:
+        cur.itersize = fetch_size
+        cur.execute("SELECT genomes.id, tree_id, genomes.name, username, " +
+                           "core_list, taxonomy, greengenes_tax, " +
+                           "array_agg(marker_id), array_agg(sequence) " +
+                    "FROM aligned_markers, genomes, users, databases, markers " +
+                    "WHERE genomes.id = genome_id " +
+                    "AND users.id = owner_id " +
+                    "AND genome_id = ANY(%s) " +
+                    "AND marker_id = markers.id " +
+                    "AND database_id = databases.id " +
+                    "AND databases.name = %s " +
+                    "AND markers.version = %s " +
+                    "AND dna is false " +
+                    "GROUP BY genomes.id, username " +
+                    "ORDER BY genomes.id", (list(requested_ids), database_name, version))
+
+        for row in cur:
+            seen_ids.add(row[0])
+            yield MakeGenomeRecord(row)
+
+    if not report_missing:
+        return
+    for genome_id in requested_ids - seen_ids:
+        sys.stderr.write("WARNING: Genome id %s has no markers in the database and will be missing from the output files.\n" % genome_id)
+
+def MakeGenomeRecord(row):
+    """
+    Returns the record (a dict) of a row of the IterGenomeRecords query.
+    """
+    (genome_id, tree_id, name, owner, core_list, taxonomy, greengenes_tax,
+     marker_ids, sequences) = row
+    #For all the fields, replace None type with "".
+    return {'genome_id' : genome_id,
+            'tree_id'   : tree_id or "",
+            'name'      : name or "",
+            'owner'     : owner or "",
+            'core_list' : core_list or "",
+            'taxonomy'  : taxonomy or "",
+            'greengenes_tax' : greengenes_tax or "",
+            'markers'   : dict(zip(marker_ids, sequences))}
+
+def ConcatenateMarkers(record, chosen_markers):
+    """
+    Returns the concatenated alignment of a genome record, padding markers
+    missing from the genome with gaps.
+    """
+    aligned_seq = []
+    for marker_id, database_specific_id, size in chosen_markers:
+        if marker_id in record['markers']:
+            aligned_seq.append(record['markers'][marker_id])
+        else:
+            aligned_seq.append(size * '-')
+    return ''.join(aligned_seq)
+
+def GetMetadataFields(record):
+    """
+    Returns a (greengenes_tax, internal_tax, core_list_status) tuple from the
+    metadata of a genome record.
+    """
+    return (record['greengenes_tax'], record['taxonomy'], record['core_list'])
+
+def FormatFastaRecord(tree_id, aligned_seq):
+    return ">%s\n%s\n" % (tree_id, aligned_seq)
+
+def FormatGreengenesRecord(gg_list):
+    return "\n".join(["BEGIN"] + gg_list + ["END"]) + "\n\n"
+
+#--- Output files
+
+class ZstdFile(object):
+    """
+    Minimal write only file object compressing to a zstd frame.
+    """
+    def __init__(self, path):
+        import zstandard
+        self.fh = open(path, 'wb')
+        self.compressor = zstandard.ZstdCompressor().compressobj()
+
+    def write(self, data):
+        self.fh.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fh.write(self.compressor.flush())
+        self.fh.close()
+
+def OpenOutput(path, compression=None):
+    """
+    Opens an output file for writing, compressing it on the fly if
+    compression is 'gzip' or 'zstd' (in which case .gz or .zst is appended
+    to the path).
+    """
+    if compression is None:
+        return open(path, 'wb')
+    elif compression == 'gzip':
+        return gzip.open(path + '.gz', 'wb')
+    elif compression == 'zstd':
+        return ZstdFile(path + '.zst')
+    raise ValueError("Unknown compression type: " + str(compression))
+
+def CheckOutputOptions(output_formats, compression):
+    """
+    Returns an error message if the output options are not valid, otherwise
+    None.
+    """
+    for output_format in output_formats:
+        if output_format not in OUTPUT_FORMATS:
+            return "Unknown output format: %s (choose from %s)" % (output_format, ", ".join(OUTPUT_FORMATS))
+    if compression is not None:
+        if compression not in COMPRESSION_TYPES:
+            return "Unknown compression type: %s (choose from %s)" % (compression, ", ".join(COMPRESSION_TYPES))
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                return "zstd compression requires the zstandard python module"
+    return None
+
+def CheckFilterThresholds(max_gap_fraction, min_conservation, max_conservation):
+    """
+    Returns an error message if any of the column filtering thresholds is
+    not a fraction between 0 and 1, otherwise None.
+    """
+    for (name, value) in (('max_gap_fraction', max_gap_fraction),
+                          ('min_conservation', min_conservation),
+                          ('max_conservation', max_conservation)):
+        if value is not None and not 0 <= value <= 1:
+            return "%s must be between 0 and 1, not %s" % (name, value)
+    return None
+
+#--- Writers
+
+class FastaWriter(object):
+    """
+    Writes the concatenated alignment of each genome record in FASTA format.
+    """
+    def __init__(self, fh):
+        self.fh = fh
+
+    def Write(self, record, aligned_seq):
+        self.fh.write(FormatFastaRecord(record['tree_id'], aligned_seq))
+
+    def Close(self):
+        self.fh.close()
+
+class GreengenesWriter(object):
+    """
+    Writes each genome record with its concatenated alignment and metadata in
+    the ARB greengenes format.
+    """
+    def __init__(self, fh, total_marker_count):
+        self.fh = fh
+        self.total_marker_count = total_marker_count
+
+    def Write(self, record, aligned_seq):
+        (gg_tax, internal_tax, core_list_status) = GetMetadataFields(record)
+        gg_list = ["db_name=%s" % record['tree_id'],
+                   "organism=%s" % record['name'],
+                   "prokMSA_id=%s" % record['tree_id'],
+                   "owner=%s" % record['owner'],
+                   "genome_tree_tax_string=%s" % internal_tax,
+                   "greengenes_tax_string=%s" % gg_tax,
+                   "core_list_status=%s" % core_list_status,
+                   "remark=%iof%i" % (len(record['markers']), self.total_marker_count),
+                   "warning=",
+                   "aligned_seq=%s" % (aligned_seq)]
+        self.fh.write(FormatGreengenesRecord(gg_list))
+
+    def Close(self):
+        self.fh.close()
+
+class PhylipWriter(object):
+    """
+    Writes the concatenated alignment of each genome record in relaxed
+    (sequential, unlimited name length) PHYLIP format. The number of records
+    must be known up front for the header.
+    """
+    def __init__(self, fh, ntaxa, nchar):
+        self.fh = fh
+        self.fh.write("%i %i\n" % (ntaxa, nchar))
+
+    def Write(self, record, aligned_seq):
+        self.fh.write("%s %s\n" % (record['tree_id'], aligned_seq))
+
+    def Close(self):
+        self.fh.close()
+
+class TreeBuilderWriter(object):
+    """
+    Streams the concatenated alignment of each genome record in FASTA format
+    to the stdin of a tree building program (e.g. "FastTree -lg") while the
+    alignment is still being generated. The program's stdout (the Newick
+    tree) and stderr are saved to the specified files.
+
+    Close() once the whole alignment has been written, otherwise Abort() so
+    no tree is built from a partial alignment.
+    """
+    def __init__(self, command, newick_path, log_path):
+        self.command = command
+        self.newick_path = newick_path
+        self.log_path = log_path
+        self.returncode = None
+        self.newick_fh = open(newick_path, 'wb')
+        self.log_fh = open(log_path, 'wb')
+        try:
+            self.process = subprocess.Popen(shlex.split(command), bufsize=-1,
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.newick_fh,
+                                            stderr=self.log_fh)
+        except OSError:
+            self.newick_fh.close()
+            self.log_fh.close()
+            raise
+
+    def Write(self, record, aligned_seq):
+        try:
+            self.process.stdin.write(FormatFastaRecord(record['tree_id'], aligned_seq))
+        except IOError as e:
+            raise ValueError("Tree builder '%s' stopped reading its input (%s), see %s" %
+                             (self.command, str(e), self.log_path))
+
+    def Close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.returncode = self.process.wait()
+        self.newick_fh.close()
+        self.log_fh.close()
+
+    def Abort(self):
+        """
+        Kills the tree builder and removes its partial tree.
+        """
+        try:
+            self.process.kill()
+        except OSError:
+            # It has already exited
+            pass
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.returncode = self.process.wait()
+        self.newick_fh.close()
+        self.log_fh.close()
+        try:
+            os.unlink(self.newick_path)
+        except OSError:
+            pass
+
+def MakeConcatenatedTreeData(GenomeDatabase, list_of_genome_ids, directory, prefix,
+                             database_name, version, max_gap_fraction=None,
+                             min_conservation=None, max_conservation=None,
+                             output_formats=DEFAULT_OUTPUT_FORMATS, compression=None,
+                             tree_builder=None, **kwargs):
+    """
+    Streams the concatenated marker alignment of each genome to the outputs
+    as soon as its markers have been read. output_formats is any of .fasta,
+    .greengenes, relaxed .phylip and the memory mappable packed binary .aln
+    (see packed_alignment.py). The text formats are compressed on the fly if
+    compression is 'gzip' or 'zstd'.
+
+    If tree_builder is given, it is a command line which is run alongside
+    the export with the alignment streamed to its stdin (see
+    TreeBuilderWriter). Its Newick output is saved to .tree.
+
+    If any of the column filtering thresholds are given, the alignment is
+    read twice: once to compute the column statistics and once to write the
+    filtered alignment. The map of kept columns is written to .column_map.
+    """
+    error = CheckOutputOptions(output_formats, compression)
+    if error is None:
+        error = CheckFilterThresholds(max_gap_fraction, min_conservation, max_conservation)
+    if error is not None:
+        GenomeDatabase.ReportError(error)
+        return None
+
+    with GenomeDatabase.Cursor() as cur:
+        chosen_markers = GetChosenMarkers(cur, database_name, version)
+
+    nchar = sum([size for (marker_id, database_specific_id, size) in chosen_markers])
+
+    col_filter = None
+    if (max_gap_fraction is not None or min_conservation is not None or
+        max_conservation is not None):
+        # Only require NumPy if filtering is requested
+        import column_filter
+        col_filter = column_filter.ColumnFilter(chosen_markers, max_gap_fraction,
+                                                min_conservation, max_conservation)
+        try:
+            for record in IterGenomeRecords(GenomeDatabase, list_of_genome_ids,
+                                            database_name, version, report_missing=False):
+                col_filter.Observe(ConcatenateMarkers(record, chosen_markers))
+        except ValueError as e:
+            GenomeDatabase.ReportError("Unable to filter alignment columns: " + str(e))
+            return None
+        nchar = col_filter.Finalise()
+        sys.stderr.write("Column filtering kept %i of %i alignment columns.\n" %
+                         (nchar, col_filter.width))
+        colmap_fh = open(os.path.join(directory, prefix + ".column_map"), 'wb')
+        try:
+            col_filter.WriteColumnMap(colmap_fh)
+        finally:
+            colmap_fh.close()
+
+    # The writers are opened inside the try, so that those already open are
+    # closed (and the tree builder stopped) if a later one can't be opened.
+    writers = []
+    tree_builder_writer = None
+    completed = False
+    try:
+        for output_format in output_formats:
+            path = os.path.join(directory, prefix + "." + output_format)
+            if output_format == 'fasta':
+                writers.append(FastaWriter(OpenOutput(path, compression)))
+            elif output_format == 'greengenes':
+                writers.append(GreengenesWriter(OpenOutput(path, compression), len(chosen_markers)))
+            elif output_format == 'phylip':
+                ntaxa = CountGenomeRecords(GenomeDatabase, list_of_genome_ids, database_name, version)
+                writers.append(PhylipWriter(OpenOutput(path, compression), ntaxa, nchar))
+            elif output_format == 'packed':
+                writers.append(packed_alignment.PackedAlignmentWriter(os.path.join(directory, prefix + ".aln"),
+                                                                      nchar))
+
+        if tree_builder is not None:
+            try:
+                tree_builder_writer = TreeBuilderWriter(tree_builder,
+                                                        os.path.join(directory, prefix + ".tree"),
+                                                        os.path.join(directory, prefix + ".tree.log"))
+            except OSError as e:
+                GenomeDatabase.ReportError("Unable to run tree builder '%s': %s" % (tree_builder, str(e)))
+                return None
+            writers.append(tree_builder_writer)
+
+        for record in IterGenomeRecords(GenomeDatabase, list_of_genome_ids,
+                                        database_name, version):
+            aligned_seq = ConcatenateMarkers(record, chosen_markers)
+            if col_filter is not None:
+                aligned_seq = col_filter.Apply(aligned_seq)
+            for writer in writers:
+                writer.Write(record, aligned_seq)
+        completed = True
+    except (IOError, ValueError) as e:
+        GenomeDatabase.ReportError("Unable to write tree data: " + str(e))
+        return None
+    finally:
+        # Anything else (e.g. a database error) also leaves the alignment
+        # incomplete, so the tree builder is stopped rather than left to
+        # finish on it.
+        for writer in writers:
+            if writer is tree_builder_writer and not completed:
+                writer.Abort()
+            else:
+                writer.Close()
+
+    if tree_builder_writer is not None and tree_builder_writer.returncode != 0:
+        GenomeDatabase.ReportError("Tree builder '%s' failed with exit code %i, see %s" %
+                                   (tree_builder, tree_builder_writer.returncode,
+                                    tree_builder_writer.log_path))
+        return None
+
+    return True
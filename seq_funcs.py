@@ -0,0 +1,85 @@
+"""
+Pure python sequence handling used by the marker pipelines. Kept free of
+database and HMMER dependencies so that it can be imported (and
+benchmarked) on its own.
+"""
+
+# The genomes are split into segments of this length, overlapping by half,
+# so that hmmalign never has to align more than one segment.
+SEGMENT_LENGTH = 10000
+SEGMENT_STEP = 5000
+
+def readfq(fp): # this is a generator function
+    """https://github.com/lh3/"""
+    last = None # this is a buffer keeping the last unprocessed line
+    while True: # mimic closure; is it a bad idea?
+        if not last: # the first record or a record following a fastq
+            for l in fp: # search for the start of the next record
+                if l[0] in '>@': # fasta/q header line
+                    last = l[:-1] # save this line
+                    break
+        if not last: break
+        name, seqs, last = last[1:].split()[0], [], None
+        for l in fp: # read the sequence
+            if l[0] in '@+>':
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[0] != '+': # this is a fasta record
+            yield name, ''.join(seqs), None # yield a fasta record
+            if not last: break
+        else: # this is a fastq record
+            seq, leng, seqs = ''.join(seqs), 0, []
+            for l in fp: # read the quality
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+                if leng >= len(seq): # have read enough quality
+                    last = None
+                    yield name, seq, ''.join(seqs); # yield a fastq record
+                    break
+            if last: # reach EOF before reading enough quality
+                yield name, seq, None # yield a fasta record instead
+                break
+
+def SegmentSequence(seq, length=SEGMENT_LENGTH, step=SEGMENT_STEP):
+    """
+    Generator yielding (start, end, segment) tuples covering the sequence in
+    segments of the specified length, each starting step bases after the
+    previous one. The end of the last segment may be past the end of the
+    sequence.
+    """
+    end = length
+    while True:
+        yield (end - length, end, seq[end - length:end])
+        if len(seq) <= end:
+            break
+        end += step
+
+def WriteSegmentedFasta(fh, records):
+    """
+    Writes the segments (see SegmentSequence) of each (name, seq, qual)
+    record to fh in FASTA format, named start_end_name.
+    """
+    for (name, seq, qual) in records:
+        for (start, end, segment) in SegmentSequence(seq):
+            fh.write(">%i_%i_%s\n%s\n" % (start, end, name, segment))
+
+def ReadMaskedAlignment(fh):
+    """
+    Returns the match columns (those marked 'x' on the #=GC RF line) of the
+    aligned sequence in an hmmalign Pfam format alignment of one sequence.
+    """
+    fh.readline()
+    fh.readline()
+    seqline = fh.readline()
+    seq_start_pos = seqline.rfind(' ')
+    fh.readline()
+    fh.readline()
+    mask = fh.readline()
+    return MaskAlignedSequence(seqline[seq_start_pos:], mask[seq_start_pos:])
+
+def MaskAlignedSequence(seqline, mask):
+    """
+    Returns the characters of seqline at the positions marked 'x' in mask.
+    """
+    return ''.join([seqline[x] for x in range(0, len(seqline)) if mask[x] == 'x'])
@@ -0,0 +1,181 @@
+"""
+Opt-in SQL instrumentation for GenomeDatabase (the --profile-sql option).
+Every statement run through a profiled connection is timed and attributed to
+the outermost GenomeDatabase method on the call stack, e.g. a marker lookup
+run for CalculateMarkersForGenome by RecalculateAllMarkers is counted under
+RecalculateAllMarkers.
+"""
+
+import sys
+import json
+import time
+import heapq
+import threading
+
+import psycopg2 as pg
+
+SLOWEST_STATEMENT_COUNT = 10
+STATEMENT_TEXT_LIMIT = 500
+
+# Statements run outside of any GenomeDatabase method
+OTHER_METHOD = '<other>'
+
+def MethodCodeNames(cls):
+    """
+    Returns a dict of the code objects of the methods of cls, including the
+    functions nested in them (e.g. the row generators), to the method name.
+    """
+    code_names = dict()
+    def AddCode(code, name):
+        code_names[code] = name
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                AddCode(const, name)
+    for klass in cls.__mro__:
+        for (name, value) in klass.__dict__.items():
+            if isinstance(value, property):
+                value = value.fget
+            code = getattr(value, 'func_code', None)
+            if code is not None and code not in code_names:
+                AddCode(code, name)
+    return code_names
+
+class MethodStats(object):
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        # Min heap of (seconds, statement)
+        self.slowest = []
+
+    def Add(self, seconds, rows, statement):
+        self.seconds += seconds
+        if rows > 0:
+            self.rows += rows
+        if statement is None:
+            return
+        self.queries += 1
+        entry = (seconds, statement[:STATEMENT_TEXT_LIMIT])
+        if len(self.slowest) < SLOWEST_STATEMENT_COUNT:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+class SqlProfiler(object):
+    def __init__(self, cls):
+        self.cursor_factory = ProfilingCursor
+        self.code_names = MethodCodeNames(cls)
+        self.stats = dict()
+        self.lock = threading.Lock()
+
+    def CurrentMethod(self):
+        method = OTHER_METHOD
+        frame = sys._getframe(2)
+        while frame is not None:
+            name = self.code_names.get(frame.f_code)
+            if name is not None:
+                method = name
+            frame = frame.f_back
+        return method
+
+    def Record(self, method, seconds, rows, statement=None):
+        """
+        Adds a statement (or, with no statement, more time and rows for a
+        statement already recorded) to the stats of a method.
+        """
+        with self.lock:
+            if method not in self.stats:
+                self.stats[method] = MethodStats()
+            self.stats[method].Add(seconds, rows, statement)
+
+    def Summary(self):
+        """
+        Returns a dict of method -> queries, seconds, rows and slowest
+        statements, ready to be written as JSON.
+        """
+        with self.lock:
+            summary = dict()
+            for (method, stats) in self.stats.items():
+                summary[method] = {'queries' : stats.queries,
+                                   'seconds' : stats.seconds,
+                                   'rows' : stats.rows,
+                                   'slowest' : [{'seconds' : seconds, 'statement' : statement}
+                                                for (seconds, statement) in sorted(stats.slowest, reverse=True)]}
+            return summary
+
+    def WriteReport(self, fh):
+        summary = self.Summary()
+        methods = sorted(summary.items(), key=lambda item: item[1]['seconds'], reverse=True)
+        fh.write("%-40s %8s %12s %12s %10s\n" % ("Method", "Queries", "Total (ms)", "Mean (ms)", "Rows"))
+        for (method, stats) in methods:
+            fh.write("%-40s %8i %12.1f %12.2f %10i\n" % (method, stats['queries'], stats['seconds'] * 1000,
+                                                         stats['seconds'] * 1000 / max(stats['queries'], 1),
+                                                         stats['rows']))
+        slowest = []
+        for (method, stats) in methods:
+            slowest += [(statement['seconds'], method, statement['statement']) for statement in stats['slowest']]
+        if slowest:
+            fh.write("\nSlowest statements:\n")
+        for (seconds, method, statement) in sorted(slowest, reverse=True)[:SLOWEST_STATEMENT_COUNT]:
+            fh.write("%10.1f ms  %s: %s\n" % (seconds * 1000, method, ' '.join(statement.split())))
+
+    def WriteJson(self, path):
+        fh = open(path, 'wb')
+        try:
+            json.dump(self.Summary(), fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+
+class ProfilingCursor(pg.extensions.cursor):
+    """
+    Cursor recording its statements in the SqlProfiler of its connection.
+    For server side cursors the rows are fetched after execute, so the time
+    and rows of the fetches are added to the statement's method as well.
+    """
+    def _Timed(self, statement, func, *args):
+        profiler = self.connection.profiler
+        method = profiler.CurrentMethod()
+        start = time.time()
+        try:
+            return func(self, *args)
+        finally:
+            rows = self.rowcount if self.name is None else 0
+            profiler.Record(method, time.time() - start, rows, statement)
+
+    def _TimedFetch(self, func, *args):
+        if self.name is None:
+            return func(self, *args)
+        profiler = self.connection.profiler
+        method = profiler.CurrentMethod()
+        start = time.time()
+        result = func(self, *args)
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        profiler.Record(method, time.time() - start, rows)
+        return result
+
+    def execute(self, query, vars=None):
+        return self._Timed(query, pg.extensions.cursor.execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._Timed(query, pg.extensions.cursor.executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, *args):
+        return self._Timed(sql, pg.extensions.cursor.copy_expert, sql, file, *args)
+
+    def fetchone(self):
+        return self._TimedFetch(pg.extensions.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._TimedFetch(pg.extensions.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._TimedFetch(pg.extensions.cursor.fetchall)
+
+    def __iter__(self):
+        # Fetch in blocks through fetchmany so the fetches are recorded
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import numpy
+    from profiles import column_filter
+except ImportError:
+    numpy = None
+
+CHOSEN_MARKERS = [(1, 'PMPROK00001', 3), (2, 'PMPROK00002', 2)]
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ColumnFilterTest(unittest.TestCase):
+    def MakeFilter(self, alignment, chunk_size=64, **thresholds):
+        col_filter = column_filter.ColumnFilter(CHOSEN_MARKERS, chunk_size=chunk_size, **thresholds)
+        for aligned_seq in alignment:
+            col_filter.Observe(aligned_seq)
+        col_filter.Finalise()
+        return col_filter
+
+    def testColumnStatistics(self):
+        col_filter = self.MakeFilter(['AAA-a', 'ACA-c', 'AG--C', 'AT-xB'])
+        self.assertEqual(list(col_filter.gap_fraction), [0.0, 0.0, 0.5, 0.75, 0.0])
+        # Conservation ignores gaps and case
+        self.assertEqual(list(col_filter.conservation), [1.0, 0.25, 1.0, 1.0, 0.5])
+
+    def testStatisticsDoNotDependOnChunkSize(self):
+        alignment = ['AAA-a', 'ACA-c', 'AG--C', 'AT-xB', 'CCCCC']
+        whole = self.MakeFilter(alignment)
+        chunked = self.MakeFilter(alignment, chunk_size=2)
+        self.assertEqual(list(whole.gap_fraction), list(chunked.gap_fraction))
+        self.assertEqual(list(whole.conservation), list(chunked.conservation))
+
+    def testNoThresholdsKeepsEveryColumn(self):
+        col_filter = self.MakeFilter(['AAA-a', 'ACA-c'])
+        self.assertEqual(list(col_filter.kept_columns), [0, 1, 2, 3, 4])
+        self.assertEqual(col_filter.Apply('AAA-a'), 'AAA-a')
+
+    def testThresholdsAreInclusive(self):
+        alignment = ['AAA-a', 'ACA-c', 'AG--C', 'AT-xB']
+        col_filter = self.MakeFilter(alignment, max_gap_fraction=0.5)
+        self.assertEqual(list(col_filter.kept_columns), [0, 1, 2, 4])
+        col_filter = self.MakeFilter(alignment, min_conservation=0.5)
+        self.assertEqual(list(col_filter.kept_columns), [0, 2, 3, 4])
+        col_filter = self.MakeFilter(alignment, max_conservation=0.5)
+        self.assertEqual(list(col_filter.kept_columns), [1, 4])
+        col_filter = self.MakeFilter(alignment, max_gap_fraction=0.5, max_conservation=0.5)
+        self.assertEqual(list(col_filter.kept_columns), [1, 4])
+        self.assertEqual(col_filter.Apply('AT-xB'), 'TB')
+
+    def testWrongWidthIsRejected(self):
+        col_filter = column_filter.ColumnFilter(CHOSEN_MARKERS)
+        self.assertRaises(ValueError, col_filter.Observe, 'AAAA')
+
+    def testColumnMap(self):
+        col_filter = self.MakeFilter(['AAA-a', 'ACA-c', 'AG--C', 'AT-xB'], max_gap_fraction=0.5)
+        fh = StringIO()
+        col_filter.WriteColumnMap(fh)
+        lines = fh.getvalue().splitlines()
+        self.assertEqual(lines[0], "column\tmarker\tmarker_position\tgap_fraction\tconservation\tfiltered_column")
+        self.assertEqual(lines[1:],
+                         ["1\tPMPROK00001\t1\t0.0000\t1.0000\t1",
+                          "2\tPMPROK00001\t2\t0.0000\t0.2500\t2",
+                          "3\tPMPROK00001\t3\t0.5000\t1.0000\t3",
+                          "4\tPMPROK00002\t1\t0.7500\t1.0000\t-",
+                          "5\tPMPROK00002\t2\t0.0000\t0.5000\t4"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_migrations
+
+# These tests need a PostgreSQL server to run the migration functions on, set
+# GENOME_TREE_TEST_DSN (e.g. "dbname=postgres user=postgres host=/tmp") to
+# run them. Nothing is committed.
+TEST_DSN = os.environ.get('GENOME_TREE_TEST_DSN')
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+@unittest.skipIf(psycopg2 is None or TEST_DSN is None, "GENOME_TREE_TEST_DSN is not set")
+class RemoveXmlElementTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = psycopg2.connect(TEST_DSN)
+        self.cur = self.conn.cursor()
+        self.cur.execute(db_migrations.REMOVE_XML_ELEMENT_FUNCTION)
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.conn.close()
+
+    def RemoveElement(self, doc, element_path):
+        self.cur.execute("SELECT genome_tree_remove_xml_element(%s, %s)", (doc, element_path))
+        return self.cur.fetchone()[0]
+
+    def testOnlyThePromotedPathIsRemoved(self):
+        doc = ('<data><internal><core_list>public</core_list><taxonomy>k__Bacteria</taxonomy></internal>' +
+               '<other><core_list>kept</core_list></other></data>')
+        self.assertEqual(self.RemoveElement(doc, ['data', 'internal', 'core_list']),
+                         '<data><internal><taxonomy>k__Bacteria</taxonomy></internal>' +
+                         '<other><core_list>kept</core_list></other></data>')
+
+    def testNestedElementsAreKept(self):
+        doc = '<data><internal><x><core_list>nested</core_list></x><core_list>public</core_list></internal></data>'
+        self.assertEqual(self.RemoveElement(doc, ['data', 'internal', 'core_list']),
+                         '<data><internal><x><core_list>nested</core_list></x></internal></data>')
+
+    def testAttributesAndEmptyElementsAreRemoved(self):
+        doc = '<data><internal a="1"><core_list x="a>b">public</core_list><core_list/></internal></data>'
+        self.assertEqual(self.RemoveElement(doc, ['data', 'internal', 'core_list']),
+                         '<data><internal a="1"></internal></data>')
+
+    def testCommentsAndDeclarationsAreIgnored(self):
+        doc = ('<?xml version="1.0"?>\n<data><!-- <core_list>c</core_list> -->' +
+               '<internal><core_list><![CDATA[<a>]]></core_list>text</internal></data>')
+        self.assertEqual(self.RemoveElement(doc, ['data', 'internal', 'core_list']),
+                         '<?xml version="1.0"?>\n<data><!-- <core_list>c</core_list> -->' +
+                         '<internal>text</internal></data>')
+
+    def testDeepPath(self):
+        doc = ('<data><internal><greengenes><dereplicated><best_blast><greengenes_tax>gg</greengenes_tax>' +
+               '<identity>99</identity></best_blast></dereplicated></greengenes></internal>' +
+               '<ncbi><taxonomy>t</taxonomy></ncbi></data>')
+        self.assertEqual(self.RemoveElement(doc, ['data', 'internal', 'greengenes', 'dereplicated',
+                                                  'best_blast', 'greengenes_tax']),
+                         '<data><internal><greengenes><dereplicated><best_blast>' +
+                         '<identity>99</identity></best_blast></dereplicated></greengenes></internal>' +
+                         '<ncbi><taxonomy>t</taxonomy></ncbi></data>')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import gevent
+    import gevent.lock
+    import genome_tree_async
+except ImportError:
+    gevent = None
+
+class FakeGenomeDatabase(object):
+    """
+    Stands in for GenomeDatabase, streaming more rows than fit in the queue.
+    """
+    def __init__(self, row_count):
+        self.row_count = row_count
+        self.released = 0
+        self.closed = False
+
+    def SearchGenomes(self):
+        try:
+            for i in range(self.row_count):
+                yield (i,)
+        finally:
+            self.closed = True
+
+    def ReleaseConnection(self):
+        self.released += 1
+
+@unittest.skipIf(gevent is None, "gevent is not installed")
+class StreamTest(unittest.TestCase):
+    def MakeAsyncDatabase(self, row_count, max_connections=1):
+        # Bypasses __init__, which needs the monkey patching and a backend
+        async_db = genome_tree_async.AsyncGenomeDatabase.__new__(genome_tree_async.AsyncGenomeDatabase)
+        async_db.db = FakeGenomeDatabase(row_count)
+        async_db.slots = gevent.lock.BoundedSemaphore(max_connections)
+        return async_db
+
+    def testStoppingEarlyReleasesTheConnection(self):
+        async_db = self.MakeAsyncDatabase(genome_tree_async.STREAM_QUEUE_SIZE * 4)
+        rows = async_db.IterSearchGenomes()
+        self.assertEqual(next(rows), (0,))
+        # Let the producer fill the queue and block on it
+        gevent.sleep(0.01)
+        with gevent.Timeout(5):
+            rows.close()
+            gevent.sleep(0.01)
+        self.assertFalse(async_db.slots.locked())
+        self.assertEqual(async_db.db.released, 1)
+        self.assertTrue(async_db.db.closed)
+
+    def testStreamsAllRows(self):
+        row_count = genome_tree_async.STREAM_QUEUE_SIZE * 2 + 1
+        async_db = self.MakeAsyncDatabase(row_count)
+        with gevent.Timeout(5):
+            rows = list(async_db.IterSearchGenomes())
+        self.assertEqual(rows, [(i,) for i in range(row_count)])
+        gevent.sleep(0)
+        self.assertFalse(async_db.slots.locked())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import psycopg2
+    import genome_tree_backend
+except ImportError:
+    psycopg2 = None
+
+@unittest.skipIf(psycopg2 is None, "psycopg2 is not installed")
+class CopyRowTest(unittest.TestCase):
+    def testPlainValues(self):
+        self.assertEqual(genome_tree_backend.CopyRow(('C00000001', 12, 1.5)), "C00000001\t12\t1.5\n")
+
+    def testNoneIsNull(self):
+        self.assertEqual(genome_tree_backend.CopyRow(('C00000001', None)), "C00000001\t\\N\n")
+
+    def testSpecialCharactersAreEscaped(self):
+        self.assertEqual(genome_tree_backend.CopyRow(('a\tb', 'c\\d', 'e\nf', 'g\rh')),
+                         "a\\tb\tc\\\\d\te\\nf\tg\\rh\n")
+
+    def testEscapedBackslashIsNotNull(self):
+        self.assertEqual(genome_tree_backend.CopyRow(('\\N',)), "\\\\N\n")
+
+@unittest.skipIf(psycopg2 is None, "psycopg2 is not installed")
+class IterFileTest(unittest.TestCase):
+    def testReadInPieces(self):
+        fh = genome_tree_backend.IterFile(iter(['ab', 'cde', '', 'f']))
+        self.assertEqual(fh.read(3), 'abc')
+        self.assertEqual(fh.read(1), 'd')
+        self.assertEqual(fh.read(), 'ef')
+        self.assertEqual(fh.read(4), '')
+
+    def testReadline(self):
+        fh = genome_tree_backend.IterFile(iter(['a\tb\nc', '\td\n', 'e']))
+        self.assertEqual(fh.readline(), 'a\tb\n')
+        self.assertEqual(fh.readline(2), 'c\t')
+        self.assertEqual(fh.readline(), 'd\n')
+        self.assertEqual(fh.readline(), 'e')
+        self.assertEqual(fh.readline(), '')
+
+    def testRowsRoundTrip(self):
+        rows = [('C00000001', 'k__Bacteria;\tp__Firmicutes'), ('C00000002', None)]
+        fh = genome_tree_backend.IterFile(genome_tree_backend.CopyRow(row) for row in rows)
+        self.assertEqual(fh.read(), "C00000001\tk__Bacteria;\\tp__Firmicutes\nC00000002\t\\N\n")
+
+if __name__ == '__main__':
+    unittest.main()
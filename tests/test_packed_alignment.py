@@ -0,0 +1,72 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiles import packed_alignment
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PackedAlignmentTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.aln')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def WriteAlignment(self, rows, ncols):
+        writer = packed_alignment.PackedAlignmentWriter(self.path, ncols)
+        for (tree_id, aligned_seq) in rows:
+            writer.Write({'tree_id' : tree_id}, aligned_seq)
+        writer.Close()
+
+    def testHeaderAndIndex(self):
+        self.WriteAlignment([('C00000001', 'ACGT-'), ('C00000002', 'TT-AA')], 5)
+        fh = open(self.path, 'rb')
+        header = struct.unpack(packed_alignment.HEADER_FORMAT, fh.read(packed_alignment.HEADER_SIZE))
+        rows = fh.read()
+        fh.close()
+        self.assertEqual(header, (packed_alignment.MAGIC, 2, 5))
+        self.assertEqual(rows, 'ACGT-TT-AA')
+        self.assertEqual(open(self.path + '.idx', 'rb').read(),
+                         "0\tC00000001\t%i\n1\tC00000002\t%i\n" % (packed_alignment.HEADER_SIZE,
+                                                                    packed_alignment.HEADER_SIZE + 5))
+
+    def testWrongWidthIsRejected(self):
+        writer = packed_alignment.PackedAlignmentWriter(self.path, 5)
+        try:
+            self.assertRaises(ValueError, writer.Write, {'tree_id' : 'C00000001'}, 'ACGT')
+        finally:
+            writer.Close()
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testLoadRoundTrip(self):
+        self.WriteAlignment([('C00000001', 'ACGT-'), ('C00000002', 'TT-AA')], 5)
+        (tree_ids, alignment) = packed_alignment.LoadPackedAlignment(self.path)
+        self.assertEqual(tree_ids, ['C00000001', 'C00000002'])
+        self.assertEqual(alignment.shape, (2, 5))
+        self.assertEqual(alignment[1].tobytes(), 'TT-AA')
+        del alignment
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testLoadEmpty(self):
+        self.WriteAlignment([], 5)
+        (tree_ids, alignment) = packed_alignment.LoadPackedAlignment(self.path)
+        self.assertEqual(tree_ids, [])
+        self.assertEqual(alignment.shape, (0, 5))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testLoadRejectsOtherFiles(self):
+        open(self.path, 'wb').write('>C00000001\nACGT-\n' + ' ' * packed_alignment.HEADER_SIZE)
+        self.assertRaises(ValueError, packed_alignment.LoadPackedAlignment, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiles import tree_data
+
+# Reads the whole alignment before writing its tree, like a real tree builder
+TREE_BUILDER = "sh -c 'cat > /dev/null; echo \"(A,B);\"'"
+CHOSEN_MARKERS = [(1, 'PMPROK00001', 4)]
+
+class FakeCursor(object):
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return CHOSEN_MARKERS
+
+    def __iter__(self):
+        for (i, row) in enumerate(self.rows):
+            if i == self.fail_after:
+                raise RuntimeError("connection lost")
+            yield row
+
+class FakeGenomeDatabase(object):
+    """
+    Stands in for GenomeDatabase, returning the marker list and then the
+    genome rows to the tree data queries.
+    """
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+        self.lastErrorMessage = None
+
+    @contextmanager
+    def Cursor(self, name=None):
+        yield FakeCursor(self.rows, self.fail_after)
+
+    def ReportError(self, msg):
+        self.lastErrorMessage = msg
+
+def GenomeRow(genome_id, sequence):
+    return (genome_id, 'C%08i' % genome_id, 'Genome', 'root', 'public', '', '', [1], [sequence])
+
+class FilterThresholdsTest(unittest.TestCase):
+    def testFractionsAreAccepted(self):
+        self.assertEqual(tree_data.CheckFilterThresholds(None, None, None), None)
+        self.assertEqual(tree_data.CheckFilterThresholds(0, 0.5, 1), None)
+
+    def testOutOfRangeIsRejected(self):
+        self.assertNotEqual(tree_data.CheckFilterThresholds(-0.1, None, None), None)
+        self.assertNotEqual(tree_data.CheckFilterThresholds(None, 50, None), None)
+        self.assertNotEqual(tree_data.CheckFilterThresholds(None, None, float('nan')), None)
+
+class TreeBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree_path = os.path.join(self.directory, 'test.tree')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def MakeTreeData(self, db):
+        return tree_data.MakeConcatenatedTreeData(db, [1, 2, 3], self.directory, 'test', 'Phylosift', '1',
+                                                  output_formats=['fasta'], tree_builder=TREE_BUILDER)
+
+    def testCompleteAlignmentBuildsTree(self):
+        db = FakeGenomeDatabase([GenomeRow(1, 'ACGT'), GenomeRow(2, 'AC-T'), GenomeRow(3, 'A--T')])
+        self.assertEqual(self.MakeTreeData(db), True)
+        self.assertEqual(open(self.tree_path).read(), "(A,B);\n")
+
+    def testFailedExportAbortsTreeBuilder(self):
+        db = FakeGenomeDatabase([GenomeRow(1, 'ACGT'), GenomeRow(2, 'AC-T'), GenomeRow(3, 'A--T')],
+                                fail_after=2)
+        self.assertRaises(RuntimeError, self.MakeTreeData, db)
+        self.assertFalse(os.path.exists(self.tree_path))
+
+    def testWriteErrorAbortsTreeBuilder(self):
+        # The wrong width makes the packed writer raise ValueError
+        db = FakeGenomeDatabase([GenomeRow(1, 'ACGT'), GenomeRow(2, 'AC-')])
+        result = tree_data.MakeConcatenatedTreeData(db, [1, 2], self.directory, 'test', 'Phylosift', '1',
+                                                    output_formats=['packed'], tree_builder=TREE_BUILDER)
+        self.assertEqual(result, None)
+        self.assertTrue(db.lastErrorMessage.startswith("Unable to write tree data"))
+        self.assertFalse(os.path.exists(self.tree_path))
+
+if __name__ == '__main__':
+    unittest.main()